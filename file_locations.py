@@ -29,6 +29,10 @@ FBI_CRIME_2017_XLS_FILENAME = './primary_sources/fbi/Table_8_Offenses_Known_to_L
 FBI_CRIME_2018_XLS_FILENAME = './primary_sources/fbi/Table_8_Offenses_Known_to_Law_Enforcement_by_State_by_City_2018.xls'
 FBI_CRIME_2019_XLS_FILENAME = './primary_sources/fbi/Table_8_Offenses_Known_to_Law_Enforcement_by_State_by_City_2019.xls'
 FBI_CRIME_COMBINED_CSV_FILENAME = './primary_sources/fbi/fbi_normalized.csv'
+# Parsed copies of the xls files above, so xlrd only runs when one changes.
+FBI_XLS_CACHE_DIR = './primary_sources/fbi/xls_cache/'
+# Running sums of the normalized years above, see merging_code/fbi_aggregate.py.
+FBI_AGGREGATE_FILENAME = './primary_sources/fbi/fbi_aggregate.pkl'
 
 # ./primary_sources/cdc
 CDC_PROVISIONAL_COVID19_DEATHS_2020_FILENAME = './primary_sources/cdc/Provisional_COVID-19_Death_Counts_in_the_United_States_by_County.csv'
@@ -44,3 +48,10 @@ ELECTIONS_FINAL_CSV_FILENAME = './primary_sources/elections/elections_normalized
 
 # master compiled csv output
 MASTER_CSV_FILENAME = './city_comparison.csv'
+# Hashes of every stage's inputs, code and output, from the last build.
+BUILD_MANIFEST_JSON_FILENAME = './primary_sources/build_manifest.json'
+# Fuzzy 'state' and 'city' matches resolved while merging the geocode city list.
+FUZZY_MATCH_CACHE_CSV_FILENAME = './primary_sources/fuzzy_match_cache.csv'
+# The api responses of every scraper, see merging_code/scrape_cache.py.  It's
+# kept in sync with the *_CACHED_JSON_FILENAME files above.
+SCRAPE_CACHE_FILENAME = './primary_sources/scrape_cache.sqlite'
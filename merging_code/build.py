@@ -0,0 +1,332 @@
+#!/usr/bin/env python3
+"""
+Rebuild the *_normalized.csv and *_scraped.csv files, then the master csv, but
+only the ones whose inputs changed.  The sha1 of every input file, and of the
+code of every stage, is recorded in BUILD_MANIFEST_JSON_FILENAME.  A stage is
+rerun when one of those hashes changed, or when its output is missing or was
+changed by hand.  Since upstream outputs are inputs of downstream stages, a
+rebuild that doesn't change an output doesn't rebuild anything after it.
+
+Stages that don't depend on each other, like the normalizers, run at the same
+time in a process pool.  The wall time of every stage, and the critical path
+(the slowest chain of dependent stages), are logged at the end.
+
+python -m merging_code.build [--force] [stage_name ...]
+"""
+
+import argparse
+import concurrent.futures
+import importlib
+import os
+import sys
+import time
+from file_locations import BUILD_MANIFEST_JSON_FILENAME
+from file_locations import CDC_FINAL_CSV_FILENAME, CDC_PROVISIONAL_COVID19_DEATHS_2020_FILENAME
+from file_locations import CENSUS_2019_POPULATION_FILENAME
+from file_locations import CENSUS_AREA_2010_CSV_FILENAME, CENSUS_FINAL_CSV_FILENAME
+from file_locations import CITY_CODES_CSV_FILENAME
+from file_locations import ELECTIONS_2020_FILENAME, ELECTIONS_FINAL_CSV_FILENAME
+from file_locations import EXPERIAN_FINAL_CSV_FILENAME, EXPERIAN_SOURCE_CSV_DIR
+from file_locations import FBI_CRIME_2015_XLS_FILENAME, FBI_CRIME_2016_XLS_FILENAME
+from file_locations import FBI_CRIME_2017_XLS_FILENAME, FBI_CRIME_2018_XLS_FILENAME
+from file_locations import FBI_CRIME_2019_XLS_FILENAME, FBI_CRIME_COMBINED_CSV_FILENAME
+from file_locations import GEOCODE_CACHED_JSON_FILENAME, GEOCODE_FINAL_CSV_FILENAME
+from file_locations import MASTER_CSV_FILENAME
+from file_locations import WALKSCORE_CACHED_JSON_FILENAME, WALKSCORE_FINAL_CSV_FILENAME
+from file_locations import ZILLOW_CACHED_JSON_FILENAME, ZILLOW_FINAL_CSV_FILENAME
+from merging_code.utils import get_all_filenames_with_extension, get_code_filenames, get_dict_from_json_file
+from merging_code.utils import get_file_hash, get_logger, write_dict_to_json_file, write_final_dataframe
+
+LOGGER = get_logger('build')
+
+EXPERIAN_SOURCE_CSV_FILENAMES = sorted(
+  get_all_filenames_with_extension(EXPERIAN_SOURCE_CSV_DIR, 'csv'))
+
+# Stages are listed in dependency order: a stage only reads the outputs of the
+# stages above it.  'function' is looked up in 'module' only when the stage
+# runs, so the build doesn't import every data source up front.
+BUILD_STAGES = [{
+  'name': 'census',
+  'module': 'merging_code.normalize_census',
+  'function': 'get_final_census_dataframe',
+  'inputs': [CENSUS_AREA_2010_CSV_FILENAME],
+  'output': CENSUS_FINAL_CSV_FILENAME,
+  'index': False
+}, {
+  'name': 'fbi',
+  'module': 'merging_code.normalize_fbi',
+  'function': 'get_final_fbi_dataframe',
+  'inputs': [
+    FBI_CRIME_2015_XLS_FILENAME, FBI_CRIME_2016_XLS_FILENAME,
+    FBI_CRIME_2017_XLS_FILENAME, FBI_CRIME_2018_XLS_FILENAME,
+    FBI_CRIME_2019_XLS_FILENAME, CENSUS_FINAL_CSV_FILENAME
+  ],
+  'output': FBI_CRIME_COMBINED_CSV_FILENAME,
+  'index': True
+}, {
+  'name': 'experian',
+  'module': 'merging_code.normalize_experian',
+  'function': 'get_final_experian_dataframe',
+  'inputs': EXPERIAN_SOURCE_CSV_FILENAMES + [CENSUS_FINAL_CSV_FILENAME],
+  'output': EXPERIAN_FINAL_CSV_FILENAME,
+  'index': False
+}, {
+  'name': 'elections',
+  'module': 'merging_code.normalize_elections',
+  'function': 'get_final_elections_dataframe',
+  'inputs': [ELECTIONS_2020_FILENAME],
+  'output': ELECTIONS_FINAL_CSV_FILENAME,
+  'index': False
+}, {
+  'name': 'cdc',
+  'module': 'merging_code.normalize_cdc',
+  'function': 'get_final_cdc_dataframe',
+  'inputs': [
+    CDC_PROVISIONAL_COVID19_DEATHS_2020_FILENAME,
+    CENSUS_2019_POPULATION_FILENAME
+  ],
+  'output': CDC_FINAL_CSV_FILENAME,
+  'index': False
+}, {
+  'name': 'geocode',
+  'module': 'merging_code.scrape_geocodes',
+  'function': 'get_final_geocodes_dataframe',
+  'inputs': [
+    CENSUS_FINAL_CSV_FILENAME, FBI_CRIME_COMBINED_CSV_FILENAME,
+    GEOCODE_CACHED_JSON_FILENAME
+  ],
+  'output': GEOCODE_FINAL_CSV_FILENAME,
+  'index': False
+}, {
+  'name': 'walkscore',
+  'module': 'merging_code.scrape_walkscores',
+  'function': 'get_final_walkscores_dataframe',
+  'inputs': [
+    GEOCODE_FINAL_CSV_FILENAME, WALKSCORE_CACHED_JSON_FILENAME,
+    CENSUS_FINAL_CSV_FILENAME
+  ],
+  'output': WALKSCORE_FINAL_CSV_FILENAME,
+  'index': False
+}, {
+  'name': 'zillow',
+  'module': 'merging_code.scrape_zillow',
+  'function': 'get_final_zillow_dataframe',
+  'inputs': [
+    GEOCODE_FINAL_CSV_FILENAME, CITY_CODES_CSV_FILENAME,
+    ZILLOW_CACHED_JSON_FILENAME, CENSUS_FINAL_CSV_FILENAME
+  ],
+  'output': ZILLOW_FINAL_CSV_FILENAME,
+  'index': False
+}, {
+  'name': 'city_comparison',
+  'module': 'merging_code.get_city_comparison',
+  'function': 'get_final_city_comparison_dataframe',
+  'inputs': [
+    CENSUS_FINAL_CSV_FILENAME, WALKSCORE_FINAL_CSV_FILENAME,
+    FBI_CRIME_COMBINED_CSV_FILENAME, ZILLOW_FINAL_CSV_FILENAME,
+    CDC_FINAL_CSV_FILENAME, ELECTIONS_FINAL_CSV_FILENAME
+  ],
+  'output': MASTER_CSV_FILENAME,
+  'index': False,
+  'intermediate': False
+}]
+
+
+def get_stage_hashes(stage):
+  """ Hash the inputs and code of a stage. """
+  return {
+    'inputs': {
+      filename: get_file_hash(filename) for filename in stage['inputs']
+    },
+    'code': {
+      filename: get_file_hash(filename)
+      for filename in get_code_filenames(stage['module'])
+    }
+  }
+
+
+def is_stage_stale(stage, stage_hashes, manifest):
+  """ A stage is stale if its inputs or code changed since it was last built,
+  or if its output is missing or was changed since. """
+  recorded = manifest.get(stage['name'])
+  if recorded is None:
+    return True
+  if recorded['inputs'] != stage_hashes['inputs']:
+    return True
+  if recorded['code'] != stage_hashes['code']:
+    return True
+  return recorded['output'] != get_file_hash(stage['output'])
+
+
+def run_stage(stage):
+  """ Import the stage's function, run it, and write its output file.  Runs in
+  a worker process.  Returns the wall time of the stage, in seconds. """
+  start_time = time.time()
+  module = importlib.import_module(stage['module'])
+  function = getattr(module, stage['function'])
+  write_final_dataframe(LOGGER,
+                        function,
+                        stage['output'],
+                        index=stage['index'],
+                        intermediate=stage.get('intermediate', True))
+  return time.time() - start_time
+
+
+def is_stage_due(stage, manifest, force=False):
+  """ Return True if the stage has to be rebuilt. """
+  stage_hashes = get_stage_hashes(stage)
+  missing_inputs = [
+    filename for filename, file_hash in stage_hashes['inputs'].items()
+    if file_hash is None
+  ]
+  if missing_inputs:
+    if not os.path.isfile(stage['output']):
+      sys.exit('Missing inputs for stage {}: {}'.format(stage['name'],
+                                                        missing_inputs))
+    LOGGER.warning('Missing inputs for stage {}: {}, keeping {}'.format(
+      stage['name'], missing_inputs, stage['output']))
+    return False
+  if not force and not is_stage_stale(stage, stage_hashes, manifest):
+    LOGGER.info('Up to date: {}'.format(stage['output']))
+    return False
+  return True
+
+
+def record_stage(stage, manifest):
+  """ Record the hashes of a stage that was just rebuilt in `manifest`. """
+  # Hash the inputs after the stage ran, the scrapers write their json caches
+  # at the end of a scrape.
+  stage_hashes = get_stage_hashes(stage)
+  stage_hashes['output'] = get_file_hash(stage['output'])
+  manifest[stage['name']] = stage_hashes
+
+
+def get_stage_dependencies(stages):
+  """ Return {stage name: names of the stages whose output it reads}. """
+  output_stage_names = {stage['output']: stage['name'] for stage in stages}
+  return {
+    stage['name']: {
+      output_stage_names[filename]
+      for filename in stage['inputs']
+      if filename in output_stage_names
+    } for stage in stages
+  }
+
+
+def get_critical_path(stages, dependencies, wall_times):
+  """ Return the chain of stages with the longest total wall time, and that
+  total.  A build takes at least that long, however many workers it has. """
+  finish_times = {}
+  previous_stages = {}
+  # `stages` are in dependency order, so dependencies finish first.
+  for stage in stages:
+    name = stage['name']
+    # On a tie, the stage listed first wins.
+    previous_names = [
+      other['name'] for other in stages if other['name'] in dependencies[name]
+    ]
+    previous = max(previous_names, key=finish_times.get, default=None)
+    previous_stages[name] = previous
+    finish_times[name] = wall_times[name] + finish_times.get(previous, 0)
+  name = max(finish_times, key=finish_times.get, default=None)
+  critical_path = []
+  while name is not None:
+    critical_path.insert(0, name)
+    name = previous_stages[name]
+  return critical_path, finish_times.get(critical_path[-1], 0)
+
+
+def log_build_times(stages, dependencies, wall_times):
+  """ Log the wall time of every stage, and the critical path. """
+  for stage in stages:
+    LOGGER.info('Stage {} wall time: {:.1f} seconds'.format(
+      stage['name'], wall_times[stage['name']]))
+  if not stages:
+    return
+  critical_path, critical_time = get_critical_path(stages, dependencies,
+                                                   wall_times)
+  log_msg = 'Critical path: {}, {:.1f} seconds. All stages: {:.1f} seconds'
+  LOGGER.info(
+    log_msg.format(' -> '.join(critical_path), critical_time,
+                   sum(wall_times.values())))
+
+
+def submit_ready_stages(executor, build_state, manifest, force):
+  """ Submit every pending stage whose dependencies are done.  Stages that are
+  up to date are done right away, with a wall time of 0. """
+  submitted = True
+  while submitted:
+    submitted = False
+    done = set(build_state['wall_times'])
+    for stage in list(build_state['pending']):
+      if not build_state['dependencies'][stage['name']] <= done:
+        continue
+      build_state['pending'].remove(stage)
+      submitted = True
+      if is_stage_due(stage, manifest, force):
+        build_state['running'][executor.submit(run_stage, stage)] = stage
+      else:
+        build_state['wall_times'][stage['name']] = 0.0
+
+
+def build(stages=None,
+          stage_names=None,
+          force=False,
+          manifest_filename=BUILD_MANIFEST_JSON_FILENAME,
+          jobs=None):
+  """ Rebuild the stale stages.  Independent stages run at the same time in up
+  to `jobs` worker processes, a stage starts once the stages it reads from are
+  done.  `stage_names` limits the build to those stages.  Returns the names of
+  the stages that were rebuilt, in stage order. """
+  if stages is None:
+    stages = BUILD_STAGES
+  stages = [
+    stage for stage in stages if not stage_names or stage['name'] in stage_names
+  ]
+  manifest = get_dict_from_json_file(manifest_filename)
+  build_state = {
+    'dependencies': get_stage_dependencies(stages),
+    'pending': list(stages),
+    'running': {},
+    'wall_times': {}
+  }
+  rebuilt = set()
+  with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+    submit_ready_stages(executor, build_state, manifest, force)
+    while build_state['running']:
+      done, _ = concurrent.futures.wait(
+        build_state['running'], return_when=concurrent.futures.FIRST_COMPLETED)
+      for future in done:
+        stage = build_state['running'].pop(future)
+        build_state['wall_times'][stage['name']] = future.result()
+        record_stage(stage, manifest)
+        rebuilt.add(stage['name'])
+        # Write after every stage, so an interrupted build keeps its progress.
+        write_dict_to_json_file(manifest_filename, manifest)
+      submit_ready_stages(executor, build_state, manifest, force)
+  log_build_times(stages, build_state['dependencies'],
+                  build_state['wall_times'])
+  rebuilt = [stage['name'] for stage in stages if stage['name'] in rebuilt]
+  LOGGER.info('Rebuilt stages: {}'.format(rebuilt))
+  return rebuilt
+
+
+def main():
+  """ Parse the command line, then build. """
+  parser = argparse.ArgumentParser(description=__doc__)
+  parser.add_argument('stage_names',
+                      nargs='*',
+                      help='only build these stages, eg. fbi city_comparison')
+  parser.add_argument('--force',
+                      action='store_true',
+                      help='rebuild even if nothing changed')
+  parser.add_argument('--jobs',
+                      type=int,
+                      default=None,
+                      help='worker processes, defaults to the cpu count')
+  args = parser.parse_args()
+  build(stage_names=args.stage_names, force=args.force, jobs=args.jobs)
+
+
+if __name__ == '__main__':
+  main()
@@ -13,7 +13,7 @@ LOGGER = get_logger('county_population')
 def get_county_population_dataframe():
   """ The main function which returns the normalized CDC dataframe. """
   census_2019_dataframe = get_dataframe_from_spreadsheet(
-    LOGGER, CENSUS_2019_POPULATION_FILENAME)
+    LOGGER, CENSUS_2019_POPULATION_FILENAME, data_source='census_2019')
   census_2019_dataframe = normalize_headers_in_dataframes(
     'census_2019', [census_2019_dataframe])[0]
   # Check that the "_fips" column types are int64.
@@ -0,0 +1,137 @@
+""" Canonical city identities, so that sources can be joined on an integer id.
+
+The registry is built once from the census 2010 'geoid'.  Every census
+('state', 'city') gets a compact integer 'city_id', in 'geoid' order.  Other
+sources spell the same city differently, eg. 'st. johns' or 'st johns' versus
+'saint johns', or 'abbeville' versus 'abbeville city', so the registry also
+holds an alias for every census name, and names are resolved through the same
+aliases.
+"""
+
+import functools
+import numpy
+import pandas
+from file_locations import CENSUS_FINAL_CSV_FILENAME
+from merging_code.utils import get_dataframe_from_spreadsheet, get_logger
+
+LOGGER = get_logger('city_registry')
+
+# Abbreviations are expanded before suffixes are stripped.  'boro' is expanded
+# too, so 'middlesboro' and 'avonmore boro' match 'middlesborough' and
+# 'avonmore borough'.
+CITY_ABBREVIATIONS = {
+  r'\bst\.? ': 'saint ',
+  r'\bste\.? ': 'sainte ',
+  r'\bft\.? ': 'fort ',
+  r'\bmt\.? ': 'mount ',
+  r'boro\b': 'borough',
+}
+
+# Consolidated city-county governments and police agencies are named after
+# their city, eg. 'lexington-fayette urban county', 'louisville/jefferson county
+# metro government', 'savannah-chatham metropolitan' or 'las vegas metropolitan
+# police department'.  The county part and the government or agency type are
+# stripped.
+CITY_GOVERNMENT_REGEX = (
+  r'(-[a-z]+|/[a-z ]+|, [a-z ]+)?( county)? ((metropolitan |county )?police department|'
+  r'(unified|consolidated|metro|metropolitan) government|urban county|metropolitan|metro)$'
+)
+
+# The county of a consolidated city-county, eg. 'athens-clarke county'.  FBI
+# agencies like 'lakeview, harrison county' are *not* resolved without their
+# county, the census 'lakeview town' can be another county's.
+CITY_COUNTY_REGEX = r'-[a-z ]+ county$'
+
+# The other cities of an agency that serves several, eg. '-mecklenburg' in
+# 'charlotte-mecklenburg' or '/brooten' in 'belgrade/brooten'.
+JOINT_AGENCY_REGEX = r'[-/].*$'
+
+# Census place types.  Townships are not places in the census, and are often a
+# different municipality than the borough or village of the same name, so
+# ' township' is *not* stripped.
+CITY_SUFFIXES_REGEX = r' (city and borough|city|cdp|town|village|borough|municipality|corporation)$'
+
+
+def get_city_aliases(cities):
+  """ Take a `pandas.Series` of city names and return their aliases. eg.
+  'St. Anthony city (Stearns County)' becomes 'saint anthony'. """
+  aliases = cities.str.lower().str.replace(r'\d', '', regex=True)
+  # Drop qualifiers like ' (stearns county)'.
+  aliases = aliases.str.replace(r' \(.*\)$', '', regex=True)
+  for abbreviation, expansion in CITY_ABBREVIATIONS.items():
+    aliases = aliases.str.replace(abbreviation, expansion, regex=True)
+  aliases = aliases.str.replace(CITY_GOVERNMENT_REGEX, '', regex=True)
+  aliases = aliases.str.replace(CITY_COUNTY_REGEX, '', regex=True)
+  aliases = aliases.str.replace(CITY_SUFFIXES_REGEX, '', regex=True)
+  return aliases.str.strip()
+
+
+def get_city_registry_dataframe(census_dataframe):
+  """ Take a census 2010 dataframe with 'geoid', 'state' and 'city', and return
+  the registry: a ('state', 'city', 'city_id') dataframe with one row for every
+  census name, and one for every alias that isn't already a census name. """
+  cities = census_dataframe[['geoid', 'state', 'city']].dropna()
+  cities = cities.sort_values(by=['geoid'], kind='mergesort')
+  # Like the STATE_CITY join, the first 'geoid' wins when a state has two
+  # places with the same name.
+  cities = cities.drop_duplicates(['state', 'city'])
+  cities = cities.assign(city_id=numpy.arange(len(cities), dtype=numpy.int64))
+  aliases = cities.assign(city=get_city_aliases(cities['city']))
+  # Names with two place types, like 'beaux arts village town', get an alias
+  # for each: 'beaux arts village' and 'beaux arts'.
+  second_aliases = aliases.assign(city=get_city_aliases(aliases['city']))
+  registry = pandas.concat([cities, aliases, second_aliases], ignore_index=True)
+  # Census names come first, so they always win over an alias, and first
+  # aliases win over second ones.  Between two aliases, the lower 'geoid' wins.
+  registry = registry.drop_duplicates(['state', 'city'])
+  return registry[['state', 'city', 'city_id']].reset_index(drop=True)
+
+
+@functools.lru_cache(maxsize=None)
+def get_city_registry():
+  """ Get the registry for CENSUS_FINAL_CSV_FILENAME.  It is only read once, so
+  callers must not mutate it. """
+  census_dataframe = get_dataframe_from_spreadsheet(
+    LOGGER,
+    CENSUS_FINAL_CSV_FILENAME,
+    usecols=['geoid', 'state', 'city'],
+    encoding='ISO-8859-1')
+  registry = get_city_registry_dataframe(census_dataframe)
+  LOGGER.debug('City registry built. Total row count: {}'.format(
+    str(len(registry))))
+  return registry
+
+
+def get_city_ids(dataframe, registry):
+  """ Look up 'city_id' for the 'state' and 'city' columns of `dataframe`.
+  Returns a float `pandas.Series`, NaN where the city isn't in the registry. """
+  keys = dataframe[['state', 'city']].reset_index(drop=True)
+  city_ids = keys.merge(registry, how='left', on=['state', 'city'])['city_id']
+  return city_ids.set_axis(dataframe.index)
+
+
+def add_city_id_column(dataframe, registry=None):
+  """ Add the integer 'city_id' column to a dataframe with 'state' and 'city'
+  columns.  Rows that can't be resolved get an empty 'city_id'.
+
+  A name that is in the registry always gets its id.  Otherwise the alias of
+  the name is looked up, and then the alias of its first city when it's a
+  joint agency, eg. 'charlotte-mecklenburg' or 'belgrade/brooten'.  But an
+  alias never takes an id that another row already matched, and only the first
+  row with an alias keeps its id.  So 'manlius village' and 'manlius town'
+  don't both become the census 'manlius village'.
+  """
+  if registry is None:
+    registry = get_city_registry()
+  city_ids = get_city_ids(dataframe, registry)
+  aliases = get_city_aliases(dataframe['city'])
+  first_cities = get_city_aliases(dataframe['city'].str.replace(
+    JOINT_AGENCY_REGEX, '', regex=True))
+  for cities in (aliases, first_cities):
+    alias_ids = get_city_ids(dataframe.assign(city=cities), registry)
+    alias_ids = alias_ids.where(city_ids.isna())
+    alias_ids = alias_ids.where(~alias_ids.isin(city_ids.dropna()))
+    alias_ids = alias_ids.where(~alias_ids.duplicated())
+    city_ids = city_ids.fillna(alias_ids)
+  dataframe['city_id'] = city_ids.astype('Int64')
+  return dataframe
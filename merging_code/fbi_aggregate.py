@@ -0,0 +1,132 @@
+""" Running sums of the FBI crime numbers, per ('state', 'city').
+
+The FBI stage publishes every city's mean crime numbers over the years of FBI
+data, and its annual population change between the first and the last year.
+Instead of concatenating every year's workbook to compute those, an aggregate
+keeps the sums and counts of every column, and every year's population.  So a
+new year is folded in, or an old one retired, from that year's workbook alone.
+
+The aggregate also keeps the panel of every year's numbers, see
+merging_code/fbi_panel.py.
+
+Sums are compensated: every sum is kept with the rounding error of the
+additions that made it (Knuth's TwoSum).  So retiring a year gives the same
+rounded means as never having folded it in.
+"""
+
+import numpy
+import pandas
+from merging_code.fbi_panel import add_fbi_panel_year, drop_fbi_panel_year
+from merging_code.fbi_panel import get_empty_fbi_panel
+
+STATE_CITY = ['state', 'city']
+
+
+def get_empty_state_city_dataframe():
+  """ An empty dataframe indexed by ('state', 'city'). """
+  index = pandas.MultiIndex.from_tuples([], names=STATE_CITY)
+  return pandas.DataFrame(index=index)
+
+
+def get_empty_fbi_aggregate():
+  """ An aggregate with no years folded in.  'tables' holds the table metadata
+  of the folded years, with the sha1 of their xls file.  The populations are
+  ('state', 'city') by year, of the first and the last row of a city in a year. """
+  return {
+    'code_hash': None,
+    'tables': {},
+    'sums': get_empty_state_city_dataframe(),
+    'sum_errors': get_empty_state_city_dataframe(),
+    'counts': get_empty_state_city_dataframe(),
+    'first_populations': get_empty_state_city_dataframe(),
+    'last_populations': get_empty_state_city_dataframe(),
+    'panel': get_empty_fbi_panel()
+  }
+
+
+def get_aligned_dataframes(left, right, fill_value):
+  """ Reindex both dataframes to the union of their rows and columns. """
+  index = left.index.union(right.index)
+  columns = left.columns.union(right.columns)
+  return (left.reindex(index=index, columns=columns, fill_value=fill_value),
+          right.reindex(index=index, columns=columns, fill_value=fill_value))
+
+
+def add_compensated(sums, sum_errors, values):
+  """ Add `values` to `sums`.  The rounding error of the addition is added to
+  `sum_errors`, so `sums + sum_errors` stays exact. """
+  sums, values = get_aligned_dataframes(sums, values, 0.0)
+  sum_errors, _ = get_aligned_dataframes(sum_errors, values, 0.0)
+  new_sums = sums + values
+  values_part = new_sums - sums
+  errors = (sums - (new_sums - values_part)) + (values - values_part)
+  return new_sums, sum_errors + errors
+
+
+def fold_fbi_dataframe(aggregate, table_metadata, dataframe):
+  """ Fold one year of normalized FBI data, indexed by ('state', 'city',
+  'year'), into the aggregate. """
+  groupby = dataframe.groupby(level=STATE_CITY)
+  aggregate['sums'], aggregate['sum_errors'] = add_compensated(
+    aggregate['sums'], aggregate['sum_errors'], groupby.sum())
+  counts, year_counts = get_aligned_dataframes(aggregate['counts'],
+                                               groupby.count(), 0)
+  aggregate['counts'] = counts + year_counts
+  year = table_metadata['year']
+  for name, populations in (('first_populations', groupby.first()),
+                            ('last_populations', groupby.last())):
+    aggregate[name] = pandas.concat(
+      [aggregate[name], populations['population'].rename(year)], axis=1)
+  aggregate['panel'] = add_fbi_panel_year(aggregate['panel'], dataframe)
+  aggregate['tables'][table_metadata['document_label']] = table_metadata
+  return aggregate
+
+
+def retire_fbi_dataframe(aggregate, table_metadata, dataframe):
+  """ Take one year of normalized FBI data back out of the aggregate.
+  `dataframe` has to be the one that was folded in. """
+  groupby = dataframe.groupby(level=STATE_CITY)
+  sums, sum_errors = add_compensated(aggregate['sums'], aggregate['sum_errors'],
+                                     -groupby.sum())
+  counts, year_counts = get_aligned_dataframes(aggregate['counts'],
+                                               groupby.count(), 0)
+  counts = counts - year_counts
+  # Drop the cities that were only in the retired year.
+  index = counts.index[(counts['population'] > 0).to_numpy()]
+  aggregate['sums'] = sums.loc[index]
+  aggregate['sum_errors'] = sum_errors.loc[index]
+  aggregate['counts'] = counts.loc[index]
+  year = table_metadata['year']
+  for name in ('first_populations', 'last_populations'):
+    aggregate[name] = aggregate[name].drop(columns=[year]).reindex(index)
+  aggregate['panel'] = drop_fbi_panel_year(aggregate['panel'], year)
+  del aggregate['tables'][table_metadata['document_label']]
+  return aggregate
+
+
+def get_fbi_means(aggregate):
+  """ Return the mean of every column, by ('state', 'city').  Like
+  `pandas.DataFrame.mean`, a column that is empty every year is empty. """
+  counts = aggregate['counts']
+  sums = aggregate['sums'] + aggregate['sum_errors']
+  means = sums.div(counts.where(counts > 0))
+  return means[sorted(means.columns)].sort_index()
+
+
+def get_population_in_year(populations, last=False):
+  """ Return the ('population', 'year') dataframe of every city's first, or
+  last, year with a population. """
+  populations = populations[sorted(populations.columns, reverse=last)]
+  positions = populations.notna().to_numpy().argmax(axis=1)
+  values = populations.to_numpy()[numpy.arange(len(populations)), positions]
+  years = populations.columns.to_numpy(dtype='int64')[positions]
+  columns = {'population': values, 'year': years}
+  dataframe = pandas.DataFrame(columns, index=populations.index)
+  return dataframe.sort_index()
+
+
+def get_first_and_last_populations(aggregate):
+  """ Return the ('population', 'year') dataframes of every city's earliest and
+  latest year, indexed by ('state', 'city'). """
+  return (get_population_in_year(aggregate['first_populations']),
+          get_population_in_year(aggregate['last_populations'], last=True))
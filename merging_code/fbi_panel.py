@@ -0,0 +1,64 @@
+""" A panel of every normalized FBI year, and the per city trends it gives.
+
+The panel is a float32 dataframe indexed by ('state', 'city', 'year'), with a
+column per crime (per 100k) and 'population'.  It's kept in the FBI aggregate,
+so it's updated a year at a time like the running sums, and downstream code can
+use every city's yearly numbers without reading the xls files again.
+"""
+
+import pandas
+
+STATE_CITY = ['state', 'city']
+
+
+def get_empty_fbi_panel():
+  """ A panel without any years. """
+  index = pandas.MultiIndex.from_tuples([], names=STATE_CITY + ['year'])
+  return pandas.DataFrame(index=index, dtype='float32')
+
+
+def add_fbi_panel_year(panel, dataframe):
+  """ Add a year of normalized FBI data, indexed by ('state', 'city', 'year'),
+  to the panel. """
+  panel = pandas.concat([panel, dataframe], sort=True)
+  return panel.astype('float32').sort_index()
+
+
+def drop_fbi_panel_year(panel, year):
+  """ Take a year back out of the panel. """
+  return panel.drop(index=year, level='year')
+
+
+def get_fbi_trends(panel, columns):
+  """ Return the trend of every column, by ('state', 'city'), as two columns:
+
+  - '<column> slope': the least squares slope over the years, per year.
+  - '<column> percent change': the change from the first to the last year with
+    a value, as a fraction of the first year.
+
+  Both are empty when a city has a value for less than two years, and the
+  percent change is also empty when the first year's value is 0.
+  """
+  values = panel[columns].astype('float64')
+  has_value = values.notna()
+  # Years relative to the first year, so the sums of squares stay small.
+  years = panel.index.get_level_values('year')
+  years = (years - years.min()).to_numpy(dtype='float64')
+  year_values = has_value.mul(years, axis=0)
+  values = values.fillna(0)
+  sums = {
+    name: dataframe.groupby(level=STATE_CITY).sum()
+    for name, dataframe in (('n', has_value), ('x', year_values),
+                            ('xx', year_values * year_values), ('y', values),
+                            ('xy', year_values * values))
+  }
+  denominator = sums['n'] * sums['xx'] - sums['x'] * sums['x']
+  slopes = (sums['n'] * sums['xy'] - sums['x'] * sums['y']).div(
+    denominator.where(denominator > 0))
+  groupby = panel[columns].astype('float64').groupby(level=STATE_CITY)
+  first = groupby.first()
+  percent_changes = (groupby.last() - first).div(first.where(first > 0))
+  percent_changes = percent_changes.where(sums['n'] > 1)
+  slopes = slopes.round(1).add_suffix(' slope')
+  percent_changes = percent_changes.round(3).add_suffix(' percent change')
+  return pandas.concat([slopes, percent_changes], axis=1)
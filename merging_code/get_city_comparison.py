@@ -1,5 +1,6 @@
 """ Join Census and FBI data into one combined pandas DataFrame. """
 
+import tracemalloc
 from file_locations import CDC_FINAL_CSV_FILENAME
 from file_locations import CENSUS_FINAL_CSV_FILENAME
 from file_locations import ELECTIONS_FINAL_CSV_FILENAME
@@ -10,7 +11,7 @@ from file_locations import ZILLOW_FINAL_CSV_FILENAME
 from merging_code.headers_cleanup import HEADERS_CHANGE
 from merging_code.merge_dataframes import get_dataframe_from_merged_table_metadata
 from merging_code.merge_dataframes import JoinColumn
-from merging_code.normalize_dataframes import move_columns_to_left_of_dataframe, divide_two_columns, drop_headers
+from merging_code.normalize_dataframes import divide_two_columns, get_final_columns, get_sorted_positions
 from merging_code.utils import get_logger, write_final_dataframe
 
 LOGGER = get_logger('get_city_comparison')
@@ -18,22 +19,22 @@ LOGGER = get_logger('get_city_comparison')
 CSV_FILES_TO_MERGE = [{
   'csv_filename': CENSUS_FINAL_CSV_FILENAME,
   'document_label': 'census_2010',
-  'join_column': JoinColumn.STATE_CITY
+  'join_column': JoinColumn.CITY_ID
 }, {
   'csv_filename': WALKSCORE_FINAL_CSV_FILENAME,
   'document_label': 'walkscore',
   'suffix': '_walkscore',
-  'join_column': JoinColumn.STATE_CITY
+  'join_column': JoinColumn.CITY_ID
 }, {
   'csv_filename': FBI_CRIME_COMBINED_CSV_FILENAME,
   'document_label': 'fbi',
   'suffix': '_fbi_crime',
-  'join_column': JoinColumn.STATE_CITY
+  'join_column': JoinColumn.CITY_ID
 }, {
   'csv_filename': ZILLOW_FINAL_CSV_FILENAME,
   'document_label': 'zillow_final',
   'suffix': 'zillow',
-  'join_column': JoinColumn.STATE_CITY
+  'join_column': JoinColumn.CITY_ID
 }, {
   'csv_filename': CDC_FINAL_CSV_FILENAME,
   'document_label': 'cdc',
@@ -45,19 +46,31 @@ CSV_FILES_TO_MERGE = [{
 }]
 
 
-def get_final_city_comparison_dataframe():
-  """ The main function which returns the final dataframe. """
-  # `get_dataframe_from_merged_table_metadata` joins on `state` and `city`.
-  dataframe = get_dataframe_from_merged_table_metadata(LOGGER,
-                                                       CSV_FILES_TO_MERGE)
+def get_assembled_city_comparison_dataframe(dataframe):
+  """ Add the derived columns to the merged dataframe, then move, drop and sort
+  its columns and rows.  The merged dataframe is only copied once. """
   land_area_key = HEADERS_CHANGE['census_2010']['rename_columns'][
     'area in square miles - land area']
   dataframe = divide_two_columns(dataframe, 'population density', 'population',
                                  land_area_key)
-  dataframe = move_columns_to_left_of_dataframe(
-    dataframe, ['city', 'state', 'population density'])
-  dataframe = drop_headers('final_csv', dataframe)
-  dataframe = dataframe.sort_values(by=['state', 'city'])
+  columns = get_final_columns('final_csv', dataframe.columns,
+                              ['city', 'state', 'population density'])
+  rows = get_sorted_positions(dataframe, ['state', 'city'])
+  return dataframe.iloc[rows, dataframe.columns.get_indexer(columns)]
+
+
+def get_final_city_comparison_dataframe():
+  """ The main function which returns the final dataframe. """
+  # `get_dataframe_from_merged_table_metadata` joins on the census 'city_id'.
+  dataframe = get_dataframe_from_merged_table_metadata(LOGGER,
+                                                       CSV_FILES_TO_MERGE)
+  # Only the assembly is traced, so the peak is the assembly's alone.
+  tracemalloc.start()
+  dataframe = get_assembled_city_comparison_dataframe(dataframe)
+  _, peak_size = tracemalloc.get_traced_memory()
+  tracemalloc.stop()
+  LOGGER.info('Final assembly peak memory: {:.1f} MB, for {} rows.'.format(
+    peak_size / 2**20, str(len(dataframe))))
 
   # The CDC (Center for Disease Control) and NVSS (National Vital Statistics
   # System) index much of their data by county (especially county FIPS), so we
@@ -67,8 +80,10 @@ def get_final_city_comparison_dataframe():
 
 
 if __name__ == '__main__':
-  # Write the combined dataframe table to the final csv file.
+  # Write the combined dataframe table to the final csv file.  Nothing reads it
+  # back, so it doesn't get an intermediate file.
   write_final_dataframe(LOGGER,
                         get_final_city_comparison_dataframe,
                         MASTER_CSV_FILENAME,
-                        index=False)
+                        index=False,
+                        intermediate=False)
@@ -166,7 +166,7 @@ HEADERS_CHANGE = {
       'state_fbi_crime', 'state_fbi_crime', 'state_walkscore',
       'state_walkscore', 'stateexperian_2017', 'statezillow', 'target geo id2',
       'longitude_x', 'longitude_y', 'latitude_x', 'latitude_y',
-      'reverse_address_x', 'reverse_address_y'
+      'reverse_address_x', 'reverse_address_y', 'city_id'
     ]
   }
 }
@@ -1,19 +1,29 @@
 """Use fuzzy matching to join DataFrames on 'state' and 'city'."""
 
+import bisect
 from enum import Enum
+import hashlib
+import os
+import sys
+import numpy
 import pandas
+from merging_code.city_registry import add_city_id_column
 from merging_code.normalize_dataframes import drop_headers, rename_headers
+from merging_code.utils import read_intermediate_dataframe
 
+FUZZY_MATCH_CACHE_COLUMNS = [
+  'left_source', 'right_source', 'state', 'city', 'right_city',
+  'right_cities_hash'
+]
 
-def get_all_states_from_index(state_city_index):
-  """ Given index of ('state', 'city'), return set of 'states' in index. """
-  return set(
-    state_city_index.get_level_values('state').unique().values.tolist())
 
-
-def get_all_cities_from_state(state_city_index, state):
-  """ Returns an array of cities from state. """
-  return state_city_index.to_frame().loc[state, :].index.values.tolist()
+def get_cities_by_state(state_city_index):
+  """ Given index of ('state', 'city'), return a dict of 'state' to the list of
+  its cities, in index order. """
+  cities_by_state = {}
+  for state, city in state_city_index:
+    cities_by_state.setdefault(state, []).append(city)
+  return cities_by_state
 
 
 def prefix_match(name, list_names):
@@ -24,15 +34,67 @@ def prefix_match(name, list_names):
   return None
 
 
-def get_row_with_key(dataframe, key):
-  """ Get a row of DataFrame as type DataFrame with index 0. """
-  # In order to have pandas return a dataframe all the time, pass a *list* of
-  # `key`, instead of key directly.
-  row = dataframe.loc[[key]]
+class PrefixIndex:
+  """ Answer `prefix_match(name, list_names)` for a fixed `list_names` without
+  scanning the list.
+
+  Names that `name` starts with are found with one dict lookup per prefix of
+  `name`.  Names that start with `name` are a contiguous range of the sorted
+  names, found with bisect.  A sparse table of minimum list positions over the
+  sorted names keeps the tie-breaking of `prefix_match`: the match that comes
+  first in `list_names` wins.
+  """
+
+  def __init__(self, list_names):
+    self.list_names = list_names
+    self.first_positions = {}
+    for position, name in enumerate(list_names):
+      self.first_positions.setdefault(name, position)
+    self.sorted_names = sorted(self.first_positions)
+    # `self.min_positions[level][i]` is the smallest list position among
+    # `self.sorted_names[i:i + 2**level]`.
+    self.min_positions = [[
+      self.first_positions[name] for name in self.sorted_names
+    ]]
+    span = 1
+    while span * 2 <= len(self.sorted_names):
+      previous = self.min_positions[-1]
+      self.min_positions.append([
+        min(previous[i], previous[i + span])
+        for i in range(len(previous) - span)
+      ])
+      span *= 2
+
+  def get_min_position_in_range(self, start, end):
+    """ Smallest list position among `self.sorted_names[start:end]`. """
+    level = (end - start).bit_length() - 1
+    row = self.min_positions[level]
+    return min(row[start], row[end - (1 << level)])
+
+  def match(self, name):
+    """ Same result as `prefix_match(name, self.list_names)`. """
+    positions = [
+      self.first_positions[name[:length]]
+      for length in range(len(name) + 1)
+      if name[:length] in self.first_positions
+    ]
+    start = bisect.bisect_left(self.sorted_names, name)
+    end = bisect.bisect_right(self.sorted_names, name + chr(sys.maxunicode))
+    if start < end:
+      positions.append(self.get_min_position_in_range(start, end))
+    if not positions:
+      return None
+    return self.list_names[min(positions)]
+
+
+def get_rows_with_keys(dataframe, keys):
+  """ Get the rows of DataFrame for a list of keys, as type DataFrame with a
+  fresh 0..n index. """
+  rows = dataframe.loc[keys]
   # Drop index containing 'state' and 'city'.
   # We'll add those fields back after joining.
-  row = row.reset_index(drop=True)
-  return row
+  rows = rows.reset_index(drop=True)
+  return rows
 
 
 def set_index_as_state_and_city(dataframe):
@@ -45,8 +107,117 @@ def set_index_as_state_and_city(dataframe):
   return dataframe
 
 
-def join_on_state_and_city(logger, left_df, right_df):
-  """ Join two dataframes on 'state' and 'city' columns. """
+def get_cities_hash(cities):
+  """ Fingerprint a list of city names, to tell when a cached match is stale. """
+  return hashlib.sha1('\n'.join(cities).encode('utf-8')).hexdigest()
+
+
+def read_fuzzy_match_cache(filename):
+  """ Read the resolved fuzzy match aliases, or an empty table if missing. """
+  if os.path.isfile(filename):
+    # An empty 'right_city' records that the city had no match.
+    return pandas.read_csv(filename, dtype=str, keep_default_na=False)
+  return pandas.DataFrame(columns=FUZZY_MATCH_CACHE_COLUMNS)
+
+
+def write_fuzzy_match_cache(filename, fuzzy_match_cache):
+  """ Write the resolved fuzzy match aliases back to their csv file. """
+  aliases = fuzzy_match_cache['aliases'].sort_values(
+    by=['left_source', 'right_source', 'state', 'city'])
+  aliases.to_csv(filename, index=False)
+
+
+def get_cached_aliases(fuzzy_match_cache):
+  """ Return {(state, city): (right_city, right_cities_hash)} for the sources
+  being joined, or {} when there is no cache. """
+  if fuzzy_match_cache is None:
+    return {}
+  aliases = fuzzy_match_cache['aliases']
+  aliases = aliases[
+    (aliases['left_source'] == fuzzy_match_cache['left_source']) &
+    (aliases['right_source'] == fuzzy_match_cache['right_source'])]
+  rows = zip(aliases['state'], aliases['city'], aliases['right_city'],
+             aliases['right_cities_hash'])
+  return {(state, city): (right_city, right_cities_hash)
+          for state, city, right_city, right_cities_hash in rows}
+
+
+def update_fuzzy_match_cache(fuzzy_match_cache, mapping):
+  """ Replace the cached aliases for the sources being joined with `mapping`. """
+  aliases = fuzzy_match_cache['aliases']
+  is_stale = ((aliases['left_source'] == fuzzy_match_cache['left_source']) &
+              (aliases['right_source'] == fuzzy_match_cache['right_source']))
+  mapping = mapping.assign(left_source=fuzzy_match_cache['left_source'],
+                           right_source=fuzzy_match_cache['right_source'])
+  fuzzy_match_cache['aliases'] = pandas.concat(
+    [aliases[~is_stale], mapping[FUZZY_MATCH_CACHE_COLUMNS]], ignore_index=True)
+
+
+def match_cities_in_state(left_cities, right_cities, cached_aliases, state):
+  """ Yield (city, right_city, right_cities_hash) for every left city, reusing
+  a cached alias when the right cities of `state` have not changed. """
+  right_cities_hash = get_cities_hash(right_cities)
+  right_cities_index = None
+  for city in left_cities:
+    right_city, cached_hash = cached_aliases.get((state, city), (None, None))
+    if cached_hash != right_cities_hash:
+      # Index the right cities once per state to match against.
+      if right_cities_index is None:
+        right_cities_index = PrefixIndex(right_cities)
+      right_city = right_cities_index.match(city) or ''
+    yield (city, right_city, right_cities_hash)
+
+
+def get_fuzzy_state_city_mapping(logger,
+                                 left_missing_keys,
+                                 right_missing_keys,
+                                 cached_aliases=None):
+  """ Build a ('state', 'city', 'right_city', 'right_cities_hash') table
+  mapping every unmatched left key to the right city it prefix matches, or ''
+  when nothing matches.  The `state` *must* match. """
+  left_cities_by_state = get_cities_by_state(left_missing_keys)
+  right_cities_by_state = get_cities_by_state(right_missing_keys)
+  # List of states that are in both left and right sides.
+  states = set(left_cities_by_state) & set(right_cities_by_state)
+  mapping = []
+  # Iterate by state.
+  for state in sorted(states):
+    logger.debug('state: {}'.format(state))
+    matches = match_cities_in_state(left_cities_by_state[state],
+                                    right_cities_by_state[state],
+                                    cached_aliases or {}, state)
+    for city, right_city, right_cities_hash in matches:
+      mapping.append((state, city, right_city, right_cities_hash))
+  return pandas.DataFrame(
+    mapping, columns=['state', 'city', 'right_city', 'right_cities_hash'])
+
+
+def join_with_fuzzy_mapping(left_df, right_df, mapping):
+  """ Inner join the rows of `mapping` against both dataframes in one merge. """
+  # Gets data for every (state, city) and (state, right_city); returns row
+  # DataFrames without the 'state' and 'city' fields, aligned by position.
+  left_rows = get_rows_with_keys(left_df,
+                                 list(zip(mapping['state'], mapping['city'])))
+  right_rows = get_rows_with_keys(
+    right_df, list(zip(mapping['state'], mapping['right_city'])))
+  merge_rows = left_rows.merge(right_rows,
+                               how='inner',
+                               left_index=True,
+                               right_index=True)
+  # Add `state` and `city`.
+  merge_rows.insert(0, 'state', mapping['state'].values)
+  merge_rows.insert(1, 'city', mapping['city'].values)
+  return merge_rows
+
+
+def join_on_state_and_city(logger, left_df, right_df, fuzzy_match_cache=None):
+  """ Join two dataframes on 'state' and 'city' columns.
+
+  `fuzzy_match_cache` is an optional dict with the 'aliases' DataFrame from
+  `read_fuzzy_match_cache`, and the 'left_source' and 'right_source' labels of
+  the two dataframes.  Cached aliases are reused, and 'aliases' is updated with
+  the aliases resolved by this join.
+  """
   left_df = set_index_as_state_and_city(left_df)
   right_df = set_index_as_state_and_city(right_df)
   # First, join exact.
@@ -60,34 +231,22 @@ def join_on_state_and_city(logger, left_df, right_df):
   right_missing_keys = right_df.index.difference(common_df.index)
 
   # Now perform "fuzzy matching" inner join between the left and right keys that
-  # don't already have a match.  The `state` *must* match.
-  # List of states that are in both left and right sides.
-  states = get_all_states_from_index(
-    left_missing_keys) & get_all_states_from_index(right_missing_keys)
+  # don't already have a match.  Resolve every match up front, then join them
+  # all at once, rather than merging and appending one row at a time.
+  mapping = get_fuzzy_state_city_mapping(logger, left_missing_keys,
+                                         right_missing_keys,
+                                         get_cached_aliases(fuzzy_match_cache))
+  if fuzzy_match_cache is not None:
+    update_fuzzy_match_cache(fuzzy_match_cache, mapping)
+  mapping = mapping[mapping['right_city'] != '']
   # Reset index to make it easier to append new rows.
   common_df = common_df.reset_index()
-  # Iterate by state.
-  for state in sorted(states):
-    logger.debug('state: {}'.format(state))
-    # Create list of cities in dataframes to match against.
-    left_cities = get_all_cities_from_state(left_missing_keys, state)
-    right_cities = get_all_cities_from_state(right_missing_keys, state)
-    for city in left_cities:
-      max_city = prefix_match(city, right_cities)
-      if max_city is not None:
-        # Gets data for (state, city); returns a row DataFrame
-        # without the 'state' and 'city' fields.
-        left_row = get_row_with_key(left_df, (state, city))
-        right_row = get_row_with_key(right_df, (state, max_city))
-        merge_rows = left_row.merge(right_row,
-                                    how='inner',
-                                    left_index=True,
-                                    right_index=True)
-        # Add `state` and `city`.
-        merge_rows.insert(0, 'state', [state])
-        merge_rows.insert(1, 'city', [city])
-        assert 'index' not in common_df.columns.values
-        common_df = common_df.append(merge_rows, ignore_index=True, sort=True)
+  if not mapping.empty:
+    merge_rows = join_with_fuzzy_mapping(left_df, right_df, mapping)
+    assert 'index' not in common_df.columns.values
+    common_df = pandas.concat([common_df, merge_rows],
+                              ignore_index=True,
+                              sort=True)
 
   assert 'index' not in common_df.columns.values
   return common_df
@@ -103,21 +262,37 @@ def join_on_county(left_df, right_df, how='left'):
   return common_df
 
 
+def join_on_city_id(left_df, right_df):
+  """ Inner merge on the integer 'city_id' column.  The 'state' and 'city' of
+  the left dataframe are kept, the right ones are just another spelling. """
+  right_df = right_df.drop(columns=['state', 'city'])
+  common_df = left_df.merge(right_df, how='inner', on='city_id')
+  return common_df
+
+
 class JoinColumn(Enum):
   """ Handle different types of joins when merging different sources of data. """
   STATE_CITY = 1
   COUNTY_FIPS = 2
+  CITY_ID = 3
 
   @classmethod
-  def join_with_combined_table(cls, logger, left_df, right_df,
-                               right_table_metadata):
+  def join_with_combined_table(cls,
+                               logger,
+                               left_df,
+                               right_df,
+                               right_table_metadata,
+                               fuzzy_match_cache=None):
     """Join dataframes based on 'join_column' in table_metadata. """
     join_column = right_table_metadata['join_column']
     assert join_column in cls
     if join_column == cls.STATE_CITY:
-      result = join_on_state_and_city(logger, left_df, right_df)
+      result = join_on_state_and_city(logger, left_df, right_df,
+                                      fuzzy_match_cache)
     if join_column == cls.COUNTY_FIPS:
       result = join_on_county(left_df, right_df)
+    if join_column == cls.CITY_ID:
+      result = join_on_city_id(left_df, right_df)
     return result
 
   @classmethod
@@ -128,69 +303,112 @@ class JoinColumn(Enum):
       keys = ['state', 'city']
     if join_column == JoinColumn.COUNTY_FIPS:
       keys = ['county_fips']
+    if join_column == JoinColumn.CITY_ID:
+      keys = ['city_id']
     return keys
 
 
 # remove everything below this line, or rewrite it.
 
 
-def get_dataframe_from_merged_table_metadata(logger, tables_metadata):
-  """ Take table metadata, and return a merged panda datatable. """
+def get_dataframe_from_merged_table_metadata(logger,
+                                             tables_metadata,
+                                             fuzzy_match_cache_filename=None):
+  """ Take table metadata, and return a merged panda datatable.
+
+  When `fuzzy_match_cache_filename` is set, the fuzzy 'state' and 'city'
+  matches are read from and saved to that csv file, so that a rebuild only
+  fuzzy matches cities that are new, or whose state changed.
+  """
+  fuzzy_match_cache = None
+  if fuzzy_match_cache_filename is not None:
+    fuzzy_match_cache = {
+      'aliases': read_fuzzy_match_cache(fuzzy_match_cache_filename)
+    }
   combined_table = None
+  combined_labels = []
   for table_metadata in tables_metadata:
     if combined_table is None:
       combined_table = get_normalized_data_table(logger, table_metadata)
+      combined_labels.append(table_metadata['document_label'])
       continue
     next_data_table = get_normalized_data_table(logger, table_metadata)
+    if fuzzy_match_cache is not None:
+      fuzzy_match_cache['left_source'] = '+'.join(combined_labels)
+      fuzzy_match_cache['right_source'] = table_metadata['document_label']
     # combined_table = join_on_state_and_city(logger, combined_table,
     #                                         next_data_table)
     combined_table = JoinColumn.join_with_combined_table(
-      logger, combined_table, next_data_table, table_metadata)
+      logger, combined_table, next_data_table, table_metadata,
+      fuzzy_match_cache)
+    combined_labels.append(table_metadata['document_label'])
     logger.info('Dataframe length: {}'.format(str(len(combined_table))))
+  if fuzzy_match_cache is not None:
+    write_fuzzy_match_cache(fuzzy_match_cache_filename, fuzzy_match_cache)
   drop_headers('final_csv', combined_table)
   rename_headers('final_csv', combined_table)
   return combined_table
 
 
-def get_combined_dataframe(logger,
-                           dataframes,
-                           how='outer',
-                           merge_on='city',
-                           optional_merge_on='county'):
-  """ Combined all the CSV files, then return the combined dataframe. """
-  combined_dataframe = None
-  for dataframe in dataframes:
-    if combined_dataframe is None:
-      combined_dataframe = dataframe
-      continue
-    merge_on = ['city', 'state', 'credit score']
-    for optional_merge in optional_merge_on:
-      if optional_merge in dataframe:
-        # We can only perform an outer merge if both the
-        # `combined_dataframe` and `dataframe` have the same columns
-        # we want to merge on.
-        assert optional_merge in combined_dataframe
-        merge_on.append(optional_merge)
-    combined_dataframe = combined_dataframe.merge(dataframe,
-                                                  on=merge_on,
-                                                  how=how)
-    log_msg = 'Row quantity for combined_dataframe: {}'.format(
-      str(len(combined_dataframe)))
-    logger.debug(log_msg)
+def get_combined_dataframe(logger, dataframes, merge_on, optional_merge_on):
+  """ Combine the dataframes with one concat, and keep one row for every
+  `merge_on` and `optional_merge_on` key, with the first value of every other
+  column.  An empty value is a key of its own.
+
+  Like a merge on `merge_on` alone, a dataframe without every
+  `optional_merge_on` column only adds the rows whose `merge_on` key the other
+  dataframes don't have.  Those get empty `optional_merge_on` columns.
+  """
+  dataframes = list(dataframes)
+  combined_dataframe = pandas.concat(dataframes, ignore_index=True)
+  columns = combined_dataframe.columns
+  is_partial = [
+    not set(optional_merge_on).issubset(dataframe.columns)
+    for dataframe in dataframes
+  ]
+  is_partial_row = numpy.repeat(is_partial,
+                                [len(dataframe) for dataframe in dataframes])
+  keys = pandas.MultiIndex.from_frame(combined_dataframe[merge_on])
+  is_merged_row = is_partial_row & keys.isin(keys[~is_partial_row])
+  combined_dataframe = combined_dataframe[~is_merged_row]
+  combined_dataframe = combined_dataframe.groupby(merge_on + optional_merge_on,
+                                                  sort=False,
+                                                  dropna=False).first()
+  combined_dataframe = combined_dataframe.reset_index()[columns]
+  log_msg = 'Row quantity for combined_dataframe: {}'.format(
+    str(len(combined_dataframe)))
+  logger.debug(log_msg)
   return combined_dataframe
 
 
+def get_data_table_with_city_ids(data_table):
+  """ Make sure the data table has an int64 'city_id' column, and drop the rows
+  whose city isn't in the registry.  Csv files written before their normalizer
+  emitted 'city_id' get it resolved here. """
+  if 'city_id' not in data_table:
+    data_table = add_city_id_column(data_table)
+  data_table = data_table.dropna(subset=['city_id'])
+  return data_table.astype({'city_id': 'int64'})
+
+
 def get_normalized_data_table(logger, table_metadata):
   """ Input a dict with csv filename, suffix if available, the document label,
   and return a data_table. """
-  data_table = pandas.read_csv(table_metadata['csv_filename'],
-                               header=table_metadata.get('header', 0),
-                               encoding='ISO-8859-1')
-  drop_headers(table_metadata['document_label'], data_table)
+  csv_filename = table_metadata['csv_filename']
+  header = table_metadata.get('header', 0)
+  data_table = read_intermediate_dataframe(
+    logger,
+    csv_filename,
+    data_source=table_metadata['document_label'],
+    header=header,
+    encoding='ISO-8859-1')
   rename_headers(table_metadata['document_label'], data_table)
   log_msg = 'Normalized document_label: {} Dataframe length: {}'.format(
     table_metadata['document_label'], str(len(data_table)))
   logger.info(log_msg)
-  # Deduplicate by the table key: ('state', 'city') or 'county_fips'.
+  if table_metadata['join_column'] == JoinColumn.CITY_ID:
+    data_table = get_data_table_with_city_ids(data_table)
+  # Deduplicate by the table key: ('state', 'city'), 'county_fips' or
+  # 'city_id'.
   data_table = data_table.drop_duplicates(JoinColumn.keys(table_metadata))
   return data_table
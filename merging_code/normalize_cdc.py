@@ -15,7 +15,7 @@ LOGGER = get_logger('normalize_cdc')
 def get_final_cdc_dataframe():
   """ The main function which returns the normalized CDC dataframe. """
   cdc_2020_dataframe = get_dataframe_from_spreadsheet(
-    LOGGER, CDC_PROVISIONAL_COVID19_DEATHS_2020_FILENAME)
+    LOGGER, CDC_PROVISIONAL_COVID19_DEATHS_2020_FILENAME, data_source='cdc')
   cdc_2020_dataframe = normalize_headers_in_dataframes('cdc',
                                                        [cdc_2020_dataframe])[0]
 
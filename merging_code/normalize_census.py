@@ -1,39 +1,48 @@
 #!/usr/bin/env python3
 """ Normalize the census 2010 geography csv. """
-import pandas
-
 from file_locations import CENSUS_AREA_2010_CSV_FILENAME, CENSUS_FINAL_CSV_FILENAME
-from merging_code.utils import get_dataframe_from_spreadsheet, remove_substring_from_end_of_string
+from merging_code.city_registry import add_city_id_column, get_city_registry_dataframe
+from merging_code.utils import get_dataframe_from_spreadsheet
 from merging_code.utils import get_logger, write_final_dataframe
 from merging_code.normalize_dataframes import normalize_headers_in_dataframes
 
 LOGGER = get_logger('normalize_census')
 
 
-def parse_city_state_from_row(row):
-  """ Take a row, add the city/state cells to the row if available. """
-  city, state = ['NULL', 'NULL']
-  if row['Geographic area'].count(' - ') == 2:
-    state, city = row['Geographic area'].lower().split(' - ')[-2:]
-    city = remove_substring_from_end_of_string(city, [' city', ' cdp'])
-  return pandas.Series([city, state])
-
-
 def add_city_state_to_dataframe(dataframe):
-  """ Clean up the census 2010 csv. """
-  dataframe[['city', 'state']] = dataframe.apply(parse_city_state_from_row,
-                                                 axis=1)
+  """ Clean up the census 2010 csv.  'Geographic area' is like 'United States -
+  Alabama - Abbeville city', rows without a city are dropped. """
+  areas = dataframe['Geographic area']
+  has_city = areas.str.count(' - ') == 2
+  parts = areas.str.lower().str.split(' - ')
+  city = parts.str[-1]
+  # Like `remove_substring_from_end_of_string`, ' city' then ' cdp'.
+  for suffix in [' city', ' cdp']:
+    city = city.str.replace(r'{}\Z'.format(suffix), '', regex=True)
+  dataframe['city'] = city.where(has_city, 'NULL')
+  dataframe['state'] = parts.str[-2].where(has_city, 'NULL')
   dataframe = dataframe[dataframe.state != "NULL"]
   return dataframe
 
 
 def get_final_census_dataframe():
   """ The main function which returns the final dataframe. """
+  # 'Geographic area' is dropped, but only after the city and state are parsed
+  # from it.
   census_2010_dataframe = get_dataframe_from_spreadsheet(
-    LOGGER, CENSUS_AREA_2010_CSV_FILENAME, header=1, encoding='ISO-8859-1')
+    LOGGER,
+    CENSUS_AREA_2010_CSV_FILENAME,
+    data_source='census_2010',
+    keep_columns=['Geographic area'],
+    header=1,
+    encoding='ISO-8859-1')
   census_2010_dataframe = add_city_state_to_dataframe(census_2010_dataframe)
   census_2010_dataframe = normalize_headers_in_dataframes(
     'census_2010', [census_2010_dataframe])[0]
+  # The census is where the city registry comes from, so build it from this
+  # dataframe rather than from the csv we're about to write.
+  census_2010_dataframe = add_city_id_column(
+    census_2010_dataframe, get_city_registry_dataframe(census_2010_dataframe))
   LOGGER.info('Census 2010 normalized. Total row count: {}'.format(
     str(len(census_2010_dataframe))))
   return census_2010_dataframe
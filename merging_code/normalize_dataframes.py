@@ -1,7 +1,7 @@
 """ All code related to normalizing and cleaning up dataframes. """
-import pandas
+import functools
+import numpy
 from merging_code.headers_cleanup import HEADERS_CHANGE
-from merging_code.utils import remove_integers_from_string
 
 
 def drop_empty_rows_from_dataframes(dataframes, col_names):
@@ -24,14 +24,17 @@ def divide_two_columns(dataframe,
                        numerator_col,
                        divisor_col,
                        round_param=None):
-  """ Divide two columns in a series. optional round_param amount. """
+  """ Divide two columns in a series. optional round_param amount.  Like
+  `round(cell_value, None)`, the column is rounded to integers when there's no
+  round_param. """
   divided_column = dataframe[numerator_col] / dataframe[divisor_col]
   if round_param is None:
-    rounded_divided_column = divided_column.apply(
-      lambda cell_value: round(cell_value, None))
+    rounded_divided_column = divided_column.round().astype('int64')
   else:
-    rounded_divided_column = divided_column.apply(
-      lambda cell_value: round(cell_value, round_param))
+    # `round` rounds the exact decimal value, which numpy doesn't.
+    rounded_divided_column = numpy.frompyfunc(round, 2,
+                                              1)(divided_column,
+                                                 round_param).astype('float64')
   dataframe[new_col_name] = rounded_divided_column
   return dataframe
 
@@ -55,20 +58,61 @@ def rename_headers(data_source, dataframe):
   return dataframe.rename(columns=HEADERS_CHANGE[data_source]['rename_columns'])
 
 
-def lower_case_headers_in_dataframes(dataframe):
-  """ Lower case all the strings in all the headers of the dataframes. """
-  for column in dataframe.columns:
-    dataframe = dataframe.rename(columns={column: column.lower()})
-  return dataframe
+@functools.lru_cache(maxsize=None)
+def get_header_plan(data_source):
+  """ Compile the HEADERS_CHANGE of a data source, once, into a
+  (rename_columns, drop_columns) plan.  The renames apply to headers that
+  already have their new lines removed and are lower cased. """
+  headers_change = HEADERS_CHANGE.get(data_source, {})
+  return (headers_change.get('rename_columns', {}),
+          frozenset(headers_change.get('drop_columns', ())))
+
+
+def get_normalized_header(data_source, column):
+  """ Return the new name of a header, or None if it's dropped.  New lines are
+  removed _before_ renames. """
+  rename_columns, drop_columns = get_header_plan(data_source)
+  header = column.replace('\n', ' ').lower()
+  header = rename_columns.get(header, header)
+  if header in drop_columns:
+    return None
+  return header
+
+
+def get_normalized_headers(data_source, columns):
+  """ Take the headers of a dataframe, and return the positions of the headers
+  to keep and their new names. """
+  positions = []
+  headers = []
+  for position, column in enumerate(columns):
+    header = get_normalized_header(data_source, column)
+    if header is not None:
+      positions.append(position)
+      headers.append(header)
+  return positions, headers
+
+
+def get_header_projection(data_source, keep_columns=()):
+  """ Return a `usecols` callable for the readers, which is true for the
+  headers the data source keeps, and for `keep_columns`.  So the dropped
+  columns are never parsed. """
+  keep_columns = frozenset(keep_columns)
+
+  def is_kept_column(column):
+    """ Headers that aren't strings are kept, they're never renamed. """
+    if column in keep_columns or not isinstance(column, str):
+      return True
+    return get_normalized_header(data_source, column) is not None
+
+  return is_kept_column
 
 
 def normalize_headers_in_dataframe(data_source, dataframe):
   """ meta function, take a single dataframe, and run the various normalizing functions on it. """
-  # note, removing new lines happens _before_ renames.
-  new_dataframe = remove_new_lines_from_headers_dataframes(dataframe)
-  new_dataframe = lower_case_headers_in_dataframes(new_dataframe)
-  new_dataframe = rename_headers(data_source, new_dataframe)
-  new_dataframe = drop_headers(data_source, new_dataframe)
+  positions, headers = get_normalized_headers(data_source, dataframe.columns)
+  # One copy of the frame, whatever the number of renamed or dropped headers.
+  new_dataframe = dataframe.take(positions, axis=1)
+  new_dataframe.columns = headers
   new_dataframe = remove_integers_from_dataframe_by_columns(
     new_dataframe, ['city', 'state', 'county'])
   return new_dataframe
@@ -83,40 +127,51 @@ def normalize_headers_in_dataframes(data_source, dataframes):
   return new_dataframes
 
 
-def remove_integers_from_dataframe_by_columns(dataframe, column_names):
-  """ Remove integers from 'city' and 'state' column values.  Also make everything lowercase. """
+def get_digits_table(column):
+  """ A `str.translate` table that deletes every character of the strings in
+  `column` that `str.isdigit` is true for. """
+  characters = set(''.join(
+    value for value in column.to_numpy() if isinstance(value, str)))
+  return {
+    ord(character): None for character in characters if character.isdigit()
+  }
 
-  def remove_integers_from_row(row, column_name):
-    """ remove integers from a row for city/state. """
-    return pandas.Series([remove_integers_from_string(row[column_name])])
 
+def remove_integers_from_dataframe_by_columns(dataframe, column_names):
+  """ Remove integers from 'city' and 'state' column values.  Also make everything lowercase.
+  Like `remove_integers_from_string`, cells that aren't strings are kept. """
   for column_name in column_names:
-    if column_name not in dataframe:
+    if column_name not in dataframe or dataframe[column_name].dtype != object:
       continue
-    dataframe[column_name] = dataframe.apply(remove_integers_from_row,
-                                             column_name=column_name,
-                                             axis=1)
+    column = dataframe[column_name]
+    new_column = column.str.translate(get_digits_table(column)).str.lower()
+    dataframe[column_name] = new_column.where(new_column.notna(), column)
   return dataframe
 
 
-def remove_new_lines_from_headers_dataframes(dataframe):
-  """ Remove all the new lines from headers in the dataframes. """
-  for column in dataframe.columns:
-    dataframe = dataframe.rename(columns={column: column.replace('\n', ' ')})
-  return dataframe
-
-
-def move_columns_to_left_of_dataframe(dataframe, new_columns_order):
+def move_columns_to_left(columns, new_columns_order):
   """ Helper method to take certain columns and move them to the beginning. """
-  old_columns_order = list(dataframe)
-  col_index = 0
-  for column in new_columns_order:
-    # move the column to head of list using index, pop and insert
-    old_columns_order.insert(
-      col_index, old_columns_order.pop(old_columns_order.index(column)))
-    col_index += 1
-    dataframe = dataframe.loc[:, old_columns_order]
-  return dataframe
+  moved_columns = set(new_columns_order)
+  return list(new_columns_order) + [
+    column for column in columns if column not in moved_columns
+  ]
+
+
+def get_final_columns(data_source, columns, new_columns_order):
+  """ Return the columns, with `new_columns_order` moved to the beginning, and
+  without the drop_columns of HEADERS_CHANGE. """
+  _, drop_columns = get_header_plan(data_source)
+  return [
+    column for column in move_columns_to_left(columns, new_columns_order)
+    if column not in drop_columns
+  ]
+
+
+def get_sorted_positions(dataframe, column_names):
+  """ The positions of the rows of `dataframe`, in the order
+  `dataframe.sort_values(by=column_names)` gives them. """
+  keys = dataframe[column_names].reset_index(drop=True)
+  return keys.sort_values(by=column_names).index.to_numpy()
 
 
 def lower_case_dataframes_columns(dataframes, columns):
@@ -22,7 +22,6 @@ character, not numeric.
 
 """
 
-import pandas
 from file_locations import ELECTIONS_2020_FILENAME, ELECTIONS_FINAL_CSV_FILENAME
 from merging_code.utils import get_dataframe_from_spreadsheet
 from merging_code.utils import get_logger, write_final_dataframe
@@ -30,70 +29,64 @@ from merging_code.normalize_dataframes import normalize_headers_in_dataframes
 
 LOGGER = get_logger('normalize_elections')
 
+# The parties we keep, and the columns of their share of the county vote.
+PARTY_COLUMNS = {
+  'DEM': 'county_dem_percent',
+  'REP': 'county_rep_percent',
+  'LIB': 'county_lib_percent'
+}
+
+
+def is_president_county_race(dataframe):
+  """ Filter for only "President" races on the county level.  County FIPS
+  contains 5 digits. """
+  is_president = dataframe['race'] == 'President'
+  is_county = dataframe['id'].str.len() == 5
+  return is_president & is_county
+
+
+def get_party_percents_dataframe(elections_dataframe):
+  """ Take the county rows of a race, and return the 'county_fips' and the
+  PARTY_COLUMNS of every county. """
+  # Every party's share of the total county vote.
+  county_total_votes = elections_dataframe.groupby(
+    'county_fips')['votes'].transform('sum')
+  elections_dataframe = elections_dataframe.assign(
+    county_vote_percent=elections_dataframe['votes'] / county_total_votes)
+
+  # Collapse the REP, DEM, LIB rows into one row for each county.  A county
+  # without one of the parties gets 0 for it, and if a party has two rows in a
+  # county, the first one is kept.
+  elections_dataframe = elections_dataframe[elections_dataframe['party'].isin(
+    PARTY_COLUMNS)]
+  elections_dataframe = elections_dataframe.drop_duplicates(
+    ['county_fips', 'party'])
+  party_percents = elections_dataframe.set_index(
+    ['county_fips', 'party'])['county_vote_percent'].unstack(fill_value=0)
+  party_percents = party_percents.reindex(columns=list(PARTY_COLUMNS),
+                                          fill_value=0)
+  party_percents = party_percents.rename(columns=PARTY_COLUMNS)
+  party_percents.columns.name = None
+  return party_percents.reset_index()
+
 
 def get_final_elections_dataframe():
   """ The main function which returns the normalized elections dataframe. """
   # We need 'id' and 'fips5', which are FIPS character strings, to be read as
-  # strings instead of integers.
+  # strings instead of integers.  Only the county "President" rows are kept, as
+  # the csv is read.
   elections_2020_dataframe = get_dataframe_from_spreadsheet(
-    LOGGER, ELECTIONS_2020_FILENAME, dtype={
+    LOGGER,
+    ELECTIONS_2020_FILENAME,
+    data_source='elections_2020',
+    row_filter=is_president_county_race,
+    dtype={
       'id': object,
       'fips5': object
     })
   elections_2020_dataframe = normalize_headers_in_dataframes(
     'elections_2020', [elections_2020_dataframe])[0]
-  # Filter for only "President" races on the county level.  County FIPS contains 5 digits.
-  is_president = elections_2020_dataframe['race'] == 'President'
-  is_county = elections_2020_dataframe['id'].str.len() == 5
-  is_president_county_race = is_president & is_county
-  elections_2020_dataframe = elections_2020_dataframe[is_president_county_race]
-
-  sum_votes = elections_2020_dataframe.groupby('county_fips')['votes'].sum()
-  county_total_votes = pandas.DataFrame({'county_total_votes': sum_votes})
-  elections_2020_dataframe = elections_2020_dataframe.merge(county_total_votes,
-                                                            how='left',
-                                                            on='county_fips')
-
-  # Filter for only REP, DEM, LIB parties.
-  elections_2020_dataframe = elections_2020_dataframe[
-    (elections_2020_dataframe['party'] == 'DEM') |
-    (elections_2020_dataframe['party'] == 'REP') |
-    (elections_2020_dataframe['party'] == 'LIB')]
-
-  # Calculate the percentage each of REP, DEM, LIB received in the total county vote.
-  elections_2020_dataframe['county_vote_percent'] = elections_2020_dataframe[
-    'votes'] / elections_2020_dataframe['county_total_votes']
-
-  # Collapse the 3 REP, DEM, LIB rows into one row for each county.
-  elections_combined_party_rows_dataframe = elections_2020_dataframe.groupby(
-    'county_fips')[[
-      'party', 'county_vote_percent'
-    ]].apply(lambda x: list(zip(x.party, x.county_vote_percent))).reset_index()
-
-  def party_votes(target_party):
-
-    def helper(tuple_list):
-      for elt in tuple_list:
-        party, percent = elt
-        if party == target_party:
-          return percent
-      return 0
-
-    return helper
-
-  elections_combined_party_rows_dataframe[
-    'county_dem_percent'] = elections_combined_party_rows_dataframe[0].apply(
-      party_votes('DEM'))
-  elections_combined_party_rows_dataframe[
-    'county_rep_percent'] = elections_combined_party_rows_dataframe[0].apply(
-      party_votes('REP'))
-  elections_combined_party_rows_dataframe[
-    'county_lib_percent'] = elections_combined_party_rows_dataframe[0].apply(
-      party_votes('LIB'))
-  elections_combined_party_rows_dataframe = elections_combined_party_rows_dataframe.drop(
-    columns=[0])
-
-  return elections_combined_party_rows_dataframe
+  return get_party_percents_dataframe(elections_2020_dataframe)
 
 
 if __name__ == '__main__':
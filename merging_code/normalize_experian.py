@@ -1,7 +1,10 @@
 #!/usr/bin/env python3
 """ Merge all the csv files from experian city credit scores into one combined csv. """
 
+import concurrent.futures
+import os
 from file_locations import EXPERIAN_FINAL_CSV_FILENAME, EXPERIAN_SOURCE_CSV_DIR
+from merging_code.city_registry import add_city_id_column
 from merging_code.normalize_dataframes import drop_empty_rows_from_dataframes, normalize_headers_in_dataframes
 from merging_code.normalize_dataframes import lower_case_dataframes_columns
 from merging_code.utils import get_dataframe_from_spreadsheet, get_all_filenames_with_extension
@@ -11,15 +14,25 @@ from merging_code.merge_dataframes import get_combined_dataframe
 LOGGER = get_logger('normalize_experian')
 
 
-def get_dict_of_all_experian_dataframes(csv_files):
-  """ Turn a list of csv filenames into a list of panda dataframe objects. """
-  dataframes = {}
-  for csv_file in csv_files:
-    dataframe = get_dataframe_from_spreadsheet(LOGGER,
-                                               csv_file,
-                                               sheet_type='csv')
-    dataframes[csv_file] = dataframe
-  return dataframes
+def get_experian_dataframe(csv_file):
+  """ Read one experian csv file. """
+  return get_dataframe_from_spreadsheet(LOGGER,
+                                        csv_file,
+                                        sheet_type='csv',
+                                        data_source='experian')
+
+
+def get_dict_of_all_experian_dataframes(csv_files, jobs=None):
+  """ Turn a list of csv filenames into a list of panda dataframe objects.  The
+  files are read at the same time, by up to `jobs` threads. """
+  if jobs is None:
+    jobs = min(len(csv_files), os.cpu_count() or 1)
+  if jobs > 1:
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+      dataframes = list(executor.map(get_experian_dataframe, csv_files))
+  else:
+    dataframes = [get_experian_dataframe(csv_file) for csv_file in csv_files]
+  return dict(zip(csv_files, dataframes))
 
 
 def get_state_name_from_filename(file_name):
@@ -68,9 +81,9 @@ def get_final_experian_dataframe():
   final_combined_dataframe = get_combined_dataframe(
     LOGGER,
     dataframes,
-    how='outer',
     merge_on=['city', 'state', 'credit score'],
     optional_merge_on=['county'])
+  final_combined_dataframe = add_city_id_column(final_combined_dataframe)
   return final_combined_dataframe
 
 
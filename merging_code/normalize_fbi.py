@@ -1,12 +1,22 @@
 """ Join Census and FBI data into one combined pandas DataFrame. """
 
-import datetime
+import concurrent.futures
+import hashlib
 import math
+import os
+import numpy
 import pandas
 from file_locations import FBI_CRIME_2018_XLS_FILENAME, FBI_CRIME_2015_XLS_FILENAME
 from file_locations import FBI_CRIME_2016_XLS_FILENAME, FBI_CRIME_2017_XLS_FILENAME
 from file_locations import FBI_CRIME_2019_XLS_FILENAME, FBI_CRIME_COMBINED_CSV_FILENAME
-from merging_code.utils import get_dataframe_from_spreadsheet, get_logger, write_final_dataframe
+from file_locations import FBI_AGGREGATE_FILENAME, FBI_XLS_CACHE_DIR
+from merging_code.city_registry import add_city_id_column
+from merging_code.fbi_aggregate import fold_fbi_dataframe, get_empty_fbi_aggregate
+from merging_code.fbi_aggregate import get_fbi_means, get_first_and_last_populations
+from merging_code.fbi_aggregate import retire_fbi_dataframe
+from merging_code.fbi_panel import get_fbi_trends
+from merging_code.utils import get_cached_dataframe_from_spreadsheet, get_code_filenames, get_file_hash
+from merging_code.utils import get_logger, write_final_dataframe, write_pickle_file
 from merging_code.normalize_dataframes import drop_empty_rows_from_dataframes, lower_case_columns
 from merging_code.normalize_dataframes import normalize_headers_in_dataframe
 
@@ -38,22 +48,6 @@ def get_fbi_table_metadata():
   }]
 
 
-def normalize_row_by_pop100k(row, numeric_columns):
-  """ Normalize a row of FBI crime data by 100k for the year population. """
-  # Divide by 100k.
-  population = row['population']
-  # For every numeric column (excluding 'city' and 'state', which are string
-  # columns), normalize to crime per 100k population.
-  new_columns = {}
-  for column in numeric_columns:
-    assert isinstance(row[column], (int, float))
-    if population > 0:
-      new_columns[column] = row[column] / population * 1e5
-    else:
-      new_columns[column] = None
-  return pandas.Series(new_columns)
-
-
 def normalize_dataframe_by_pop100k(dataframe):
   """ Normalize a dataframe of FBI crime data by 100k for the year population. """
   # Normalize all numeric columns by population.
@@ -63,63 +57,30 @@ def normalize_dataframe_by_pop100k(dataframe):
   numeric_columns = [
     col for col in numeric_columns if col not in ('population', 'year')
   ]
-
-  dataframe[numeric_columns] = dataframe.apply(normalize_row_by_pop100k,
-                                               numeric_columns=numeric_columns,
-                                               axis=1)
+  population = dataframe['population']
+  per_100k = dataframe[numeric_columns].div(population, axis=0) * 1e5
+  # Rows without a population get empty crime numbers.
+  dataframe[numeric_columns] = per_100k.where(population > 0, axis=0)
   return dataframe
 
 
 def add_state_to_missing_state_col_cells(dataframe):
   """ FBI xls files are messed up, this adds the state where missing on the state column. """
   # Propagate 'state' column.
-  state = None
-  for index, row in dataframe.iterrows():
-    if pandas.notnull(row['state']):
-      state = row['state'].lower()
-      dataframe.at[index, 'state'] = state
-    dataframe.at[index, 'state'] = state
-
+  dataframe['state'] = dataframe['state'].str.lower().ffill()
   return dataframe
 
 
-def get_earliest_and_latest_fbi_dataframe(dataframe):
-  """Take the data from the latest year it was defined."""
-  dataframe = dataframe.reset_index()
-  dataframe = dataframe.set_index(['state', 'city'])
-
-  # Transform the integer 'year' column to type `datetime`.  'datetime' column
-  # will allow us to use `pandas.DataFrame.first` and `pandas.DataFrame.last`.
-  def convert_row_year_str_to_datetime_object(row):
-    return datetime.datetime(int(row['year']), 12, 31)
-
-  dataframe['datetime'] = dataframe.apply(
-    convert_row_year_str_to_datetime_object, axis=1)
-  groupby = dataframe.groupby(['state', 'city'])
-  first = groupby.first()
-  last = groupby.last()
-  # Drop the 'datetime' column to clean up.
-  first = first.drop(['datetime'], axis=1)
-  last = last.drop(['datetime'], axis=1)
-  return (first, last)
-
-
 def get_annualized_percent_change_per_year(diff, years):
   """Calculate annualized percent change."""
   return math.exp(math.log(diff) / years) - 1
 
 
-def get_series_with_annual_percent_change_for_columns(row, numeric_columns):
-  """ Show the annual change for a list of columns in a row. """
-  years = row['year']
-  new_columns = {}
-  for column in numeric_columns:
-    diff = row[column]
-    if years > 0 and diff != 0:
-      new_columns[column] = get_annualized_percent_change_per_year(diff, years)
-    else:
-      new_columns[column] = 0
-  return pandas.Series(new_columns)
+# `get_annualized_percent_change_per_year` over whole arrays.  It still uses
+# `math`: `numpy.log` and `numpy.exp` can round the last bit differently, which
+# would change the published numbers.
+get_annualized_percent_changes = numpy.frompyfunc(
+  get_annualized_percent_change_per_year, 2, 1)
 
 
 def add_annual_percent_change_for_numeric_fields(dataframe):
@@ -130,10 +91,15 @@ def add_annual_percent_change_for_numeric_fields(dataframe):
   numeric_columns = [
     col for col in numeric_columns if not col.startswith('year')
   ]
-  dataframe[numeric_columns] = dataframe.apply(
-    get_series_with_annual_percent_change_for_columns,
-    numeric_columns=numeric_columns,
-    axis=1)
+  years = dataframe['year']
+  for column in numeric_columns:
+    diff = dataframe[column]
+    has_change = (years > 0) & (diff != 0)
+    percent_changes = pandas.Series(0.0, index=dataframe.index)
+    percent_changes[has_change] = get_annualized_percent_changes(
+      diff[has_change].to_numpy(),
+      years[has_change].to_numpy()).astype('float64')
+    dataframe[column] = percent_changes
   return dataframe
 
 
@@ -169,47 +135,148 @@ def get_dataframe_with_annual_pop_percent_chg(first, last):
   return population_percent_change
 
 
-def get_concatenated_fbi_dataframe_from_xls_files(fbi_table_metadata):
-  """ Take the FBI Table 8 xls files, normalize them, then return a list of them all. """
-  normalized_fbi_dataframes = []
-  for table_metadata in fbi_table_metadata:
-    document_label = table_metadata['document_label']
-    dataframe = get_dataframe_from_spreadsheet(LOGGER,
-                                               table_metadata['xls_filename'],
-                                               header=3,
-                                               sheet_type='xls')
-    dataframe = normalize_headers_in_dataframe(document_label, dataframe)
-    dataframe = add_state_to_missing_state_col_cells(dataframe)
-    dataframe = normalize_dataframe_by_pop100k(dataframe)
-    dataframe = lower_case_columns(dataframe, ['city', 'state'])
-    dataframe['year'] = table_metadata['year']
-    dataframe = dataframe.set_index(['state', 'city', 'year'])
-    normalized_fbi_dataframes.append(dataframe)
+def get_normalized_fbi_dataframe(table_metadata,
+                                 cache_directory=FBI_XLS_CACHE_DIR):
+  """ Take one year's FBI Table 8 xls file, normalize it, and return it indexed
+  by ('state', 'city', 'year').  The parsed xls file is cached in
+  `cache_directory`. """
+  document_label = table_metadata['document_label']
+  dataframe = get_cached_dataframe_from_spreadsheet(
+    LOGGER,
+    table_metadata['xls_filename'],
+    cache_directory,
+    header=3,
+    sheet_type='xls')
+  dataframe = normalize_headers_in_dataframe(document_label, dataframe)
+  dataframe = add_state_to_missing_state_col_cells(dataframe)
+  dataframe = normalize_dataframe_by_pop100k(dataframe)
+  dataframe = lower_case_columns(dataframe, ['city', 'state'])
+  dataframe['year'] = table_metadata['year']
+  return dataframe.set_index(['state', 'city', 'year'])
+
+
+def get_normalized_fbi_dataframes(fbi_table_metadata,
+                                  jobs=None,
+                                  cache_directory=FBI_XLS_CACHE_DIR):
+  """ Take the FBI Table 8 xls files, normalize them, then return a list of them all.
+
+  Every year is normalized on its own, so the years run at the same time in up
+  to `jobs` worker processes.  The list is in `fbi_table_metadata` order, so
+  it's the same for any `jobs`.
+  """
+  if jobs is None:
+    jobs = min(len(fbi_table_metadata), os.cpu_count() or 1)
+  if jobs > 1:
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+      normalized_fbi_dataframes = list(
+        executor.map(get_normalized_fbi_dataframe, fbi_table_metadata,
+                     [cache_directory] * len(fbi_table_metadata)))
+  else:
+    normalized_fbi_dataframes = [
+      get_normalized_fbi_dataframe(table_metadata, cache_directory)
+      for table_metadata in fbi_table_metadata
+    ]
   # There are some rows in the FBI xls spreadsheet that are notes, and not
   # actually data from cities.  Drop these rows by only keeping rows that have
   # population field defined.
-  normalized_fbi_dataframes = drop_empty_rows_from_dataframes(
-    normalized_fbi_dataframes, ['population'])
-  return pandas.concat(normalized_fbi_dataframes, sort=True)
-
-
-def average_and_round_combined_fbi_dataframe(concatenated_fbi_dataframe):
-  """ Average and round all the the crime numbers for the concatenated fbi dataframe. """
-  combined_mean = concatenated_fbi_dataframe.mean(level=[0, 1])
-  combined_mean_rounded = combined_mean.round(1)
-  return combined_mean_rounded
-
-
-def get_final_fbi_dataframe():
+  return drop_empty_rows_from_dataframes(normalized_fbi_dataframes,
+                                         ['population'])
+
+
+def get_fbi_code_hash():
+  """ The sha1 of the code that normalizes a year.  An aggregate made by other
+  code has to be rebuilt. """
+  code_filenames = get_code_filenames('merging_code.normalize_fbi')
+  code_hashes = [get_file_hash(filename) for filename in code_filenames]
+  return hashlib.sha1('\n'.join(code_hashes).encode('utf-8')).hexdigest()
+
+
+def can_retire_fbi_tables(aggregate, retired_tables, code_hash):
+  """ A retired year's numbers are taken out by normalizing its xls file again.
+  So that file, and the code, must be the same as when it was folded in. """
+  if aggregate['code_hash'] != code_hash:
+    return False
+  return all(
+    get_file_hash(table['xls_filename']) == table['xls_hash']
+    for table in retired_tables)
+
+
+def retire_and_fold_fbi_tables(aggregate, retired_tables, new_tables, jobs,
+                               cache_directory):
+  """ Normalize the years to retire and to fold in, at the same time, then
+  retire and fold them into `aggregate`. """
+  LOGGER.info('FBI years retired: {} folded in: {}'.format(
+    [table['document_label'] for table in retired_tables],
+    [table['document_label'] for table in new_tables]))
+  normalized_fbi_dataframes = get_normalized_fbi_dataframes(
+    retired_tables + new_tables, jobs, cache_directory)
+  for table, dataframe in zip(retired_tables + new_tables,
+                              normalized_fbi_dataframes):
+    if table in retired_tables:
+      aggregate = retire_fbi_dataframe(aggregate, table, dataframe)
+    else:
+      aggregate = fold_fbi_dataframe(aggregate, table, dataframe)
+  return aggregate
+
+
+def get_updated_fbi_aggregate(aggregate,
+                              fbi_table_metadata,
+                              jobs=None,
+                              cache_directory=FBI_XLS_CACHE_DIR):
+  """ Retire the years of `aggregate` that aren't in `fbi_table_metadata`
+  anymore, and fold in the ones that are new.  Only those years' xls files are
+  read.  If a retired year can't be taken out, every year is folded into a new
+  aggregate instead. """
+  tables = [
+    dict(table_metadata, xls_hash=get_file_hash(table_metadata['xls_filename']))
+    for table_metadata in fbi_table_metadata
+  ]
+  folded_tables = list(aggregate['tables'].values())
+  retired_tables = [table for table in folded_tables if table not in tables]
+  code_hash = get_fbi_code_hash()
+  if not can_retire_fbi_tables(aggregate, retired_tables, code_hash):
+    LOGGER.info('Folding every FBI year into a new aggregate')
+    aggregate = get_empty_fbi_aggregate()
+    aggregate['code_hash'] = code_hash
+    folded_tables = retired_tables = []
+  new_tables = [table for table in tables if table not in folded_tables]
+  return retire_and_fold_fbi_tables(aggregate, retired_tables, new_tables, jobs,
+                                    cache_directory)
+
+
+def get_fbi_aggregate(aggregate_filename=FBI_AGGREGATE_FILENAME,
+                      cache_directory=FBI_XLS_CACHE_DIR):
+  """ Read the aggregate in `aggregate_filename`, and update it to the years of
+  `get_fbi_table_metadata`.  Only the xls files of the years that were added or
+  removed since it was written are read.  Like the xls cache, the file is only
+  written when it was missing or out of date. """
+  aggregate = get_empty_fbi_aggregate()
+  if os.path.isfile(aggregate_filename):
+    aggregate = pandas.read_pickle(aggregate_filename)
+  folded = (aggregate['code_hash'], list(aggregate['tables'].values()))
+  aggregate = get_updated_fbi_aggregate(aggregate,
+                                        get_fbi_table_metadata(),
+                                        cache_directory=cache_directory)
+  if (aggregate['code_hash'], list(aggregate['tables'].values())) != folded:
+    write_pickle_file(aggregate_filename, aggregate)
+  return aggregate
+
+
+def get_fbi_panel(aggregate_filename=FBI_AGGREGATE_FILENAME,
+                  cache_directory=FBI_XLS_CACHE_DIR):
+  """ Return every city's normalized FBI numbers of every year, as a float32
+  dataframe indexed by ('state', 'city', 'year'). """
+  return get_fbi_aggregate(aggregate_filename, cache_directory)['panel']
+
+
+def get_final_fbi_dataframe(aggregate_filename=FBI_AGGREGATE_FILENAME,
+                            cache_directory=FBI_XLS_CACHE_DIR):
   """ The main function which returns the final dataframe with all merged/meaned fbi xls files. """
-  fbi_table_metadata = get_fbi_table_metadata()
-  combined_fbi_dataframe = get_concatenated_fbi_dataframe_from_xls_files(
-    fbi_table_metadata)
-  combined_mean_rounded = average_and_round_combined_fbi_dataframe(
-    combined_fbi_dataframe)
+  aggregate = get_fbi_aggregate(aggregate_filename, cache_directory)
+  combined_mean_rounded = get_fbi_means(aggregate).round(1)
   # Compute annualized percent change in population, based on the
   # first and last years we have data.
-  first, last = get_earliest_and_latest_fbi_dataframe(combined_fbi_dataframe)
+  first, last = get_first_and_last_populations(aggregate)
   population_percent_change = get_dataframe_with_annual_pop_percent_chg(
     first, last)
 
@@ -231,6 +298,12 @@ def get_final_fbi_dataframe():
 
   # Drop the mean population, it won't be used.
   result = result.drop(['population_mean'], axis=1)
+  # Add the ' slope' and ' percent change' of every crime column.
+  crime_columns = combined_mean_rounded.columns.drop('population').to_list()
+  trends = get_fbi_trends(aggregate['panel'], crime_columns)
+  result = result.merge(trends, how='left', left_index=True, right_index=True)
+  # Add the census 'city_id' for the ('state', 'city') index.
+  result = add_city_id_column(result.reset_index()).set_index(['state', 'city'])
   result = result.sort_values(by=['city', 'state'])
   LOGGER.info('FBI Crime dataframe normalized. Total row count: {}'.format(
     str(len(result))))
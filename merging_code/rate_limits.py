@@ -0,0 +1,135 @@
+""" Rate limits for the APIs the scrapers call from several threads. """
+
+import collections
+import threading
+import time
+import requests
+
+# HTTP statuses that mean the API wants us to slow down, or is overloaded.
+BACK_OFF_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+class RateLimiter:  # pylint: disable=too-many-instance-attributes
+  """ A token bucket, shared by the threads calling one API endpoint.
+
+  Tokens come back at `rate` per second, and up to `burst` of them are kept,
+  so after a quiet spell `burst` calls can go at once.  Every call takes a
+  token, and waits for one if there's none left.
+
+  When the API pushes back, `back_off` pauses every caller and halves the
+  rate.  Every call that goes through afterwards (`recover`) wins back a
+  tenth of the configured rate, up to the configured rate.
+  """
+
+  def __init__(self, rate, burst=1, clock=time.monotonic, sleep=time.sleep):
+    self.max_rate = rate
+    self.rate = rate
+    self.burst = burst
+    self.clock = clock
+    self.sleep = sleep
+    self.tokens = burst
+    self.updated = clock()
+    self.paused_until = self.updated
+    self.lock = threading.Lock()
+
+  def get_wait(self):
+    """ Take a token and return 0, or return how long to wait for one. """
+    with self.lock:
+      now = self.clock()
+      if now < self.paused_until:
+        return self.paused_until - now
+      self.tokens = min(self.burst,
+                        self.tokens + (now - self.updated) * self.rate)
+      self.updated = now
+      # A sleep of (1 - tokens) / rate can come up a rounding error short.
+      if self.tokens >= 1 - 1e-9:
+        self.tokens = max(self.tokens - 1, 0)
+        return 0
+      return (1 - self.tokens) / self.rate
+
+  def acquire(self):
+    """ Wait until a call is allowed. """
+    wait = self.get_wait()
+    while wait > 0:
+      self.sleep(wait)
+      wait = self.get_wait()
+
+  def back_off(self, delay):
+    """ Pause every caller for `delay` seconds, and halve the rate. """
+    with self.lock:
+      now = self.clock()
+      self.paused_until = max(self.paused_until, now + delay)
+      self.rate = max(self.rate / 2, self.max_rate / 64)
+      self.tokens = 0
+      self.updated = max(self.updated, self.paused_until)
+
+  def recover(self):
+    """ A call went through, so go back up towards the configured rate. """
+    with self.lock:
+      self.rate = min(self.max_rate, self.rate + self.max_rate / 10)
+
+
+class SlidingWindowRateLimiter:
+  """ At most `calls` calls in any `period` seconds, shared by the threads
+  calling one API.  Unlike `RateLimiter`, the whole quota can go at once, so a
+  refresh takes about as long as the quota allows, and no longer. """
+
+  def __init__(self, calls, period, clock=time.monotonic, sleep=time.sleep):
+    self.calls = calls
+    self.period = period
+    self.clock = clock
+    self.sleep = sleep
+    self.call_times = collections.deque()
+    self.lock = threading.Lock()
+
+  def get_wait(self):
+    """ Take a call and return 0, or return how long to wait for one. """
+    with self.lock:
+      now = self.clock()
+      # A sleep until the oldest call leaves the window can come up a rounding
+      # error short.
+      while self.call_times and self.call_times[0] + self.period <= now + 1e-9:
+        self.call_times.popleft()
+      if len(self.call_times) < self.calls:
+        self.call_times.append(now)
+        return 0
+      return self.call_times[0] + self.period - now
+
+  def acquire(self):
+    """ Wait until a call is allowed. """
+    wait = self.get_wait()
+    while wait > 0:
+      self.sleep(wait)
+      wait = self.get_wait()
+
+
+def get_back_off_delay(response, attempt):
+  """ The Retry-After of the response, in seconds, or 2**attempt seconds. """
+  retry_after = response.headers.get('Retry-After', '')
+  if retry_after.isdigit():
+    return int(retry_after)
+  return 2**attempt
+
+
+def get_with_backoff(rate_limiter, url, retries=5, get=requests.get, **kwargs):
+  """ `requests.get` the url within the rate limiter.  When the response is
+  a 429 or a 5xx, back off and try again, up to `retries` times, then return
+  the last response. """
+  for attempt in range(retries + 1):
+    rate_limiter.acquire()
+    response = get(url, **kwargs)
+    if response.status_code not in BACK_OFF_STATUS_CODES:
+      rate_limiter.recover()
+      return response
+    if attempt < retries:
+      rate_limiter.back_off(get_back_off_delay(response, attempt))
+  return response
+
+
+def get_rate_limiters(rate_limits):
+  """ Take a dict of endpoint to (rate, burst), and return a dict of endpoint to
+  its `RateLimiter`. """
+  return {
+    endpoint: RateLimiter(rate, burst)
+    for endpoint, (rate, burst) in rate_limits.items()
+  }
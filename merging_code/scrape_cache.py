@@ -0,0 +1,173 @@
+""" The api responses of the scrapers, in one key-value cache.
+
+Every scraper keeps its responses in its own namespace of the SQLite database
+SCRAPE_CACHE_FILENAME, as json text by key.  A response is upserted as soon as
+it's scraped, so a checkpoint no longer rewrites the whole cache, and a crash
+can only lose the responses that weren't committed yet.  The database is in WAL
+mode: readers don't block the writer, and writers from several threads or
+processes wait for each other, up to BUSY_TIMEOUT seconds.
+
+The database is local and gitignored, the scrapers' json cache files are the
+copies in git, and the build's inputs.  So the two are kept in sync, see
+`get_scrape_cache`: a namespace is opened with the entries of its json file that
+it doesn't have yet, and after a scrape, the whole namespace is written back to
+the json file, if anything was added or changed.
+
+A checkout that scraped with the database before the json files were written
+back only has those responses in the database.  Nothing has to be done about
+them: the first time the namespace is opened, it has more keys than its json
+file, so the next scrape writes them back to it.
+"""
+
+import contextlib
+import json
+import sqlite3
+import threading
+from file_locations import SCRAPE_CACHE_FILENAME
+from merging_code.utils import get_dict_from_json_file, get_file_hash, write_dict_to_json_file
+
+BUSY_TIMEOUT = 30
+# SQLite limits the variables of a statement, so keys are looked up in chunks.
+KEY_CHUNK_SIZE = 500
+
+
+class ScrapeCache:
+  """ The responses of one scraper, in its namespace of the database.  Every
+  thread gets its own connection.  Keys keep the order they were first added
+  in, like a dict's.  `json_filename` is the json cache file it's kept in
+  sync with, if any. """
+
+  def __init__(self,
+               namespace,
+               filename=SCRAPE_CACHE_FILENAME,
+               json_filename=None):
+    self.namespace = namespace
+    self.filename = filename
+    self.json_filename = json_filename
+    # True once the namespace has entries its json file doesn't have.
+    self.is_ahead_of_json_file = False
+    self.local = threading.local()
+    connection = self.get_connection()
+    connection.execute(
+      'CREATE TABLE IF NOT EXISTS scrape_cache (namespace TEXT NOT NULL, '
+      'key TEXT NOT NULL, value TEXT NOT NULL, PRIMARY KEY (namespace, key))')
+    # The sha1 of every namespace's json file, when it was last read or written.
+    connection.execute(
+      'CREATE TABLE IF NOT EXISTS json_files (namespace TEXT PRIMARY KEY, '
+      'json_hash TEXT NOT NULL)')
+
+  def get_connection(self):
+    """ The connection of the current thread, in autocommit mode, so every
+    transaction is explicit. """
+    connection = getattr(self.local, 'connection', None)
+    if connection is None:
+      connection = sqlite3.connect(self.filename,
+                                   timeout=BUSY_TIMEOUT,
+                                   isolation_level=None)
+      connection.execute('PRAGMA journal_mode=WAL')
+      connection.execute('PRAGMA synchronous=NORMAL')
+      self.local.connection = connection
+    return connection
+
+  @contextlib.contextmanager
+  def get_transaction(self):
+    """ A write transaction on the connection of the current thread.  It's
+    committed at the end of the with block, or rolled back on an exception. """
+    connection = self.get_connection()
+    connection.execute('BEGIN IMMEDIATE')
+    try:
+      yield connection
+    except BaseException:
+      connection.execute('ROLLBACK')
+      raise
+    connection.execute('COMMIT')
+
+  def get_all(self):
+    """ Return the dict of every key of the namespace to its value. """
+    rows = self.get_connection().execute(
+      'SELECT key, value FROM scrape_cache WHERE namespace = ? ORDER BY rowid',
+      (self.namespace,))
+    return {key: json.loads(value) for key, value in rows}
+
+  def get_many(self, keys):
+    """ Return the dict of the cached `keys` to their values, in the order
+    they were added.  Missing keys are left out. """
+    keys = list(dict.fromkeys(keys))
+    found = []
+    for start in range(0, len(keys), KEY_CHUNK_SIZE):
+      chunk = keys[start:start + KEY_CHUNK_SIZE]
+      found += self.get_connection().execute(
+        'SELECT rowid, key, value FROM scrape_cache WHERE namespace = ? '
+        'AND key IN ({})'.format(', '.join('?' * len(chunk))),
+        [self.namespace] + chunk).fetchall()
+    return {key: json.loads(value) for _, key, value in sorted(found)}
+
+  def set_many(self, values):
+    """ Upsert the dict of keys to values, in a single transaction. """
+    if not values:
+      return
+    with self.get_transaction() as connection:
+      connection.executemany(
+        'INSERT INTO scrape_cache (namespace, key, value) VALUES (?, ?, ?) '
+        'ON CONFLICT (namespace, key) DO UPDATE SET value = excluded.value',
+        [(self.namespace, key, json.dumps(value))
+         for key, value in values.items()])
+    self.is_ahead_of_json_file = True
+
+  def set(self, key, value):
+    """ Upsert a single key. """
+    self.set_many({key: value})
+
+  def set_json_hash(self, connection, json_hash):
+    """ Record the sha1 of the json file, as of now. """
+    connection.execute(
+      'INSERT INTO json_files (namespace, json_hash) VALUES (?, ?) '
+      'ON CONFLICT (namespace) DO UPDATE SET json_hash = excluded.json_hash',
+      (self.namespace, json_hash))
+
+  def fill_from_json_file(self):
+    """ Add the entries of the json file that the namespace doesn't have yet,
+    the namespace's values win.  The file is only read when it changed since
+    it was last read or written, eg. after a git pull. """
+    if self.json_filename is None:
+      return
+    json_hash = get_file_hash(self.json_filename)
+    if json_hash is None:
+      return
+    with self.get_transaction() as connection:
+      recorded = connection.execute(
+        'SELECT json_hash FROM json_files WHERE namespace = ?',
+        (self.namespace,)).fetchone()
+      if recorded is not None and recorded[0] == json_hash:
+        return
+      cached_json = get_dict_from_json_file(self.json_filename)
+      connection.executemany(
+        'INSERT INTO scrape_cache (namespace, key, value) VALUES (?, ?, ?) '
+        'ON CONFLICT (namespace, key) DO NOTHING',
+        [(self.namespace, key, json.dumps(value))
+         for key, value in cached_json.items()])
+      count = connection.execute(
+        'SELECT COUNT(*) FROM scrape_cache WHERE namespace = ?',
+        (self.namespace,)).fetchone()[0]
+      self.set_json_hash(connection, json_hash)
+    if count > len(cached_json):
+      self.is_ahead_of_json_file = True
+
+  def write_json_file(self):
+    """ Write the whole namespace to the json file, if it has entries the file
+    doesn't have.  The scrapers call this at the end of a scrape, so the json
+    files in git, and the build's hashes of them, are up to date. """
+    if self.json_filename is None or not self.is_ahead_of_json_file:
+      return
+    with self.get_transaction() as connection:
+      write_dict_to_json_file(self.json_filename, self.get_all())
+      self.set_json_hash(connection, get_file_hash(self.json_filename))
+    self.is_ahead_of_json_file = False
+
+
+def get_scrape_cache(namespace, json_filename, filename=SCRAPE_CACHE_FILENAME):
+  """ Open the namespace of a scraper, with the entries of its json cache file
+  that it doesn't have yet. """
+  scrape_cache = ScrapeCache(namespace, filename, json_filename)
+  scrape_cache.fill_from_json_file()
+  return scrape_cache
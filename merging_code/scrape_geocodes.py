@@ -5,29 +5,44 @@ then the city and state to do goog geocode lookups. We get
 the latitude, longitude, and reverse address. These values
 are typically in the middle of the city. Then we save those
 values to csv in the end. The API calls also use a cache
-which is stored in the json file. You can rerun this without
+which is stored in the scrape cache database, see
+merging_code/scrape_cache.py. You can rerun this without
 hammering the API. Note, you need the GEOCODE_API_KEY
 in secrets.py
 """
 
 # pypi imports
+import concurrent.futures
 import ssl
 import sys
 import certifi
 import geopy
 import requests
 
+from merging_code.city_registry import add_city_id_column
 from merging_code.merge_dataframes import get_dataframe_from_merged_table_metadata
 from merging_code.merge_dataframes import JoinColumn
 from merging_code.normalize_dataframes import add_empty_columns
+from merging_code.rate_limits import get_rate_limiters
+from merging_code.scrape_cache import get_scrape_cache
 from merging_code.secrets import GEOCODE_API_KEY
-from merging_code.utils import get_dict_from_json_file, write_dict_to_json_file
 from merging_code.utils import get_logger, write_final_dataframe, is_github_actions
 from file_locations import CENSUS_FINAL_CSV_FILENAME, FBI_CRIME_COMBINED_CSV_FILENAME
 from file_locations import GEOCODE_CACHED_JSON_FILENAME, GEOCODE_FINAL_CSV_FILENAME
+from file_locations import FUZZY_MATCH_CACHE_CSV_FILENAME
 
 LOGGER = get_logger('scrape_geocodes')
 
+GEO_COLUMNS = [
+  'latitude', 'longitude', 'reverse_address', 'county_fips', 'block_fips',
+  'county_name'
+]
+
+# Cities looked up at the same time, and the (calls per second, burst) of every
+# endpoint, shared by all of them.
+GEOCODE_JOBS = 8
+GEOCODE_RATE_LIMITS = {'geocode': (10, 10), 'reverse': (10, 10), 'fcc': (5, 5)}
+
 CSV_FILES_TO_MERGE = [{
   'csv_filename': CENSUS_FINAL_CSV_FILENAME,
   'document_label': 'census_2010',
@@ -56,18 +71,16 @@ def get_geopy_googlev3_locator(geocode_api_key):
   return geolocator
 
 
-def cache_geo_metadata(cached_json, location, reverse_address, search_query,
-                       county_fips, block_fips, county_name):
-  """ Set single city geo metadata values into the main cache dict, and return the dict. """
-  cached_json[search_query] = {
+def get_geo_metadata_dict(location, reverse_address, fips):
+  """ The cached geo metadata values of a single city. """
+  return {
     'latitude': location.latitude,
     'longitude': location.longitude,
     'reverse_address': reverse_address,
-    'county_fips': county_fips,
-    'block_fips': block_fips,
-    'county_name': county_name
+    'county_fips': fips['county'],
+    'block_fips': fips['block'],
+    'county_name': fips['county_name']
   }
-  return cached_json
 
 
 def get_reverse_address(geolocator, location):
@@ -78,18 +91,6 @@ def get_reverse_address(geolocator, location):
   return reverse.address
 
 
-def add_geo_metadata_to_row(row, location, reverse_address, county_fips,
-                            block_fips, county_name):
-  """ Overwrite empty cell values in a dataframe, to add geo metadata """
-  row['latitude'] = location.latitude
-  row['longitude'] = location.longitude
-  row['reverse_address'] = reverse_address
-  row['county_fips'] = county_fips
-  row['block_fips'] = block_fips
-  row['county_name'] = county_name
-  return row
-
-
 def get_county_and_block_fips(latitude, longitude):
   """ Get the latitude, longitude, county/block fips, and county name """
   response = requests.get('https://geo.fcc.gov/api/census/block/find',
@@ -115,52 +116,85 @@ def get_county_and_block_fips(latitude, longitude):
   sys.exit('FCC api call failed')
 
 
-def add_geo_metadata_to_dataframe(dataframe):
-  """ Iterate over all cities in the dataframe, then add geo metadata to all of them """
-  geolocator = get_geopy_googlev3_locator(GEOCODE_API_KEY)
-  cached_json = get_dict_from_json_file(GEOCODE_CACHED_JSON_FILENAME)
-  add_empty_columns(dataframe, [
-    'latitude', 'longitude', 'reverse_address', 'county_fips', 'block_fips',
-    'county_name'
-  ])
+def get_geo_metadata(geolocator, search_query, rate_limiters):
+  """ Geocode a city, then get the reverse address and the county/block fips of
+  its location, one after the other.  Every call waits for its endpoint's rate
+  limiter.  Returns None if the city isn't found. """
+  rate_limiters['geocode'].acquire()
+  location = geolocator.geocode(search_query)
+  if location is None:
+    return None
+  rate_limiters['reverse'].acquire()
+  reverse_address = get_reverse_address(geolocator, location)
+  rate_limiters['fcc'].acquire()
+  fips = get_county_and_block_fips(location.latitude, location.longitude)
+  return get_geo_metadata_dict(location, reverse_address, fips)
+
+
+def get_new_geo_metadata(geolocator, search_queries, jobs):
+  """ Look up the cities of `search_queries`, up to `jobs` at the same time,
+  each in its own thread, within GEOCODE_RATE_LIMITS.  Yields the
+  (search_query, geo metadata dict) of every city, in `search_queries` order. """
+  rate_limiters = get_rate_limiters(GEOCODE_RATE_LIMITS)
+  with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+    yield from zip(
+      search_queries,
+      executor.map(get_geo_metadata, [geolocator] * len(search_queries),
+                   search_queries, [rate_limiters] * len(search_queries)))
+
+
+def add_geo_metadata_to_dataframe(dataframe,
+                                  geolocator=None,
+                                  jobs=GEOCODE_JOBS,
+                                  scrape_cache=None):
+  """ Look up the geo metadata of all the cities in the dataframe that aren't
+  in the cache, then add it to all of them.  Every city is added to the cache as
+  soon as it's looked up, in the order of the dataframe, so the cache is the
+  same for any `jobs`. """
+  if geolocator is None:
+    geolocator = get_geopy_googlev3_locator(GEOCODE_API_KEY)
+  if scrape_cache is None:
+    scrape_cache = get_scrape_cache('geocode', GEOCODE_CACHED_JSON_FILENAME)
+  search_queries = (dataframe['city'].astype(str) + ', ' +
+                    dataframe['state'].astype(str) + ', USA')
+  cached_json = scrape_cache.get_many(search_queries)
+  new_search_queries = [
+    search_query for search_query in search_queries.drop_duplicates()
+    if search_query not in cached_json
+  ]
+  new_geo_metadata = get_new_geo_metadata(geolocator, new_search_queries, jobs)
   api_count = 0
-  # pylint: disable=W0612
-  for index, row in dataframe.iterrows():
-    search_query = '{}, {}, USA'.format(row['city'], row['state'])
-    # make sure all 3 values are in the cache...
-    if search_query in cached_json:
-      # add to dataframe from cache
-      city_geo_dict = cached_json[search_query]
-      for dict_key in city_geo_dict.keys():
-        row[dict_key] = city_geo_dict[dict_key]
-      continue
-    location = geolocator.geocode(search_query)
-    if location is None:
+  for search_query, city_geo_dict in new_geo_metadata:
+    if city_geo_dict is None:
       print('Skipping: %s' % search_query)
       continue
-    reverse_address = get_reverse_address(geolocator, location)
-    fips = get_county_and_block_fips(location.latitude, location.longitude)
-    row = add_geo_metadata_to_row(row, location, reverse_address,
-                                  fips['county'], fips['block'],
-                                  fips['county_name'])
-    cache_geo_metadata(cached_json, location, reverse_address, search_query,
-                       fips['county'], fips['block'], fips['county_name'])
-    api_count += 2  # two api hits per loop, 1 for geocode, 1 for reverse address
-    if api_count % 50 == 0:
+    cached_json[search_query] = city_geo_dict
+    scrape_cache.set(search_query, city_geo_dict)
+    # Three api hits per city: geocode, reverse address and fcc fips.
+    api_count += 3
+    # Log every 25 cities.
+    if api_count % 75 == 0:
       log_msg = '### api_count: {}, cache_count: {} ###'.format(
         api_count, len(cached_json))
       LOGGER.debug(log_msg)
-      write_dict_to_json_file(GEOCODE_CACHED_JSON_FILENAME, cached_json)
-  write_dict_to_json_file(GEOCODE_CACHED_JSON_FILENAME, cached_json)
+  scrape_cache.write_json_file()
+  add_empty_columns(dataframe, GEO_COLUMNS)
+  for column in GEO_COLUMNS:
+    dataframe[column] = [
+      cached_json.get(search_query, {}).get(column, '')
+      for search_query in search_queries
+    ]
   return dataframe
 
 
-def get_final_geocodes_dataframe():
-  """ The main function which returns the final dataframe. """
-  dataframe = get_dataframe_from_merged_table_metadata(LOGGER,
-                                                       CSV_FILES_TO_MERGE)
+def get_final_geocodes_dataframe(cache_filename=FUZZY_MATCH_CACHE_CSV_FILENAME):
+  """ The main function which returns the final dataframe. `cache_filename` is
+  where the fuzzy city name matches are kept between runs. """
+  dataframe = get_dataframe_from_merged_table_metadata(
+    LOGGER, CSV_FILES_TO_MERGE, fuzzy_match_cache_filename=cache_filename)
   dataframe = dataframe[['city', 'state']]
   dataframe = add_geo_metadata_to_dataframe(dataframe)
+  dataframe = add_city_id_column(dataframe)
   dataframe = dataframe.sort_values(by=['state', 'city'])
   return dataframe
 
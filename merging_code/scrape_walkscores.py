@@ -4,17 +4,26 @@ Get the walk/bike/transit scores for every city from the census, store the raw v
 in the cache, and write the csv. We use the csv from geocode in order to have the
 right lat/long/address
 """
-import time
+import concurrent.futures
 import sys
-import requests
+from merging_code.city_registry import add_city_id_column
 from merging_code.normalize_dataframes import add_empty_columns
-from merging_code.utils import get_dict_from_json_file, write_dict_to_json_file, get_dataframe_from_spreadsheet
+from merging_code.rate_limits import RateLimiter, get_with_backoff
+from merging_code.scrape_cache import get_scrape_cache
+from merging_code.utils import get_dataframe_from_spreadsheet
 from merging_code.utils import get_logger, write_final_dataframe
 from merging_code.secrets import WALKSCORE_API_KEY
 from file_locations import WALKSCORE_FINAL_CSV_FILENAME, WALKSCORE_CACHED_JSON_FILENAME, GEOCODE_FINAL_CSV_FILENAME
 
 LOGGER = get_logger('scrape_walkscores')
 
+MOBILITY_COLUMNS = ['walkscore', 'bikescore', 'transitscore']
+
+# Cities looked up at the same time, and the (calls per second, burst) they
+# share.  When walkscore answers 429 or 5xx, every call waits and slows down.
+WALKSCORE_JOBS = 4
+WALKSCORE_RATE_LIMIT = (1, 5)
+
 
 def get_mobility_scores_dict(walkscore_json, state_city_name):
   """ Take raw walkscore json response and return a simple dictionary
@@ -31,18 +40,15 @@ def get_mobility_scores_dict(walkscore_json, state_city_name):
   return summary_scores_dict
 
 
-def get_mobility_scores_from_api(city_row):
-  """ Get the walkscore json result from the walkscore api. """
-  # We hardcode a sleep time of 3 between every request, this works.
-  time.sleep(3)
-  lat = city_row['latitude']
-  long = city_row['longitude']
+def get_mobility_scores_from_api(latitude, longitude, rate_limiter):
+  """ Get the walkscore json result from the walkscore api, within the rate
+  limiter. """
   # I have no idea what is wrong with walkscore, but https doesn't work. only http.
   scheme = 'http://'
   fqdn = 'api.walkscore.com'
   url = '{}{}/score?format=json&lat={}&lon={}&transit=1&bike=1&wsapikey={}'.format(
-    scheme, fqdn, lat, long, WALKSCORE_API_KEY)
-  result = requests.get(url)
+    scheme, fqdn, latitude, longitude, WALKSCORE_API_KEY)
+  result = get_with_backoff(rate_limiter, url)
   json_value = result.json()
   if json_value['status'] == 40:
     print("export WALKSCORE_API_KEY='secret_key'")
@@ -50,15 +56,20 @@ def get_mobility_scores_from_api(city_row):
       'Misisng walkscore api key, get one here: https://www.walkscore.com/professional/api-sign-up.php'
     )
   result.raise_for_status()
-  return result.json()
+  return json_value
 
 
-def add_mobility_scores_to_row(row, walkscore_json, city_state_string):
-  """ Input a dataframe row without walkscores. Output a dataframe row with walkscores. """
-  summary_scores_dict = get_mobility_scores_dict(walkscore_json,
-                                                 city_state_string)
-  row[list(summary_scores_dict.keys())] = list(summary_scores_dict.values())
-  return row
+def get_new_walkscore_dicts(locations, jobs, rate_limit):
+  """ Get the walkscores of the (latitude, longitude) `locations`, up to `jobs`
+  at the same time, all within one rate limiter.  Yields the useful keys of
+  every walkscore json, in `locations` order. """
+  rate_limiter = RateLimiter(*rate_limit)
+  with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+    walkscore_dicts = executor.map(
+      lambda location: get_mobility_scores_from_api(*location, rate_limiter),
+      locations)
+    for walkscore_dict in walkscore_dicts:
+      yield extract_useful_keys_from_dict(walkscore_dict)
 
 
 def extract_useful_keys_from_dict(walkscore_dict):
@@ -74,38 +85,57 @@ def extract_useful_keys_from_dict(walkscore_dict):
   return result
 
 
-def add_mobility_scores_to_dataframe(dataframe):
-  """ Parse every city row from the geocode csv, add the walkscores cells to each. """
-  cached_dict = get_dict_from_json_file(WALKSCORE_CACHED_JSON_FILENAME)
-  add_empty_columns(dataframe, ['walkscore', 'bikescore', 'transitscore'])
-  api_count = 0
-  for index, row in dataframe.iterrows():
-    city_state_string = '{}, {}'.format(row['city'], row['state'])
-    # make sure all 3 values are in the cache...
-    if city_state_string in cached_dict:
-      # add to dataframe from cache
-      walkscore_dict = cached_dict[city_state_string]
-      cached_dict[city_state_string] = extract_useful_keys_from_dict(
-        walkscore_dict)
-      dataframe.loc[index] = add_mobility_scores_to_row(row, walkscore_dict,
-                                                        city_state_string)
-      continue
-    walkscore_dict = get_mobility_scores_from_api(row)
-    walkscore_dict = extract_useful_keys_from_dict(walkscore_dict)
+def add_mobility_scores_to_dataframe(dataframe,
+                                     jobs=WALKSCORE_JOBS,
+                                     rate_limit=WALKSCORE_RATE_LIMIT,
+                                     scrape_cache=None):
+  """ Get the walkscores of all the cities in the dataframe that aren't in the
+  cache, then add the walkscore cells to all of them.  Cached cities don't
+  wait for the rate limiter.  Every city is added to the cache as soon as it's
+  scored, in the order of the dataframe, so the cache is the same for any
+  `jobs`. """
+  if scrape_cache is None:
+    scrape_cache = get_scrape_cache('walkscore', WALKSCORE_CACHED_JSON_FILENAME)
+  city_state_strings = (dataframe['city'].astype(str) + ', ' +
+                        dataframe['state'].astype(str))
+  cached_dict = scrape_cache.get_many(city_state_strings)
+  # Shrink the cached cities down to the useful keys.
+  useful_dicts = {
+    city_state_string: extract_useful_keys_from_dict(walkscore_dict)
+    for city_state_string, walkscore_dict in cached_dict.items()
+  }
+  scrape_cache.set_many({
+    city_state_string: useful_dict
+    for city_state_string, useful_dict in useful_dicts.items()
+    if useful_dict != cached_dict[city_state_string]
+  })
+  cached_dict.update(useful_dicts)
+  is_new = ~city_state_strings.isin(cached_dict.keys())
+  is_new &= ~city_state_strings.duplicated()
+  new_rows = dataframe[is_new.to_numpy()]
+  locations = list(zip(new_rows['latitude'], new_rows['longitude']))
+  new_walkscore_dicts = get_new_walkscore_dicts(locations, jobs, rate_limit)
+  for city_state_string, walkscore_dict in zip(city_state_strings[is_new],
+                                               new_walkscore_dicts):
     cached_dict[city_state_string] = walkscore_dict
-    dataframe.loc[index] = add_mobility_scores_to_row(row, walkscore_dict,
-                                                      city_state_string)
-    api_count += 2  # two api hits per loop, 1 for geocode, 1 for reverse address
-    if api_count % 10 == 0:
-      LOGGER.debug('cached_dict count: {}'.format(str(len(cached_dict.keys()))))
-      write_dict_to_json_file(WALKSCORE_CACHED_JSON_FILENAME, cached_dict)
-  write_dict_to_json_file(WALKSCORE_CACHED_JSON_FILENAME, cached_dict)
+    scrape_cache.set(city_state_string, walkscore_dict)
+    LOGGER.debug('cached_dict count: {}'.format(str(len(cached_dict.keys()))))
+  scrape_cache.write_json_file()
+  mobility_scores = [
+    get_mobility_scores_dict(cached_dict[city_state_string], city_state_string)
+    for city_state_string in city_state_strings
+  ]
+  add_empty_columns(dataframe, MOBILITY_COLUMNS)
+  for column in MOBILITY_COLUMNS:
+    dataframe[column] = [scores[column] for scores in mobility_scores]
+  return dataframe
 
 
 def get_final_walkscores_dataframe():
   """ The main function which returns the final dataframe. """
   dataframe = get_dataframe_from_spreadsheet(LOGGER, GEOCODE_FINAL_CSV_FILENAME)
   add_mobility_scores_to_dataframe(dataframe)
+  dataframe = add_city_id_column(dataframe)
   return dataframe
 
 
@@ -2,15 +2,19 @@
 """
 Get the housing data for each row in GEOCODE_FINAL_CSV_FILENAME.
 """
-import time
+import collections
+import concurrent.futures
 import sys
 import pandas
 import quandl
 from file_locations import GEOCODE_FINAL_CSV_FILENAME, ZILLOW_CACHED_JSON_FILENAME
 from file_locations import CITY_CODES_CSV_FILENAME, ZILLOW_FINAL_CSV_FILENAME
+from merging_code.city_registry import add_city_id_column
 from merging_code.merge_dataframes import join_on_state_and_city
 from merging_code.normalize_dataframes import add_empty_columns, normalize_headers_in_dataframe
-from merging_code.utils import get_dict_from_json_file, write_dict_to_json_file, get_dataframe_from_spreadsheet
+from merging_code.rate_limits import SlidingWindowRateLimiter
+from merging_code.scrape_cache import get_scrape_cache
+from merging_code.utils import get_dataframe_from_spreadsheet
 from merging_code.utils import get_logger, write_final_dataframe, is_github_actions
 from merging_code.secrets import QUANDL_API_KEY
 
@@ -74,91 +78,200 @@ ZILLOW_PRICE_CODES = {
   'ZRIFAH': 'Zillow Rental Index Per Square Foot - All Homes'
 }
 
-ZILLOW_CACHE = get_dict_from_json_file(ZILLOW_CACHED_JSON_FILENAME)
-
-
-def quandl_get_dataframe(quandl_get_value, api_count):
-  """ Wrapper for quandl.get, to avoid the exception raising. and use caching. """
-  # get the value from the cache
-  if quandl_get_value in ZILLOW_CACHE:
-    quandl_value = ZILLOW_CACHE[quandl_get_value]
-    if quandl_value is not None:
-      quandl_value = pandas.DataFrame(quandl_value)
-  # query quandl
-  else:
-    api_count += 1
-    try:
-      if QUANDL_API_KEY == '' and not is_github_actions():
-        sys.exit(
-          'Missing zillow [quandl] API key. Go here -> https://www.quandl.com/account/profile. \
-                Then set environment variable, export QUANDL_API_KEY="api_key".'
-        )
-      quandl_value = quandl.get(quandl_get_value,
-                                collapse='annual',
-                                order='desc',
-                                api_key=QUANDL_API_KEY)
-      quandl_value = quandl_value.reset_index()
-      quandl_value['Date'] = quandl_value['Date'].dt.strftime('%Y-%m-%d')
-    except quandl.errors.quandl_error.NotFoundError:
-      quandl_value = None
-  if quandl_value is None:
-    # write the value to the cache
-    ZILLOW_CACHE[quandl_get_value] = None
-    return (None, api_count)
+# Cities looked up at the same time, and the quandl quota they share: 2,000
+# calls per 10 minutes.
+ZILLOW_JOBS = 8
+QUANDL_RATE_LIMIT = (2000, 600)
+
+
+def quandl_get_dict(quandl_get_value, rate_limiter):
+  """ Wrapper for quandl.get, to avoid the exception raising, within the rate
+  limiter.  Returns the cached form of the annual values, see
+  `get_compact_quandl_dict`.  Or None when quandl doesn't know the code. """
+  if QUANDL_API_KEY == '' and not is_github_actions():
+    sys.exit(
+      'Missing zillow [quandl] API key. Go here -> https://www.quandl.com/account/profile. \
+            Then set environment variable, export QUANDL_API_KEY="api_key".')
+  rate_limiter.acquire()
+  try:
+    quandl_value = quandl.get(quandl_get_value,
+                              collapse='annual',
+                              order='desc',
+                              api_key=QUANDL_API_KEY)
+  except quandl.errors.quandl_error.NotFoundError:
+    return None
+  quandl_value = quandl_value.reset_index()
+  quandl_value['Date'] = quandl_value['Date'].dt.strftime('%Y-%m-%d')
   zillow_dataframe = quandl_value.sort_values(by=['Date'], ascending=False)
-  ZILLOW_CACHE[quandl_get_value] = zillow_dataframe.to_dict()
-  return (zillow_dataframe, api_count)
+  return {
+    'dates': zillow_dataframe['Date'].to_list(),
+    'values': zillow_dataframe['Value'].to_list()
+  }
+
+
+def get_compact_quandl_dict(quandl_dict):
+  """ The cached form of a quandl code's annual values: the parallel lists of
+  their 'dates' and 'values', latest first.  Takes the older cached form too,
+  the `DataFrame.to_dict` of their 'Date' and 'Value' by row. """
+  if quandl_dict is None or 'dates' in quandl_dict:
+    return quandl_dict
+  dates = quandl_dict['Date']
+  rows = sorted(dates, key=dates.get, reverse=True)
+  return {
+    'dates': [dates[row] for row in rows],
+    'values': [quandl_dict['Value'][row] for row in rows]
+  }
 
 
-def add_zillow_price_code_to_row(row, city_code, zillow_price_code, api_count):
-  """ Take a row, add the zillow price code, return the row. """
-  quandl_get_value = 'ZILLOW/C{}_{}'.format(city_code, zillow_price_code)
-  quandl_value, api_count = quandl_get_dataframe(quandl_get_value, api_count)
-  if quandl_value is None:
-    return (row, api_count, False)
-  value = quandl_value['Value'].iloc[0]
-  row[zillow_price_code] = value
-  return (row, api_count, True)
+def get_latest_zillow_value(quandl_dict):
+  """ The latest value of a cached quandl code. """
+  return quandl_dict['values'][0]
 
 
-def add_zillow_price_codes_to_row(row, api_count):
-  """ Query quandl for all the housing data we want for each city/state. return pandas dataframe. """
-  city_codes = row.get('city_code').split('|')
-  working_city_code = False
+def get_city_code_quandl_get_values(city_code):
+  """ The quandl codes of every zillow price code, for a city code. """
+  return [
+    'ZILLOW/C{}_{}'.format(city_code, zillow_price_code)
+    for zillow_price_code in ZILLOW_PRICE_CODES
+  ]
+
+
+def get_zillow_values(city_codes, quandl_dicts):
+  """ The latest value of every zillow price code, of the first city code
+  quandl has any of them for.  Empty if it has none. """
   for city_code in city_codes:
-    for zillow_price_code, description in ZILLOW_PRICE_CODES.items():
-      log_msg = '{}, {} {{yesno}} {} found for city code: {}'.format(
-        row.get('city'), row.get('state'), description, city_code)
-      row, api_count, working_city_code = add_zillow_price_code_to_row(
-        row, city_code, zillow_price_code, api_count)
-      if working_city_code:
-        LOGGER.debug(log_msg.format(yesno=''))
-      else:
-        LOGGER.debug(log_msg.format(yesno='NOT'))
-    # if we got one working city_code for a city, we skip the rest.
-    if working_city_code:
-      return (row, api_count)
-  return (row, api_count)
-
-
-def add_zillow_price_codes_to_dataframe(dataframe):
-  """ Parse every city row from the geocode csv, add the walkscores cells to each. """
-  api_count = 0
-  for index, row in dataframe.iterrows():
-    new_row, api_count = add_zillow_price_codes_to_row(row, api_count)
-    dataframe.loc[index] = new_row
-    api_pause = 20
-    if api_count > 0 and api_count % api_pause == 0:
-      log_msg = '### api_count: {}, cache_count: {} ###'.format(
-        api_count, len(ZILLOW_CACHE))
-      LOGGER.debug(log_msg)
-      write_dict_to_json_file(ZILLOW_CACHED_JSON_FILENAME, ZILLOW_CACHE)
-      # the quandl api limit is 2,000 calls per 10 minutes
-      # That's ~3.3 calls per second. We'll sleep so we don't get throttled.
-      time.sleep(api_pause / 3.3)
+    zillow_values = {
+      zillow_price_code: get_latest_zillow_value(quandl_dicts[quandl_get_value])
+      for zillow_price_code, quandl_get_value in zip(
+        ZILLOW_PRICE_CODES, get_city_code_quandl_get_values(city_code))
+      if quandl_dicts.get(quandl_get_value) is not None
+    }
+    if zillow_values:
+      return zillow_values
+  return {}
+
+
+def is_city_code_found(city_code, quandl_dicts):
+  """ Whether quandl has any of the zillow price codes of the city code. """
+  return any(
+    quandl_dicts.get(quandl_get_value) is not None
+    for quandl_get_value in get_city_code_quandl_get_values(city_code))
+
+
+def get_started_probes(futures):
+  """ Cancel the probes that haven't started yet, and return the quandl dicts
+  of the ones that did, since they cost a call. """
+  return {
+    quandl_get_value: future.result()
+    for quandl_get_value, future in futures.items()
+    if not future.cancel()
+  }
+
+
+def get_city_codes_to_probe(city_codes, cached_values):
+  """ The city codes of a city up to the first one `cached_values` has found,
+  the ones after it are never used. """
+  for position, city_code in enumerate(city_codes):
+    if is_city_code_found(city_code, cached_values):
+      return city_codes[:position + 1]
+  return city_codes
+
+
+def probe_city_codes(city_codes, cached_values, probe_pool, rate_limiter):
+  """ Get the quandl codes of all the city codes of a city that aren't in
+  `cached_values`, all at the same time.  Once a city code is found, the ones
+  after it that haven't started yet are cancelled.  Returns the dict of quandl
+  code to quandl dict, or None, of every one that was looked up. """
+  city_codes = get_city_codes_to_probe(city_codes, cached_values)
+  futures = {
+    quandl_get_value: probe_pool.submit(quandl_get_dict, quandl_get_value,
+                                        rate_limiter)
+    for city_code in city_codes
+    for quandl_get_value in get_city_code_quandl_get_values(city_code)
+    if quandl_get_value not in cached_values
+  }
+  new_dicts = {}
+  quandl_dicts = collections.ChainMap(new_dicts, cached_values)
+  for city_code in city_codes:
+    for quandl_get_value in get_city_code_quandl_get_values(city_code):
+      if quandl_get_value in futures:
+        new_dicts[quandl_get_value] = futures.pop(quandl_get_value).result()
+    if is_city_code_found(city_code, quandl_dicts):
+      break
+  new_dicts.update(get_started_probes(futures))
+  return new_dicts
+
+
+def get_new_quandl_dicts(city_codes_lists, cached_values, jobs):
+  """ Probe the city codes of every city, up to `jobs` cities and `jobs` quandl
+  codes at the same time, all within QUANDL_RATE_LIMIT.  Yields the new quandl
+  dicts of every city, in `city_codes_lists` order. """
+  rate_limiter = SlidingWindowRateLimiter(*QUANDL_RATE_LIMIT)
+  with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as probe_pool:
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+      yield from executor.map(
+        lambda city_codes: probe_city_codes(city_codes, cached_values,
+                                            probe_pool, rate_limiter),
+        city_codes_lists)
+
+
+def add_zillow_values_to_dataframe(dataframe, city_codes_lists, zillow_cache):
+  """ Add the zillow price codes of each city's first city code that quandl
+  has, from the cached quandl codes. """
+  for index, city_codes in zip(dataframe.index, city_codes_lists):
+    zillow_values = get_zillow_values(city_codes, zillow_cache)
+    log_msg = '{}, {} {{yesno}} found for city codes: {}'.format(
+      dataframe.at[index, 'city'], dataframe.at[index, 'state'], city_codes)
+    LOGGER.debug(log_msg.format(yesno='' if zillow_values else 'NOT'))
+    for zillow_price_code, value in zillow_values.items():
+      dataframe.at[index, zillow_price_code] = value
   return dataframe
 
 
+def get_zillow_cache(scrape_cache, city_codes_lists):
+  """ Read the cached quandl codes of the city codes, and only those.  The ones
+  still in the older cached form are compacted, in the cache too. """
+  cached_dicts = scrape_cache.get_many(
+    quandl_get_value for city_codes in city_codes_lists
+    for city_code in city_codes
+    for quandl_get_value in get_city_code_quandl_get_values(city_code))
+  zillow_cache = {
+    quandl_get_value: get_compact_quandl_dict(quandl_dict)
+    for quandl_get_value, quandl_dict in cached_dicts.items()
+  }
+  scrape_cache.set_many({
+    quandl_get_value: quandl_dict
+    for quandl_get_value, quandl_dict in zillow_cache.items()
+    if quandl_dict is not cached_dicts[quandl_get_value]
+  })
+  return zillow_cache
+
+
+def add_zillow_price_codes_to_dataframe(dataframe,
+                                        jobs=ZILLOW_JOBS,
+                                        scrape_cache=None):
+  """ Look up the city codes of all the cities in the dataframe, then add the
+  zillow price codes of each city's first city code that quandl has.  The
+  quandl codes of every city are added to the cache as soon as it's done. """
+  if scrape_cache is None:
+    scrape_cache = get_scrape_cache('zillow', ZILLOW_CACHED_JSON_FILENAME)
+  city_codes_lists = [
+    city_codes.split('|') for city_codes in dataframe['city_code']
+  ]
+  zillow_cache = get_zillow_cache(scrape_cache, city_codes_lists)
+  api_count = 0
+  for new_dicts in get_new_quandl_dicts(city_codes_lists, zillow_cache, jobs):
+    if new_dicts:
+      zillow_cache.update(new_dicts)
+      scrape_cache.set_many(new_dicts)
+      api_count += len(new_dicts)
+      LOGGER.debug('### api_count: {}, cache_count: {} ###'.format(
+        api_count, len(zillow_cache)))
+  scrape_cache.write_json_file()
+  return add_zillow_values_to_dataframe(dataframe, city_codes_lists,
+                                        zillow_cache)
+
+
 def normalize_city_codes_dataframe(dataframe):
   """ Add city, state and county columns, fill in the values. Lowercase everything.
   When we find duplicate cities with multiple rows, we merge them, and join the
@@ -205,6 +318,7 @@ def get_final_zillow_dataframe():
   combined_dataframe = combined_dataframe.reset_index()
   final_dataframe = add_zillow_price_codes_to_dataframe(combined_dataframe)
   final_dataframe = final_dataframe.drop(['index'], axis=1)
+  final_dataframe = add_city_id_column(final_dataframe)
   final_dataframe = final_dataframe.sort_values(by=['state', 'city'])
   return final_dataframe
 
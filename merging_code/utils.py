@@ -1,6 +1,8 @@
 """ Helper functions that are used in multiple different classes or files. """
 
+import ast
 import glob
+import hashlib
 import json
 import logging
 import os
@@ -8,6 +10,21 @@ import time
 import pandas
 
 import coloredlogs
+from merging_code.normalize_dataframes import get_header_projection
+
+# Typed binary copies of the *_normalized.csv and *_scraped.csv files, so the
+# next stage doesn't re-parse the csv and re-infer every dtype.  The csv files
+# stay the published output.  Set the INTERMEDIATE_FORMAT env variable to pick
+# the format, 'parquet' and 'feather' need pyarrow, and 'csv' turns them off.
+INTERMEDIATE_FILE_EXTENSIONS = {
+  'csv': None,
+  'feather': '.feather',
+  'parquet': '.parquet',
+  'pickle': '.pkl'
+}
+
+# Rows per chunk, when a csv file is read with a `row_filter`.
+CHUNK_ROW_COUNT = 10000
 
 
 def get_logger(logger_name):
@@ -49,11 +66,77 @@ def stop_watch_function(logger, function):
   return result
 
 
-def write_final_dataframe(logger, function, file_name, index=True):
-  """ A function to get the final dataframe, log the results, and write the file. """
+def get_intermediate_filename(csv_filename):
+  """ './foo/bar_normalized.csv' becomes './foo/bar_normalized.pkl', depending
+  on INTERMEDIATE_FORMAT.  Returns None if intermediates are turned off. """
+  file_format = os.environ.get('INTERMEDIATE_FORMAT', 'pickle')
+  file_ext = INTERMEDIATE_FILE_EXTENSIONS[file_format]
+  if file_ext is None:
+    return None
+  return '{}{}'.format(os.path.splitext(csv_filename)[0], file_ext)
+
+
+def write_intermediate_dataframe(logger, dataframe, csv_filename, index=True):
+  """ Write the typed copy of the dataframe that was written to `csv_filename`.
+  Like the csv, the index becomes columns when `index` is True. """
+  file_name = get_intermediate_filename(csv_filename)
+  if file_name is None:
+    return
+  dataframe = dataframe.reset_index(drop=not index)
+  if file_name.endswith('.pkl'):
+    dataframe.to_pickle(file_name)
+  elif file_name.endswith('.feather'):
+    dataframe.to_feather(file_name)
+  else:
+    dataframe.to_parquet(file_name, index=False)
+  logger.info('Wrote file: {}'.format(file_name))
+
+
+def read_intermediate_dataframe(logger,
+                                csv_filename,
+                                data_source=None,
+                                **kwargs):
+  """ Read the typed copy of `csv_filename`, or the csv file itself (with
+  `kwargs`) if there isn't one, or if the csv was written after it.  Like
+  `get_dataframe_from_spreadsheet`, a `data_source` drops the columns its
+  HEADERS_CHANGE drops. """
+  file_name = get_intermediate_filename(csv_filename)
+  if (file_name is None or not os.path.isfile(file_name) or
+      os.path.getmtime(file_name) < os.path.getmtime(csv_filename)):
+    return get_dataframe_from_spreadsheet(logger,
+                                          csv_filename,
+                                          data_source=data_source,
+                                          **kwargs)
+  logger.debug('Reading intermediate file: {}'.format(file_name))
+  if file_name.endswith('.pkl'):
+    dataframe = pandas.read_pickle(file_name)
+  elif file_name.endswith('.feather'):
+    dataframe = pandas.read_feather(file_name)
+  else:
+    dataframe = pandas.read_parquet(file_name)
+  if data_source is None:
+    return dataframe
+  is_kept_column = get_header_projection(data_source)
+  dropped_columns = [
+    column for column in dataframe.columns if not is_kept_column(column)
+  ]
+  if dropped_columns:
+    dataframe = dataframe.drop(columns=dropped_columns)
+  return dataframe
+
+
+def write_final_dataframe(logger,
+                          function,
+                          file_name,
+                          index=True,
+                          intermediate=True):
+  """ A function to get the final dataframe, log the results, and write the file.
+  Unless `intermediate` is False, a typed copy is written next to it. """
   final_dataframe = stop_watch_function(logger, function)
   final_dataframe.to_csv(file_name, index=index)
   logger.info('Wrote file: {}'.format(file_name))
+  if intermediate:
+    write_intermediate_dataframe(logger, final_dataframe, file_name, index)
 
 
 def get_dict_from_json_file(filename):
@@ -74,18 +157,130 @@ def write_dict_to_json_file(filename, cached_json):
 def get_dataframe_from_spreadsheet(logger,
                                    file_path,
                                    sheet_type='csv',
+                                   data_source=None,
+                                   keep_columns=(),
+                                   row_filter=None,
+                                   chunk_row_count=CHUNK_ROW_COUNT,
                                    **kwargs):
-  """ Get the list of all csv filenames (from the repo root). """
+  """ Get the list of all csv filenames (from the repo root).  With a
+  `data_source`, only the columns its HEADERS_CHANGE keeps, and `keep_columns`,
+  are parsed.
+
+  `row_filter` takes a dataframe, with the spreadsheet's headers, and returns a
+  boolean `pandas.Series` of the rows to keep.  A csv file is then read
+  `chunk_row_count` rows at a time, and only the rows to keep of every chunk are
+  kept, so the whole file is never in memory.
+  """
   log_msg = 'Reading spreadsheet file: {}, sheet_type: {}, **kwargs: {}'.format(
     file_path, sheet_type, kwargs)
   logger.debug(log_msg)
+  if data_source is not None:
+    kwargs['usecols'] = get_header_projection(data_source, keep_columns)
   if sheet_type == 'xls':
-    return pandas.read_excel(file_path, **kwargs)
+    dataframe = pandas.read_excel(file_path, **kwargs)
+    if row_filter is None:
+      return dataframe
+    return dataframe[row_filter(dataframe)]
   if sheet_type == 'csv':
-    return pandas.read_csv(file_path, **kwargs)
+    if row_filter is None:
+      return pandas.read_csv(file_path, **kwargs)
+    with pandas.read_csv(file_path, chunksize=chunk_row_count,
+                         **kwargs) as chunks:
+      kept_chunks = [chunk[row_filter(chunk)] for chunk in chunks]
+    if not kept_chunks:
+      # A file without rows can have no chunks, it gets its header's columns.
+      return pandas.read_csv(file_path, **dict(kwargs, nrows=0))
+    return pandas.concat(kept_chunks)
   return None
 
 
+def get_file_hash(filename):
+  """ Return the sha1 hex digest of a file's content, or None if it's missing. """
+  if not os.path.isfile(filename):
+    return None
+  sha1 = hashlib.sha1()
+  with open(filename, 'rb') as file_handler:
+    for block in iter(lambda: file_handler.read(1 << 20), b''):
+      sha1.update(block)
+  return sha1.hexdigest()
+
+
+def get_module_filename(module_name):
+  """ 'merging_code.utils' becomes './merging_code/utils.py'. """
+  return './{}.py'.format(module_name.replace('.', '/'))
+
+
+def get_imported_repo_modules(module_name):
+  """ Return the repo modules that `module_name` imports, eg. 'file_locations'
+  and 'merging_code.*'. """
+  with open(get_module_filename(module_name)) as file_handler:
+    tree = ast.parse(file_handler.read())
+  imported = set()
+  for node in ast.walk(tree):
+    if isinstance(node, ast.ImportFrom) and node.module is not None:
+      imported.add(node.module)
+    if isinstance(node, ast.Import):
+      imported.update(alias.name for alias in node.names)
+  return {
+    name for name in imported
+    if name == 'file_locations' or name.startswith('merging_code.')
+  }
+
+
+def get_code_filenames(module_name):
+  """ Return the source files of `module_name`, and of every repo module it
+  imports, recursively.  These are the code of a stage. """
+  seen = set()
+  pending = [module_name]
+  while pending:
+    name = pending.pop()
+    if name in seen:
+      continue
+    seen.add(name)
+    pending.extend(get_imported_repo_modules(name))
+  return sorted(get_module_filename(name) for name in seen)
+
+
+def write_pickle_file(filename, data):
+  """ Pickle `data` to a temp file, then rename it to `filename`, so a
+  concurrent reader never sees half a file. """
+  temp_filename = '{}.{}.tmp'.format(filename, os.getpid())
+  pandas.to_pickle(data, temp_filename)
+  os.replace(temp_filename, filename)
+
+
+def get_cached_dataframe_from_spreadsheet(logger,
+                                          file_path,
+                                          cache_directory,
+                                          sheet_type='csv',
+                                          **kwargs):
+  """ Like `get_dataframe_from_spreadsheet`, but the parsed dataframe is pickled
+  in `cache_directory`, keyed on the sha1 of the file and the read options.  So
+  a spreadsheet is only parsed again when it, or the options, change. """
+  read_options = json.dumps(dict(kwargs, sheet_type=sheet_type),
+                            sort_keys=True,
+                            default=str)
+  cache_key = hashlib.sha1('{}\n{}'.format(get_file_hash(file_path),
+                                           read_options).encode('utf-8'))
+  base_name = os.path.basename(file_path)
+  cache_filename = os.path.join(
+    cache_directory, '{}.{}.pkl'.format(base_name, cache_key.hexdigest()))
+  if os.path.isfile(cache_filename):
+    logger.debug('Reading cached spreadsheet: {}'.format(cache_filename))
+    return pandas.read_pickle(cache_filename)
+  dataframe = get_dataframe_from_spreadsheet(logger, file_path, sheet_type,
+                                             **kwargs)
+  os.makedirs(cache_directory, exist_ok=True)
+  # Drop the entries of older versions of the spreadsheet.
+  stale_pattern = os.path.join(cache_directory,
+                               '{}.*.pkl'.format(glob.escape(base_name)))
+  for stale_filename in glob.glob(stale_pattern):
+    os.remove(stale_filename)
+  write_pickle_file(cache_filename, dataframe)
+  logger.debug('Wrote cached spreadsheet: {}'.format(cache_filename))
+  return dataframe
+
+
 def remove_substring_from_end_of_string(input_string, substring_list):
   """ func('foo bar baz', [' baz', ' bar']) outputs 'foo'. """
   new_string = input_string
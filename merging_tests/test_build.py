@@ -0,0 +1,75 @@
+""" All the code in merging_code.build should get tested here. """
+
+import os
+import pandas
+from merging_code.build import BUILD_STAGES, build, get_critical_path
+from merging_code.build import get_stage_dependencies
+
+
+def get_first_dataframe():
+  """ Fake stage, copies the primary source. """
+  return pandas.read_csv(os.environ['TEST_BUILD_SOURCE'])
+
+
+def get_second_dataframe():
+  """ Fake stage, copies the output of the first stage. """
+  return pandas.read_csv(os.environ['TEST_BUILD_FIRST'])
+
+
+def test_build_only_rebuilds_stale_stages(tmp_path, monkeypatch):
+  source_filename = str(tmp_path / 'source.csv')
+  first_filename = str(tmp_path / 'first.csv')
+  second_filename = str(tmp_path / 'second.csv')
+  monkeypatch.setenv('TEST_BUILD_SOURCE', source_filename)
+  monkeypatch.setenv('TEST_BUILD_FIRST', first_filename)
+  stages = [{
+    'name': 'first',
+    'module': 'merging_tests.test_build',
+    'function': get_first_dataframe.__name__,
+    'inputs': [source_filename],
+    'output': first_filename,
+    'index': False
+  }, {
+    'name': 'second',
+    'module': 'merging_tests.test_build',
+    'function': get_second_dataframe.__name__,
+    'inputs': [first_filename],
+    'output': second_filename,
+    'index': False
+  }]
+  manifest_filename = str(tmp_path / 'manifest.json')
+
+  def write_source(text):
+    with open(source_filename, 'w') as file_handler:
+      file_handler.write(text)
+
+  write_source('a\n1\n')
+  assert build(stages,
+               manifest_filename=manifest_filename) == ['first', 'second']
+  assert build(stages, manifest_filename=manifest_filename) == []
+  # The source changed, and so did the first stage's output.
+  write_source('a\n2\n')
+  assert build(stages,
+               manifest_filename=manifest_filename) == ['first', 'second']
+  # The source changed, but the first stage's output didn't.
+  write_source('a\n02\n')
+  assert build(stages, manifest_filename=manifest_filename) == ['first']
+  # A missing output is rebuilt.
+  os.remove(second_filename)
+  assert build(stages, manifest_filename=manifest_filename) == ['second']
+  assert build(stages, force=True,
+               manifest_filename=manifest_filename) == ['first', 'second']
+
+
+def test_get_critical_path():
+  dependencies = get_stage_dependencies(BUILD_STAGES)
+  assert dependencies['walkscore'] == {'geocode', 'census'}
+  assert dependencies['elections'] == set()
+  wall_times = {stage['name']: 1.0 for stage in BUILD_STAGES}
+  wall_times['fbi'] = 100.0
+  critical_path, critical_time = get_critical_path(BUILD_STAGES, dependencies,
+                                                   wall_times)
+  assert critical_path == [
+    'census', 'fbi', 'geocode', 'walkscore', 'city_comparison'
+  ]
+  assert critical_time == 104.0
@@ -0,0 +1,67 @@
+""" All the code in merging_code.city_registry should get tested here. """
+
+import pandas
+from merging_code.city_registry import add_city_id_column, get_city_aliases
+from merging_code.city_registry import get_city_registry_dataframe
+
+
+def test_get_city_aliases():
+  cities = pandas.Series([
+    'st. anthony city (stearns county)', 'st johns', 'abbeville city',
+    'chester township', 'alexander city',
+    'louisville/jefferson county metro government (balance)',
+    'las vegas metropolitan police department', 'avonmore boro'
+  ])
+  assert get_city_aliases(cities).tolist() == [
+    'saint anthony', 'saint johns', 'abbeville', 'chester township',
+    'alexander', 'louisville', 'las vegas', 'avonmore'
+  ]
+
+
+def test_add_city_id_column():
+  census_dataframe = pandas.DataFrame(
+    data={
+      'geoid': [30, 10, 20, 40],
+      'state': ['a', 'a', 'a', 'b'],
+      'city': ['manlius village', 'st. johns', 'x', 'x']
+    })
+  registry = get_city_registry_dataframe(census_dataframe)
+  # Ids are compact, and follow the 'geoid' order.
+  assert registry.set_index(['state', 'city']).loc[('a', 'x'), 'city_id'] == 1
+  dataframe = pandas.DataFrame(
+    data={
+      'state': ['a', 'a', 'a', 'b', 'b', 'a'],
+      'city': [
+        'manlius town', 'manlius village', 'saint johns', 'x city', 'y',
+        'x city'
+      ]
+    })
+  actual = add_city_id_column(dataframe, registry)['city_id']
+  # 'manlius town' doesn't take the id that 'manlius village' matched by name.
+  assert actual.tolist() == [pandas.NA, 2, 0, 3, pandas.NA, 1]
+
+
+def test_consolidated_and_joint_agency_names():
+  census_dataframe = pandas.DataFrame(
+    data={
+      'geoid': [10, 20, 30, 40, 50, 60, 70],
+      'state': ['ga', 'ga', 'ky', 'ky', 'nc', 'wa', 'ga'],
+      'city': [
+        'athens-clarke county unified government', 'savannah',
+        'lexington-fayette urban county', 'middlesborough', 'charlotte',
+        'beaux arts village town', 'lakeview town'
+      ]
+    })
+  registry = get_city_registry_dataframe(census_dataframe)
+  dataframe = pandas.DataFrame(
+    data={
+      'state': ['ga', 'ga', 'ky', 'ky', 'nc', 'wa', 'ga'],
+      'city': [
+        'athens-clarke county', 'savannah-chatham metropolitan', 'lexington',
+        'middlesboro', 'charlotte-mecklenburg', 'beaux arts',
+        'lakeview, harrison county'
+      ]
+    })
+  actual = add_city_id_column(dataframe, registry)['city_id']
+  # An agency qualified by its county isn't taken for another county's place.
+  assert actual.tolist() == [0, 1, 2, 3, 4, 5, pandas.NA]
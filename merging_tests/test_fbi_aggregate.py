@@ -0,0 +1,75 @@
+""" All the code in merging_code.fbi_aggregate should get tested here. """
+
+import numpy
+import pandas
+from merging_code.fbi_aggregate import fold_fbi_dataframe, get_empty_fbi_aggregate
+from merging_code.fbi_aggregate import get_fbi_means, get_first_and_last_populations
+from merging_code.fbi_aggregate import retire_fbi_dataframe
+
+
+def get_year_dataframe(year, random):
+  """ A year of normalized FBI data, for a random subset of 300 cities. """
+  cities = numpy.sort(random.choice(500, size=300, replace=False))
+  index = pandas.MultiIndex.from_arrays(
+    [['ohio'] * len(cities), ['city {:03d}'.format(city) for city in cities],
+     [year] * len(cities)],
+    names=['state', 'city', 'year'])
+  dataframe = pandas.DataFrame(
+    {
+      'population': random.integers(1, 10**6, size=len(cities)).astype(float),
+      # Quarters land on the rounding boundary of `round(1)`.
+      'burglary': random.integers(0, 10**6, size=len(cities)) / 4,
+      'rape': random.random(size=len(cities)) * 10**year % 7
+    },
+    index=index)
+  dataframe.loc[dataframe.index[::7], 'rape'] = None
+  return dataframe
+
+
+def get_earliest_and_latest_dataframe(combined):
+  """ The full rebuild reference for `get_first_and_last_populations`: every
+  city's rows of its earliest and its latest year. """
+  combined = combined.reset_index()
+  combined = combined.sort_values(by=['year'], kind='mergesort')
+  groupby = combined.set_index(['state', 'city']).groupby(['state', 'city'])
+  return (groupby.first(), groupby.last())
+
+
+def assert_aggregate_matches_full_rebuild(aggregate, dataframes):
+  """ The aggregate gives the same means, and first and last years, as the
+  concatenated dataframes. """
+  combined = pandas.concat(dataframes, sort=True)
+  expected = combined.groupby(level=[0, 1]).mean().round(1).sort_index()
+  pandas.testing.assert_frame_equal(expected, get_fbi_means(aggregate).round(1))
+  for expected, result in zip(get_earliest_and_latest_dataframe(combined),
+                              get_first_and_last_populations(aggregate)):
+    pandas.testing.assert_frame_equal(expected[['population', 'year']], result)
+
+
+def test_retire_matches_full_rebuild():
+  """ Folding in every year, then retiring some, is like never folding them. """
+  random = numpy.random.default_rng(12)
+  years = list(range(1, 6))
+  tables = [{
+    'document_label': 'fbi_{}'.format(year),
+    'year': year
+  } for year in years]
+  dataframes = [get_year_dataframe(year, random) for year in years]
+  # Without the compensation, retiring the year 3 burglary leaves a sum of
+  # 62.50000000000364, and a mean of 31.3 instead of 31.2.
+  for year, burglary in ((2, 30.7), (3, 32724.14146871332), (4, 31.8)):
+    dataframes[year - 1].loc[('ohio', 'boundary', year), :] = {
+      'population': 1000.0,
+      'burglary': burglary,
+      'rape': 1.0
+    }
+  aggregate = get_empty_fbi_aggregate()
+  for table, dataframe in zip(tables, dataframes):
+    aggregate = fold_fbi_dataframe(aggregate, table, dataframe)
+  assert_aggregate_matches_full_rebuild(aggregate, dataframes)
+  # Retire the first, a middle, and then the last year.
+  for position in (0, 1, -1):
+    aggregate = retire_fbi_dataframe(aggregate, tables.pop(position),
+                                     dataframes.pop(position))
+    assert_aggregate_matches_full_rebuild(aggregate, dataframes)
+  assert list(aggregate['tables']) == ['fbi_2', 'fbi_4']
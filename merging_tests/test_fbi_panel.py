@@ -0,0 +1,51 @@
+""" All the code in merging_code.fbi_panel should get tested here. """
+
+import numpy
+import pandas
+from merging_code.fbi_panel import add_fbi_panel_year, drop_fbi_panel_year
+from merging_code.fbi_panel import get_empty_fbi_panel, get_fbi_trends
+
+
+def get_year_dataframe(year, burglaries):
+  """ A year of normalized FBI data for the cities 'a', 'b' and 'c'. """
+  cities = [('ohio', city, year) for city in 'abc']
+  index = pandas.MultiIndex.from_tuples(cities, names=['state', 'city', 'year'])
+  columns = {'population': [1000.0, 2000.0, 3000.0], 'burglary': burglaries}
+  return pandas.DataFrame(columns, index=index)
+
+
+YEARS = [2014, 2015, 2017, 2019]
+BURGLARIES = {'a': [10.0, 14.0, 30.0, 10.0], 'b': [0.0, 3.0, 6.0, 9.0]}
+
+
+def get_panel():
+  """ A panel of `YEARS`.  'c' only has a burglary number the first year. """
+  panel = get_empty_fbi_panel()
+  for position, year in enumerate(YEARS):
+    burglaries = [BURGLARIES['a'][position], BURGLARIES['b'][position]]
+    burglaries.append(None if position else 5.0)
+    panel = add_fbi_panel_year(panel, get_year_dataframe(year, burglaries))
+  return panel
+
+
+def test_fbi_panel_trends():
+  """ Slopes are least squares fits over the years that have a value. """
+  panel = get_panel()
+  assert (panel.dtypes == 'float32').all()
+  assert len(panel) == 12
+  trends = get_fbi_trends(panel, ['burglary'])
+  for city in 'ab':
+    expected_slope = numpy.polyfit(YEARS, BURGLARIES[city], 1)[0]
+    assert trends.loc[('ohio', city),
+                      'burglary slope'] == round(expected_slope, 1)
+  assert trends.loc[('ohio', 'a'), 'burglary percent change'] == 0.0
+  # 'b' starts at 0, and 'c' only has one year.
+  assert pandas.isna(trends.loc[('ohio', 'b'), 'burglary percent change'])
+  assert trends.loc[('ohio', 'c')].isna().all()
+
+
+def test_drop_fbi_panel_year():
+  panel = drop_fbi_panel_year(get_panel(), 2019)
+  assert len(panel) == 9
+  trends = get_fbi_trends(panel, ['burglary'])
+  assert trends.loc[('ohio', 'a'), 'burglary percent change'] == 2.0
@@ -0,0 +1,46 @@
+""" All the code in merging_code.get_city_comparison should get tested here. """
+
+import tracemalloc
+import numpy
+import pandas
+from merging_code.get_city_comparison import get_assembled_city_comparison_dataframe
+from merging_code.utils import get_logger
+
+LOGGER = get_logger('test_get_city_comparison')
+
+
+def assemble_dataframe_column_by_column(dataframe):
+  """ The reference for the final assembly: round every cell, move one column
+  at a time, then drop and sort. """
+  dataframe['population density'] = (
+    dataframe['population'] / dataframe['land area sqmi census_2010']
+  ).apply(lambda cell_value: round(cell_value, None))
+  columns = list(dataframe)
+  for index, column in enumerate(['city', 'state', 'population density']):
+    columns.insert(index, columns.pop(columns.index(column)))
+    dataframe = dataframe.loc[:, columns]
+  dataframe = dataframe.drop(labels=['city_id', 'city_walkscore'], axis=1)
+  return dataframe.sort_values(by=['state', 'city'])
+
+
+def test_final_assembly():
+  """ The derived column, the columns and the sorted rows are the same as the
+  reference's, ties and empty cities included. """
+  dataframe = pandas.DataFrame(
+    {
+      'city_id': [3, 1, 2, 0, 4],
+      'population': [10.0, 25.0, 7.0, 5.0, 2.5],
+      'land area sqmi census_2010': [4.0, 10.0, 2.0, 2.0, 1.0],
+      'city_walkscore': ['ely', 'boulder', 'akron', 'ely', 'x'],
+      'state': ['ohio', 'colorado', 'ohio', 'ohio', 'colorado'],
+      'city': ['ely', 'boulder', 'akron', 'ely', numpy.nan]
+    },
+    index=[7, 3, 5, 1, 9])
+  expected = assemble_dataframe_column_by_column(dataframe.copy())
+  tracemalloc.start()
+  assembled = get_assembled_city_comparison_dataframe(dataframe)
+  _, peak_size = tracemalloc.get_traced_memory()
+  tracemalloc.stop()
+  LOGGER.info('Final assembly peak memory: {:.3f} MB'.format(peak_size / 2**20))
+  pandas.testing.assert_frame_equal(expected, assembled, check_exact=True)
+  assert assembled['population density'].to_list() == [2, 2, 4, 2, 2]
@@ -1,5 +1,8 @@
+import random
 import pandas
-from merging_code.merge_dataframes import prefix_match, join_on_state_and_city
+from merging_code.merge_dataframes import PrefixIndex, prefix_match, join_on_state_and_city
+from merging_code.merge_dataframes import read_fuzzy_match_cache, write_fuzzy_match_cache
+from merging_code.merge_dataframes import get_combined_dataframe
 from merging_code.utils import get_logger
 
 
@@ -13,6 +16,21 @@ def test_prefix_match():
   assert max_name == 'ab'
 
 
+def test_prefix_index_matches_prefix_match():
+  """ `PrefixIndex.match` must agree with the linear `prefix_match` scan,
+  including which name wins when several names match. """
+  rng = random.Random(0)
+  list_names = [
+    ''.join(rng.choice('abc ')
+            for _ in range(rng.randint(1, 5)))
+    for _ in range(200)
+  ]
+  prefix_index = PrefixIndex(list_names)
+  for name in list_names + ['', 'a', 'zzz', 'abcabcabc']:
+    assert prefix_index.match(name) == prefix_match(name, list_names)
+  assert PrefixIndex([]).match('a') is None
+
+
 def test_join_on_state_and_city():
   left_df = pandas.DataFrame(
     data={
@@ -39,3 +57,137 @@ def test_join_on_state_and_city():
   actual = join_on_state_and_city(get_logger('test'), left_df,
                                   right_df).set_index(['state', 'city'])
   assert actual.equals(expected)
+
+
+def test_join_on_state_and_city_many_fuzzy_matches():
+  left_df = pandas.DataFrame(
+    data={
+      'state': ['a', 'a', 'a', 'b'],
+      'city': ['x', 'y city', 'z', 'w'],
+      'data': [1, 2, 3, 4]
+    })
+  right_df = pandas.DataFrame(
+    data={
+      'state': ['a', 'a', 'b', 'b'],
+      'city': ['x cdp', 'y', 'w', 'v'],
+      'other': [5.0, 6.0, 7.0, 8.0]
+    })
+  # Exact matches come first, followed by the fuzzy matches in (state, city)
+  # order, with columns sorted like `DataFrame.append(sort=True)`.
+  expected = pandas.DataFrame(
+    data={
+      'city': ['w', 'x', 'y city'],
+      'data': [4, 1, 2],
+      'other': [7.0, 5.0, 6.0],
+      'state': ['b', 'a', 'a']
+    })
+  actual = join_on_state_and_city(get_logger('test'), left_df, right_df)
+  assert actual.equals(expected)
+
+
+def test_join_on_state_and_city_fuzzy_match_cache(tmp_path):
+  """ Cached aliases are reused until the right cities of their state change. """
+  cache_filename = str(tmp_path / 'fuzzy_match_cache.csv')
+  left_df = pandas.DataFrame(data={
+    'state': ['a', 'b'],
+    'city': ['x city', 'y city'],
+    'data': [1, 2]
+  })
+  right_df = pandas.DataFrame(data={
+    'state': ['a', 'b'],
+    'city': ['x', 'y'],
+    'other': [3, 4]
+  })
+  fuzzy_match_cache = {
+    'aliases': read_fuzzy_match_cache(cache_filename),
+    'left_source': 'left',
+    'right_source': 'right'
+  }
+  cold = join_on_state_and_city(get_logger('test'), left_df, right_df,
+                                fuzzy_match_cache)
+  write_fuzzy_match_cache(cache_filename, fuzzy_match_cache)
+  aliases = read_fuzzy_match_cache(cache_filename)
+  assert aliases['right_city'].tolist() == ['x', 'y']
+
+  # A warm join gives the same result from the cache alone.  Poison the alias
+  # for state 'a' to prove it is read back instead of being re-matched.
+  aliases.loc[aliases['state'] == 'a', 'right_city'] = ''
+  fuzzy_match_cache['aliases'] = aliases
+  warm = join_on_state_and_city(get_logger('test'), left_df, right_df,
+                                fuzzy_match_cache)
+  assert warm['city'].tolist() == ['y city']
+  assert cold['city'].tolist() == ['x city', 'y city']
+
+  # Changing the right cities of state 'a' invalidates its cached alias.
+  right_df.loc[right_df['state'] == 'a', 'city'] = 'x c'
+  changed = join_on_state_and_city(get_logger('test'), left_df, right_df,
+                                   fuzzy_match_cache)
+  assert changed['city'].tolist() == ['x city', 'y city']
+
+
+def get_merged_dataframe(dataframes, merge_on, optional_merge_on):
+  """ The reference for `get_combined_dataframe`: successive outer merges. """
+  combined_dataframe = None
+  for dataframe in dataframes:
+    if combined_dataframe is None:
+      combined_dataframe = dataframe
+      continue
+    on = merge_on + [
+      column for column in optional_merge_on if column in dataframe
+    ]
+    combined_dataframe = combined_dataframe.merge(dataframe, on=on, how='outer')
+  return combined_dataframe
+
+
+def get_random_credit_score_dataframes(rng, dataframe_count):
+  """ Small dataframes with repeated keys and empty counties. """
+  dataframes = []
+  for _ in range(dataframe_count):
+    row_count = rng.randint(1, 6)
+    dataframes.append(
+      pandas.DataFrame({
+        'city': [rng.choice('ab') for _ in range(row_count)],
+        'county': [rng.choice(['x', 'y', None]) for _ in range(row_count)],
+        'state': ['s'] * row_count,
+        'credit score': [rng.choice([700, 710]) for _ in range(row_count)]
+      }))
+  return dataframes
+
+
+def test_get_combined_dataframe():
+  """ The single concat gives one row for every distinct row of the successive
+  outer merges. """
+  rng = random.Random(0)
+  logger = get_logger('test_merge_dataframes')
+  merge_on = ['city', 'state', 'credit score']
+  for _ in range(50):
+    dataframes = get_random_credit_score_dataframes(rng, rng.randint(2, 5))
+    expected = get_merged_dataframe(dataframes, merge_on, ['county'])
+    expected = expected.drop_duplicates().sort_values(by=list(expected))
+    combined = get_combined_dataframe(logger, dataframes, merge_on, ['county'])
+    assert not combined.duplicated().any()
+    pandas.testing.assert_frame_equal(
+      expected.reset_index(drop=True),
+      combined.sort_values(by=list(combined)).reset_index(drop=True))
+
+
+def test_get_combined_dataframe_without_optional_column():
+  """ Like a merge on `merge_on`, a dataframe without 'county' only adds the
+  keys the others don't have, with an empty county. """
+  dataframes = [
+    pandas.DataFrame({
+      'city': ['a', 'b'],
+      'county': ['x', None],
+      'credit score': [700, 710]
+    }),
+    pandas.DataFrame({
+      'city': ['a', 'b', 'c'],
+      'credit score': [700, 710, 720]
+    })
+  ]
+  combined = get_combined_dataframe(get_logger('test_merge_dataframes'),
+                                    dataframes, ['city', 'credit score'],
+                                    ['county'])
+  assert combined['city'].to_list() == ['a', 'b', 'c']
+  assert combined['county'].to_list()[0] == 'x'
+  assert combined['county'][1:].isna().all()
@@ -1,8 +1,47 @@
 """ All the code in merging_code.normalize_census should get tested here. """
 
-from merging_tests.utils import get_city_state_row
+import pandas
+from file_locations import CENSUS_FINAL_CSV_FILENAME
+from merging_tests.utils import get_benchmarked_results, get_city_state_row
 from merging_code.headers_cleanup import HEADERS_CHANGE
-from merging_code.normalize_census import get_final_census_dataframe
+from merging_code.normalize_census import add_city_state_to_dataframe, get_final_census_dataframe
+from merging_code.utils import get_dataframe_from_spreadsheet, get_logger
+from merging_code.utils import remove_substring_from_end_of_string
+
+LOGGER = get_logger('test_normalize_census')
+
+
+def parse_city_state_from_row(row):
+  """ The row-wise reference for `add_city_state_to_dataframe`. """
+  city, state = ['NULL', 'NULL']
+  if row['Geographic area'].count(' - ') == 2:
+    state, city = row['Geographic area'].lower().split(' - ')[-2:]
+    city = remove_substring_from_end_of_string(city, [' city', ' cdp'])
+  return pandas.Series([city, state])
+
+
+def add_city_state_to_dataframe_row_wise(dataframe):
+  """ Parse every row with `parse_city_state_from_row`. """
+  dataframe[['city', 'state']] = dataframe.apply(parse_city_state_from_row,
+                                                 axis=1)
+  return dataframe[dataframe.state != "NULL"]
+
+
+def get_geographic_areas():
+  """ A 'Geographic area' column like the census 2010 csv's, made from the
+  places of the normalized census csv. """
+  census = get_dataframe_from_spreadsheet(LOGGER,
+                                          CENSUS_FINAL_CSV_FILENAME,
+                                          encoding='ISO-8859-1')
+  places = ('United States - ' + census['state'].str.title() + ' - ' +
+            census['city'].str.title() + ' city').to_list()
+  states = ('United States - ' + census['state'].drop_duplicates().str.title())
+  odd_places = [
+    'United States', 'United States - Ohio - Cdp City city',
+    'United States - Ohio - Lake Cdp', 'United States - Ohio - Township 2 - x',
+    'United States - Ohio - Ely city (balance)'
+  ]
+  return places + states.to_list() + odd_places
 
 
 def test_nyc_area():
@@ -13,3 +52,14 @@ def test_nyc_area():
     'area in square miles - land area']
   nyc_area = nyc_row.get(land_area_key)
   assert float(nyc_area) == 302.64
+
+
+def test_add_city_state_to_dataframe_benchmark():
+  """ The vectorized parser gives what the row-wise one did, for a table as
+  big as the census 2010 one. """
+  dataframe = pandas.DataFrame({'Geographic area': get_geographic_areas()})
+  expected, result = get_benchmarked_results(
+    LOGGER, add_city_state_to_dataframe_row_wise, add_city_state_to_dataframe,
+    dataframe)
+  pandas.testing.assert_frame_equal(expected, result, check_exact=True)
+  assert get_city_state_row(result, 'lake', 'ohio').shape[0] == 1
@@ -0,0 +1,70 @@
+""" All the code in merging_code.normalize_dataframes should get tested here. """
+
+import numpy
+import pandas
+from merging_code.headers_cleanup import HEADERS_CHANGE
+from merging_code.normalize_dataframes import normalize_headers_in_dataframe
+from merging_code.utils import remove_integers_from_string
+
+
+def normalize_headers_in_dataframe_row_wise(data_source, dataframe):
+  """ The reference for `normalize_headers_in_dataframe`: every step renames
+  the headers one at a time, and the digits are removed row by row. """
+  for column in dataframe.columns:
+    dataframe = dataframe.rename(columns={column: column.replace('\n', ' ')})
+  for column in dataframe.columns:
+    dataframe = dataframe.rename(columns={column: column.lower()})
+  headers_change = HEADERS_CHANGE.get(data_source, {})
+  dataframe = dataframe.rename(columns=headers_change.get('rename_columns', {}))
+  drop_columns = set(headers_change.get('drop_columns', set()))
+  dataframe = dataframe.drop(labels=list(drop_columns & set(dataframe.columns)),
+                             axis=1)
+  for column_name in ['city', 'state', 'county']:
+    if column_name in dataframe:
+      dataframe[column_name] = dataframe.apply(
+        lambda row, name=column_name: pandas.Series(
+          [remove_integers_from_string(row[name])]),
+        axis=1)
+  return dataframe
+
+
+def get_elections_like_dataframe(row_count):
+  """ A dataframe with the elections 2020 headers to rename and drop, and
+  'city', 'state' and 'county' cells with digits and without strings. """
+  cities = ['Boulder1', 'CDP 2 Town', 'St.² Johns', 'Ely', numpy.nan]
+  columns = {
+    'FIPS5': ['08013'] * row_count,
+    'Place': ['x'] * row_count,
+    'City': (cities * row_count)[:row_count],
+    'State': ['Colorado 4'] * row_count,
+    'County': ([1.0, numpy.nan] * row_count)[:row_count],
+    'Total\nVotes': numpy.arange(row_count)
+  }
+  for index in range(20):
+    columns['Extra\n{}'.format(index)] = numpy.arange(row_count) * index
+  return pandas.DataFrame(columns)
+
+
+def test_normalize_headers_in_dataframe():
+  """ Newlines are removed and headers lower cased before the renames, and the
+  digits are removed from the strings only. """
+  dataframe = normalize_headers_in_dataframe('elections_2020',
+                                             get_elections_like_dataframe(5))
+  assert list(dataframe.columns)[:5] == [
+    'county_fips', 'city', 'state', 'county', 'total votes'
+  ]
+  assert dataframe['city'].to_list()[:4] == [
+    'boulder', 'cdp  town', 'st. johns', 'ely'
+  ]
+  assert numpy.isnan(dataframe['city'][4])
+  assert dataframe['state'][0] == 'colorado '
+  assert dataframe['county'][0] == 1.0
+
+
+def test_normalize_headers_in_dataframe_matches_row_wise():
+  """ The compiled header plan gives what the row-wise steps did. """
+  dataframe = get_elections_like_dataframe(50)
+  expected = normalize_headers_in_dataframe_row_wise('elections_2020',
+                                                     dataframe.copy())
+  result = normalize_headers_in_dataframe('elections_2020', dataframe.copy())
+  pandas.testing.assert_frame_equal(expected, result, check_exact=True)
@@ -1,6 +1,8 @@
 """Test percentage of county that voted for Dem, Rep, Lib parties. """
 
-from merging_code.normalize_elections import get_final_elections_dataframe
+import pandas
+from merging_code.normalize_elections import PARTY_COLUMNS, get_final_elections_dataframe
+from merging_code.normalize_elections import get_party_percents_dataframe
 
 
 def test_normalize_elections():
@@ -15,3 +17,41 @@ def test_normalize_elections():
   assert round(float(county_rep_percent), 2) == 0.21
   county_lib_percent = boulder_row.get('county_lib_percent')
   assert round(float(county_lib_percent), 2) == 0.01
+
+
+def get_party_percents_dataframe_from_tuples(elections_dataframe):
+  """ The reference for `get_party_percents_dataframe`: a list of
+  (party, percent) tuples per county, scanned for every party. """
+  sum_votes = elections_dataframe.groupby('county_fips')['votes'].sum()
+  sum_votes = pandas.DataFrame({'county_total_votes': sum_votes})
+  elections_dataframe = elections_dataframe.merge(sum_votes,
+                                                  how='left',
+                                                  on='county_fips')
+  elections_dataframe = elections_dataframe[elections_dataframe['party'].isin(
+    PARTY_COLUMNS)]
+  elections_dataframe = elections_dataframe.assign(
+    county_vote_percent=elections_dataframe['votes'] /
+    elections_dataframe['county_total_votes'])
+  tuples = elections_dataframe.groupby('county_fips')[[
+    'party', 'county_vote_percent'
+  ]].apply(lambda x: list(zip(x.party, x.county_vote_percent))).reset_index()
+  for party, column in PARTY_COLUMNS.items():
+    tuples[column] = tuples[0].apply(lambda tuple_list, party=party: next(
+      (percent for name, percent in tuple_list if name == party), 0))
+  return tuples.drop(columns=[0])
+
+
+def test_get_party_percents_dataframe():
+  """ A missing party gets 0, the first row of a party wins, and a county
+  without any of the parties is left out. """
+  dataframe = pandas.DataFrame({
+    'county_fips': [
+      '08013', '08013', '08013', '01001', '01001', '01001', '02002'
+    ],
+    'party': ['REP', 'DEM', 'GRN', 'LIB', 'DEM', 'LIB', 'GRN'],
+    'votes': [20, 70, 10, 1, 3, 4, 5]
+  })
+  expected = get_party_percents_dataframe_from_tuples(dataframe)
+  party_percents = get_party_percents_dataframe(dataframe)
+  pandas.testing.assert_frame_equal(expected, party_percents, check_exact=True)
+  assert party_percents['county_lib_percent'].to_list() == [0.125, 0.0]
@@ -1,11 +1,231 @@
 """ All the code in merging_code.normalize_fbi should get tested here. """
 
-from merging_code.normalize_fbi import get_final_fbi_dataframe
+import math
+import pandas
+from merging_code import normalize_fbi
+from merging_code.fbi_aggregate import get_empty_fbi_aggregate, get_fbi_means
+from merging_code.fbi_aggregate import get_first_and_last_populations
+from merging_code.normalize_dataframes import normalize_headers_in_dataframe
+from merging_code.normalize_fbi import add_annual_percent_change_for_numeric_fields
+from merging_code.normalize_fbi import add_state_to_missing_state_col_cells
+from merging_code.normalize_fbi import get_fbi_aggregate, get_fbi_panel, get_fbi_table_metadata
+from merging_code.normalize_fbi import get_final_fbi_dataframe, get_normalized_fbi_dataframes
+from merging_code.normalize_fbi import get_updated_fbi_aggregate
+from merging_code.normalize_fbi import normalize_dataframe_by_pop100k
+from merging_code.utils import get_cached_dataframe_from_spreadsheet, get_logger
+from merging_tests.utils import get_benchmarked_results
 
+LOGGER = get_logger('test_normalize_fbi')
 
-def test_boulder_area():
+
+def normalize_row_by_pop100k(row, numeric_columns):
+  """ The row-wise reference for `normalize_dataframe_by_pop100k`. """
+  population = row['population']
+  new_columns = {}
+  for column in numeric_columns:
+    assert isinstance(row[column], (int, float))
+    if population > 0:
+      new_columns[column] = row[column] / population * 1e5
+    else:
+      new_columns[column] = None
+  return pandas.Series(new_columns)
+
+
+def normalize_dataframe_by_pop100k_row_wise(dataframe):
+  """ Normalize every row with `normalize_row_by_pop100k`. """
+  numeric_columns = dataframe.select_dtypes(
+    include=['float64', 'int64']).columns.to_list()
+  numeric_columns = [
+    col for col in numeric_columns if col not in ('population', 'year')
+  ]
+  dataframe[numeric_columns] = dataframe.apply(normalize_row_by_pop100k,
+                                               numeric_columns=numeric_columns,
+                                               axis=1)
+  return dataframe
+
+
+def add_state_to_missing_state_col_cells_row_wise(dataframe):
+  """ The row-wise reference for `add_state_to_missing_state_col_cells`. """
+  state = None
+  for index, row in dataframe.iterrows():
+    if pandas.notnull(row['state']):
+      state = row['state'].lower()
+      dataframe.at[index, 'state'] = state
+    dataframe.at[index, 'state'] = state
+  return dataframe
+
+
+def get_series_with_annual_percent_change_for_columns(row, numeric_columns):
+  """ Annual change for a row, with `math` on every cell. """
+  years = row['year']
+  new_columns = {}
+  for column in numeric_columns:
+    diff = row[column]
+    if years > 0 and diff != 0:
+      new_columns[column] = math.exp(math.log(diff) / years) - 1
+    else:
+      new_columns[column] = 0
+  return pandas.Series(new_columns)
+
+
+def add_annual_percent_change_for_numeric_fields_row_wise(dataframe):
+  """ The row-wise reference for `add_annual_percent_change_for_numeric_fields`. """
+  numeric_columns = [
+    col for col in dataframe.select_dtypes(include=['float64', 'int64']).columns
+    if not col.startswith('year')
+  ]
+  dataframe[numeric_columns] = dataframe.apply(
+    get_series_with_annual_percent_change_for_columns,
+    numeric_columns=numeric_columns,
+    axis=1)
+  return dataframe
+
+
+def get_fbi_year_dataframe(table_metadata, cache_directory):
+  """ One year's workbook, before it's normalized per 100k. """
+  dataframe = get_cached_dataframe_from_spreadsheet(
+    LOGGER,
+    table_metadata['xls_filename'],
+    cache_directory,
+    header=3,
+    sheet_type='xls')
+  dataframe = normalize_headers_in_dataframe(table_metadata['document_label'],
+                                             dataframe)
+  return add_state_to_missing_state_col_cells(dataframe)
+
+
+def test_boulder_area(tmp_path):
   """ We know the fbi property crime for boulder is ~2768, let's test this. """
-  dataframe = get_final_fbi_dataframe()
+  dataframe = get_final_fbi_dataframe(str(tmp_path / 'fbi_aggregate.pkl'),
+                                      tmp_path / 'xls_cache')
   boulder_property_crime = dataframe.loc[('colorado', 'boulder'),
                                          'property crime']
   assert round(boulder_property_crime, 2) == 3013.2
+
+
+def test_boulder_panel(tmp_path):
+  """ The panel has boulder's numbers of every year, the mean of which is the
+  published number. """
+  panel = get_fbi_panel(str(tmp_path / 'fbi_aggregate.pkl'),
+                        tmp_path / 'xls_cache')
+  boulder = panel.loc[('colorado', 'boulder')]
+  # Boulder isn't in the 2016 workbook.
+  assert list(boulder.index) == [2014, 2015, 2017, 2019]
+  assert boulder['property crime'].dtype == 'float32'
+  assert round(float(boulder['property crime'].mean()), 1) == 3013.2
+
+
+def test_parallel_years_match_serial_years(tmp_path):
+  """ Normalizing the years in worker processes gives the same dataframe. """
+  fbi_table_metadata = get_fbi_table_metadata()[-2:]
+  serial = get_normalized_fbi_dataframes(fbi_table_metadata, 1, tmp_path)
+  parallel = get_normalized_fbi_dataframes(fbi_table_metadata, 2, tmp_path)
+  for serial_dataframe, parallel_dataframe in zip(serial, parallel):
+    pandas.testing.assert_frame_equal(serial_dataframe, parallel_dataframe)
+
+
+def test_normalize_dataframe_by_pop100k():
+  """ Zero and missing populations get empty crime numbers, like the row-wise
+  reference. """
+  dataframe = pandas.DataFrame({
+    'city': ['a', 'b', 'c', 'd'],
+    'population': [2e5, 0, None, 3e4],
+    'murder': [10, 1, 2, None],
+    'rape': [1.5, 2.0, 3.0, 7.0]
+  })
+  expected = normalize_dataframe_by_pop100k_row_wise(dataframe.copy())
+  result = normalize_dataframe_by_pop100k(dataframe.copy())
+  pandas.testing.assert_frame_equal(expected, result, check_exact=True)
+  assert result.loc[0, 'murder'] == 5.0
+  assert result.loc[1:2, ['murder', 'rape']].isna().all(axis=None)
+
+
+def test_normalize_dataframe_by_pop100k_benchmark(tmp_path):
+  """ Compare the vectorized and row-wise normalization of a whole year. """
+  dataframe = get_fbi_year_dataframe(get_fbi_table_metadata()[-1], tmp_path)
+  expected, result = get_benchmarked_results(
+    LOGGER, normalize_dataframe_by_pop100k_row_wise,
+    normalize_dataframe_by_pop100k, dataframe)
+  pandas.testing.assert_frame_equal(expected, result, check_exact=True)
+
+
+def test_fbi_columnar_transforms_benchmark(tmp_path):
+  """ The columnar FBI transforms give exactly what the row-wise ones did. """
+  fbi_table_metadata = get_fbi_table_metadata()[-2:]
+  dataframe = get_cached_dataframe_from_spreadsheet(
+    LOGGER,
+    fbi_table_metadata[-1]['xls_filename'],
+    tmp_path,
+    header=3,
+    sheet_type='xls')
+  dataframe = normalize_headers_in_dataframe(
+    fbi_table_metadata[-1]['document_label'], dataframe)
+  expected, result = get_benchmarked_results(
+    LOGGER, add_state_to_missing_state_col_cells_row_wise,
+    add_state_to_missing_state_col_cells, dataframe)
+  pandas.testing.assert_frame_equal(expected, result, check_exact=True)
+
+  aggregate = get_updated_fbi_aggregate(get_empty_fbi_aggregate(),
+                                        fbi_table_metadata,
+                                        jobs=1,
+                                        cache_directory=tmp_path)
+  first, last = get_first_and_last_populations(aggregate)
+  population = pandas.DataFrame({
+    'population': last['population'] / first['population'],
+    'year': last['year'] - first['year']
+  })
+  expected, result = get_benchmarked_results(
+    LOGGER, add_annual_percent_change_for_numeric_fields_row_wise,
+    add_annual_percent_change_for_numeric_fields, population)
+  pandas.testing.assert_frame_equal(expected, result, check_exact=True)
+
+
+def test_get_updated_fbi_aggregate(tmp_path, monkeypatch):
+  """ Retiring a year from the aggregate only reads that year's xls file, and
+  gives the means of an aggregate that never had it. """
+  read_labels = []
+  normalize_fbi_dataframe = normalize_fbi.get_normalized_fbi_dataframe
+
+  def get_normalized_fbi_dataframe(table_metadata, cache_directory):
+    read_labels.append(table_metadata['document_label'])
+    return normalize_fbi_dataframe(table_metadata, cache_directory)
+
+  monkeypatch.setattr(normalize_fbi, 'get_normalized_fbi_dataframe',
+                      get_normalized_fbi_dataframe)
+  fbi_table_metadata = get_fbi_table_metadata()[-2:]
+  aggregate = get_updated_fbi_aggregate(get_empty_fbi_aggregate(),
+                                        fbi_table_metadata,
+                                        jobs=1,
+                                        cache_directory=tmp_path)
+  assert len(aggregate['tables']) == 2
+  del read_labels[:]
+  aggregate = get_updated_fbi_aggregate(aggregate,
+                                        fbi_table_metadata[1:],
+                                        jobs=1,
+                                        cache_directory=tmp_path)
+  assert read_labels == [fbi_table_metadata[0]['document_label']]
+  expected = get_updated_fbi_aggregate(get_empty_fbi_aggregate(),
+                                       fbi_table_metadata[1:],
+                                       jobs=1,
+                                       cache_directory=tmp_path)
+  assert aggregate['tables'] == expected['tables']
+  pandas.testing.assert_frame_equal(
+    get_fbi_means(expected).round(1),
+    get_fbi_means(aggregate).round(1))
+
+
+def test_get_fbi_aggregate_only_writes_when_out_of_date(tmp_path, monkeypatch):
+  """ The aggregate file is written when it's missing, and not when it's read
+  again with the same years. """
+  written = []
+  monkeypatch.setattr(normalize_fbi, 'get_fbi_table_metadata',
+                      lambda: get_fbi_table_metadata()[-1:])
+  monkeypatch.setattr(normalize_fbi, 'write_pickle_file',
+                      lambda filename, data: written.append(filename))
+  aggregate_filename = str(tmp_path / 'fbi_aggregate.pkl')
+  cache_directory = tmp_path / 'xls_cache'
+  aggregate = get_fbi_aggregate(aggregate_filename, cache_directory)
+  assert written == [aggregate_filename]
+  pandas.to_pickle(aggregate, aggregate_filename)
+  get_fbi_aggregate(aggregate_filename, cache_directory)
+  assert written == [aggregate_filename]
@@ -0,0 +1,93 @@
+""" All the code in merging_code.rate_limits should get tested here. """
+
+from merging_code.rate_limits import RateLimiter, SlidingWindowRateLimiter
+from merging_code.rate_limits import get_rate_limiters, get_with_backoff
+
+
+class FakeClock:
+  """ A clock that only moves when something sleeps. """
+
+  def __init__(self):
+    self.now = 0.0
+
+  def time(self):
+    return self.now
+
+  def sleep(self, seconds):
+    self.now += seconds
+
+
+def test_rate_limiter():
+  """ A burst goes at once, then the calls are spaced by 1 / rate. """
+  clock = FakeClock()
+  rate_limiter = RateLimiter(2, burst=3, clock=clock.time, sleep=clock.sleep)
+  call_times = []
+  for _ in range(5):
+    rate_limiter.acquire()
+    call_times.append(clock.now)
+  assert call_times == [0.0, 0.0, 0.0, 0.5, 1.0]
+  # After a quiet spell, the bucket is full again, but not fuller.
+  clock.sleep(10)
+  for _ in range(4):
+    rate_limiter.acquire()
+  assert clock.now == 11.5
+
+
+def test_sliding_window_rate_limiter():
+  """ The whole quota goes at once, then every call waits for the one
+  `period` before it to leave the window. """
+  clock = FakeClock()
+  rate_limiter = SlidingWindowRateLimiter(3, 10, clock.time, clock.sleep)
+  call_times = []
+  for _ in range(3):
+    rate_limiter.acquire()
+    call_times.append(clock.now)
+    clock.sleep(1)
+  for _ in range(4):
+    rate_limiter.acquire()
+    call_times.append(clock.now)
+  assert call_times == [0.0, 1.0, 2.0, 10.0, 11.0, 12.0, 20.0]
+
+
+def test_get_rate_limiters():
+  rate_limiters = get_rate_limiters({'geocode': (10, 5)})
+  assert rate_limiters['geocode'].rate == 10
+  assert rate_limiters['geocode'].burst == 5
+
+
+class FakeResponse:
+  """ Just what `get_with_backoff` looks at in a `requests` response. """
+
+  def __init__(self, status_code, headers=None):
+    self.status_code = status_code
+    self.headers = headers or {}
+
+
+def test_get_with_backoff():
+  """ A 429 or a 5xx pauses the calls for the Retry-After, or 2**attempt
+  seconds, and halves the rate, which the calls that go through win back. """
+  clock = FakeClock()
+  rate_limiter = RateLimiter(4, burst=1, clock=clock.time, sleep=clock.sleep)
+  responses = [
+    FakeResponse(429, {'Retry-After': '10'}),
+    FakeResponse(503),
+    FakeResponse(200)
+  ]
+  urls = []
+
+  def get(url):
+    urls.append(url)
+    return responses.pop(0)
+
+  response = get_with_backoff(rate_limiter, 'http://api', get=get)
+  assert response.status_code == 200
+  assert urls == ['http://api'] * 3
+  # 10s for the Retry-After and 1 / 2s for a token at the halved rate, then
+  # 2**1s for the 503 and 1 / 1s.
+  assert clock.now == 13.5
+  assert rate_limiter.rate == 1.4
+  # Out of retries, the last response is returned.
+  responses = [FakeResponse(500)] * 3
+  response = get_with_backoff(rate_limiter, 'http://api', retries=2, get=get)
+  assert response.status_code == 500
+  assert not responses
@@ -0,0 +1,108 @@
+""" All the code in merging_code.scrape_cache should get tested here. """
+
+import concurrent.futures
+from merging_code.scrape_cache import KEY_CHUNK_SIZE, ScrapeCache, get_scrape_cache
+from merging_code.utils import get_dict_from_json_file, get_file_hash, write_dict_to_json_file
+
+
+def test_fill_from_json_file(tmp_path):
+  """ A namespace gets the entries of its own json file that it doesn't have,
+  whenever the file changed. """
+  json_filename = str(tmp_path / 'geo_data.json')
+  filename = str(tmp_path / 'scrape_cache.sqlite')
+  cached_json = {'b': {'latitude': 1.5}, 'a': None, 'c': [1, 'x']}
+  write_dict_to_json_file(json_filename, cached_json)
+  scrape_cache = get_scrape_cache('geocode', json_filename, filename)
+  assert scrape_cache.get_all() == cached_json
+  assert list(scrape_cache.get_all()) == ['b', 'a', 'c']
+  assert not scrape_cache.is_ahead_of_json_file
+  write_dict_to_json_file(json_filename, {'a': 1, 'd': 1})
+  scrape_cache = get_scrape_cache('geocode', json_filename, filename)
+  assert scrape_cache.get_all() == dict(cached_json, d=1)
+  assert scrape_cache.is_ahead_of_json_file
+  assert get_scrape_cache('zillow', json_filename, filename).get_all() == {
+    'a': 1,
+    'd': 1
+  }
+
+
+def test_write_json_file(tmp_path):
+  """ The json file is only written when the namespace has something new, and
+  isn't read back after it was written. """
+  json_filename = str(tmp_path / 'walkscore_data.json')
+  filename = str(tmp_path / 'scrape_cache.sqlite')
+  write_dict_to_json_file(json_filename, {'a': 1})
+  scrape_cache = get_scrape_cache('walkscore', json_filename, filename)
+  scrape_cache.write_json_file()
+  json_hash = get_file_hash(json_filename)
+  scrape_cache.set_many({})
+  scrape_cache.write_json_file()
+  assert get_file_hash(json_filename) == json_hash
+  scrape_cache.set('b', {'walkscore': 2})
+  scrape_cache.write_json_file()
+  assert get_dict_from_json_file(json_filename) == {
+    'a': 1,
+    'b': {
+      'walkscore': 2
+    }
+  }
+  assert not scrape_cache.is_ahead_of_json_file
+  scrape_cache = get_scrape_cache('walkscore', json_filename, filename)
+  assert not scrape_cache.is_ahead_of_json_file
+
+
+def test_write_json_file_after_migration(tmp_path):
+  """ Responses that only a database filled the old way has, are written to
+  the json file by the next scrape. """
+  json_filename = str(tmp_path / 'zillow_data.json')
+  filename = str(tmp_path / 'scrape_cache.sqlite')
+  write_dict_to_json_file(json_filename, {'a': 1})
+  ScrapeCache('zillow', filename).set_many({'a': 1, 'b': 2})
+  scrape_cache = get_scrape_cache('zillow', json_filename, filename)
+  scrape_cache.write_json_file()
+  assert get_dict_from_json_file(json_filename) == {'a': 1, 'b': 2}
+
+
+def test_fill_from_missing_json_file(tmp_path):
+  scrape_cache = get_scrape_cache('walkscore', str(tmp_path / 'missing.json'),
+                                  str(tmp_path / 'scrape_cache.sqlite'))
+  assert not scrape_cache.get_all()
+
+
+def test_upserts(tmp_path):
+  """ An upsert keeps the key where it was, and bulk reads leave the missing
+  keys out. """
+  scrape_cache = ScrapeCache('walkscore', str(tmp_path / 'scrape_cache.sqlite'))
+  scrape_cache.set_many({'a': 1, 'b': 2})
+  scrape_cache.set('a', {'status': 1})
+  scrape_cache.set('c', 3)
+  assert scrape_cache.get_all() == {'a': {'status': 1}, 'b': 2, 'c': 3}
+  assert list(scrape_cache.get_many(['c', 'x', 'a', 'c'])) == ['a', 'c']
+
+
+def test_bulk_reads_in_chunks(tmp_path):
+  scrape_cache = ScrapeCache('walkscore', str(tmp_path / 'scrape_cache.sqlite'))
+  keys = [str(index) for index in range(KEY_CHUNK_SIZE * 2 + 1)]
+  scrape_cache.set_many({key: int(key) for key in keys})
+  values = scrape_cache.get_many(reversed(keys + ['y']))
+  assert list(values) == keys
+  assert values[keys[-1]] == KEY_CHUNK_SIZE * 2
+
+
+def test_concurrent_writers(tmp_path):
+  """ Threads writing through the same cache, and through caches of their own,
+  like processes would, don't lose any writes. """
+  filename = str(tmp_path / 'scrape_cache.sqlite')
+  shared_cache = ScrapeCache('zillow', filename)
+
+  def write_keys(writer):
+    scrape_cache = shared_cache if writer % 2 else ScrapeCache(
+      'zillow', filename)
+    for index in range(50):
+      scrape_cache.set('{} {}'.format(writer, index), [writer, index])
+
+  with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+    list(executor.map(write_keys, range(8)))
+  values = shared_cache.get_all()
+  assert len(values) == 8 * 50
+  assert values['7 49'] == [7, 49]
@@ -1,15 +1,91 @@
 """ All the code in merging_code.scrape_geocodes should get tested here. """
 
+import time
+from types import SimpleNamespace
+import pandas
+from merging_code import scrape_geocodes
 from merging_code.scrape_geocodes import get_final_geocodes_dataframe
+from merging_code.scrape_cache import ScrapeCache
 from merging_tests.utils import get_city_state_row
 
 
-def test_sunnyvale_geo():
+def test_sunnyvale_geo(tmp_path):
   """ We know the lat, long and reverse address for sunnyvale, let's test this. """
-  dataframe = get_final_geocodes_dataframe()
+  cache_filename = str(tmp_path / 'fuzzy_match_cache.csv')
+  dataframe = get_final_geocodes_dataframe(cache_filename=cache_filename)
   sunnyvale = get_city_state_row(dataframe, 'sunnyvale', 'california')
   assert len(sunnyvale) == 1
   assert float(sunnyvale.get('latitude')) == 37.36883
   assert float(sunnyvale.get('longitude')) == -122.0363496
   sunnyvale_address = 'El Camino & Mathilda, Sunnyvale, CA 94087, USA'
   assert sunnyvale.get('reverse_address').iloc[0] == sunnyvale_address
+
+
+class FakeGeolocator:
+  """ A local stand in for the geopy geolocator, which takes a while to answer,
+  like the real one. """
+
+  def __init__(self):
+    self.search_queries = []
+
+  def geocode(self, search_query):
+    time.sleep(0.01)
+    self.search_queries.append(search_query)
+    if search_query.startswith('nowhere'):
+      return None
+    latitude = float(len(search_query))
+    return SimpleNamespace(latitude=latitude, longitude=-latitude)
+
+  @staticmethod
+  def reverse(query, exactly_one):
+    assert exactly_one
+    time.sleep(0.01)
+    return SimpleNamespace(address='1 Main St, {}'.format(query))
+
+
+def get_fake_county_and_block_fips(latitude, longitude):
+  time.sleep(0.01)
+  return {
+    'county': '{:05d}'.format(int(latitude)),
+    'block': '{:015d}'.format(int(-longitude)),
+    'county_name': 'county {}'.format(int(latitude))
+  }
+
+
+def test_concurrent_geocoding(tmp_path, monkeypatch):
+  """ The cities looked up at the same time give the dataframe and the cache
+  of the ones looked up one at a time. """
+  monkeypatch.setattr(scrape_geocodes, 'get_county_and_block_fips',
+                      get_fake_county_and_block_fips)
+  monkeypatch.setattr(scrape_geocodes, 'GEOCODE_RATE_LIMITS', {
+    'geocode': (1000, 10),
+    'reverse': (1000, 10),
+    'fcc': (1000, 10)
+  })
+  cities = ['city {}'.format(index) for index in range(30)]
+  cities += ['city 3', 'nowhere', 'cached city']
+  cached_json = {
+    'cached city, ohio, USA': {
+      'latitude': 1.5,
+      'county_fips': '1'
+    }
+  }
+  results = []
+  for jobs in (1, 8):
+    scrape_cache = ScrapeCache(
+      'geocode', str(tmp_path / 'scrape_cache_{}.sqlite'.format(jobs)))
+    scrape_cache.set_many(cached_json)
+    dataframe = pandas.DataFrame({'city': cities, 'state': 'ohio'})
+    geolocator = FakeGeolocator()
+    dataframe = scrape_geocodes.add_geo_metadata_to_dataframe(
+      dataframe, geolocator, jobs, scrape_cache)
+    assert sorted(geolocator.search_queries) == sorted(
+      '{}, ohio, USA'.format(city) for city in cities[:30] + ['nowhere'])
+    results.append((dataframe, scrape_cache.get_all()))
+  pandas.testing.assert_frame_equal(results[0][0], results[1][0])
+  assert list(results[0][1].items()) == list(results[1][1].items())
+  dataframe = results[1][0]
+  assert dataframe['reverse_address'][0] == '1 Main St, 17.0, -17.0'
+  assert dataframe['latitude'][32] == 1.5
+  assert dataframe['longitude'][32] == ''
+  assert dataframe['latitude'][31] == ''
@@ -1,6 +1,12 @@
 """ All the code in merging_code.scrape_walkscores should get tested here. """
 
+import functools
+import threading
+import time
+import pandas
+from merging_code import rate_limits, scrape_walkscores
 from merging_code.scrape_walkscores import get_final_walkscores_dataframe
+from merging_code.scrape_cache import ScrapeCache
 from merging_tests.utils import get_city_state_row
 
 
@@ -11,3 +17,93 @@ def test_palo_alto_scores():
   assert int(palo_alto.get('walkscore')) == 44
   assert int(palo_alto.get('bikescore')) == 78
   assert int(palo_alto.get('transitscore')) == 29
+
+
+class FakeWalkscoreApi:
+  """ A local stand in for api.walkscore.com, which takes a while to answer,
+  and answers 429 to every fifth call. """
+
+  def __init__(self):
+    self.urls = []
+    self.lock = threading.Lock()
+
+  def get(self, url):
+    time.sleep(0.01)
+    with self.lock:
+      self.urls.append(url)
+      call_count = len(self.urls)
+    if call_count % 5 == 0:
+      return FakeWalkscoreResponse(429, {})
+    latitude = float(url.split('&lat=')[1].split('&')[0])
+    walkscore_json = {'status': 1, 'walkscore': int(latitude), 'foo': 'bar'}
+    if latitude > 10:
+      walkscore_json['bike'] = {'score': int(latitude) + 1}
+    return FakeWalkscoreResponse(200, walkscore_json)
+
+
+class FakeWalkscoreResponse:
+  """ Just what the walkscore scraper looks at in a `requests` response. """
+
+  def __init__(self, status_code, walkscore_json):
+    self.status_code = status_code
+    self.headers = {'Retry-After': '0'}
+    self.walkscore_json = walkscore_json
+
+  def json(self):
+    return self.walkscore_json
+
+  @staticmethod
+  def raise_for_status():
+    return None
+
+
+def assert_fake_walkscores(dataframe):
+  """ The scores of `test_concurrent_walkscores`: missing ones are ''. """
+  assert dataframe['walkscore'].to_list()[:3] == [0, 1, 2]
+  assert dataframe['bikescore'][11] == 12
+  assert dataframe['bikescore'][3] == ''
+  assert dataframe['walkscore'][20] == 3
+  assert dataframe.loc[21, ['walkscore', 'transitscore']].to_list() == ['', 7]
+
+
+def test_concurrent_walkscores(tmp_path, monkeypatch):
+  """ The cities scored at the same time, with 429s along the way, give the
+  dataframe and the cache of the ones scored one at a time.  Cached
+  cities don't call the api. """
+  cities = ['city {}'.format(index) for index in range(20)]
+  cities += ['city 3', 'cached city']
+  cached_dict = {
+    'cached city, ohio': {
+      'status': 2,
+      'transit': {
+        'score': 7
+      },
+      'foo': 'bar'
+    }
+  }
+  results = []
+  for jobs in (1, 4):
+    api = FakeWalkscoreApi()
+    monkeypatch.setattr(
+      scrape_walkscores, 'get_with_backoff',
+      functools.partial(rate_limits.get_with_backoff, get=api.get))
+    scrape_cache = ScrapeCache(
+      'walkscore', str(tmp_path / 'scrape_cache_{}.sqlite'.format(jobs)))
+    scrape_cache.set_many(cached_dict)
+    dataframe = pandas.DataFrame({
+      'city': cities,
+      'state': 'ohio',
+      'latitude': range(len(cities)),
+      'longitude': 0.0
+    })
+    dataframe = scrape_walkscores.add_mobility_scores_to_dataframe(
+      dataframe, jobs, (1000, 10), scrape_cache)
+    # 20 cities, and a retry for every fifth call.
+    assert len(api.urls) == 24
+    results.append((dataframe, scrape_cache.get_all()))
+  pandas.testing.assert_frame_equal(results[0][0], results[1][0])
+  assert list(results[0][1].items()) == list(results[1][1].items())
+  # The new cities and the cached ones are shrunk down to the useful keys.
+  assert 'foo' not in results[1][1]['city 0, ohio']
+  assert 'foo' not in results[1][1]['cached city, ohio']
+  assert_fake_walkscores(results[1][0])
@@ -1,5 +1,11 @@
 """ All the code in merging_code.scrape_walkscores should get tested here. """
 
+import time
+import numpy
+import pandas
+import quandl
+from merging_code import scrape_zillow
+from merging_code.scrape_cache import ScrapeCache
 from merging_code.scrape_zillow import get_final_zillow_dataframe
 from merging_tests.utils import get_city_state_row
 
@@ -10,3 +16,80 @@ def test_cambridge_rent_price_per_sqft():
   dataframe = get_final_zillow_dataframe()
   cambridge = get_city_state_row(dataframe, 'cambridge', 'massachusetts')
   assert round(cambridge.iloc[0].get('ZRIFAH'), 1) == 2.9
+
+
+def fake_quandl_get(quandl_get_value, **kwargs):
+  """ A local stand in for quandl.get, which takes a while to answer.  It knows
+  the city codes that are multiples of 3. """
+  assert kwargs['collapse'] == 'annual'
+  time.sleep(0.01)
+  city_code = int(quandl_get_value.split('/C')[1].split('_')[0])
+  if city_code % 3 != 0:
+    raise quandl.errors.quandl_error.NotFoundError('not found')
+  index = pandas.DatetimeIndex(['2020-12-31', '2019-12-31'], name='Date')
+  return pandas.DataFrame({'Value': [city_code / 10, 0.0]}, index=index)
+
+
+def test_get_compact_quandl_dict():
+  """ The older cached form gives the dates and values of the dataframe it was
+  made from, latest first. """
+  dataframe = pandas.DataFrame({
+    'Date': ['2018-12-31', '2020-12-31', '2019-12-31'],
+    'Value': [1.5, 2.5, float('nan')]
+  })
+  # Like the json cache file, the rows are strings.
+  dataframe.index = dataframe.index.astype(str)
+  expected = dataframe.sort_values(by=['Date'], ascending=False)
+  compact_dict = scrape_zillow.get_compact_quandl_dict(dataframe.to_dict())
+  assert compact_dict['dates'] == expected['Date'].to_list()
+  numpy.testing.assert_equal(compact_dict['values'],
+                             expected['Value'].to_list())
+  assert scrape_zillow.get_latest_zillow_value(compact_dict) == 2.5
+  assert scrape_zillow.get_compact_quandl_dict(compact_dict) is compact_dict
+  assert scrape_zillow.get_compact_quandl_dict(None) is None
+
+
+def get_city_codes_dataframe(city_codes):
+  """ A city per city codes, as `add_zillow_price_codes_to_dataframe` gets
+  them. """
+  return pandas.DataFrame({
+    'city': ['city {}'.format(index) for index in range(len(city_codes))],
+    'state': 'ohio',
+    'city_code': city_codes,
+    'ZRIFAH': ''
+  })
+
+
+def test_concurrent_zillow(tmp_path, monkeypatch):
+  """ The cities looked up at the same time, with their city codes probed at
+  the same time, give the dataframe of the ones looked up one at a time. """
+  monkeypatch.setattr(quandl, 'get', fake_quandl_get)
+  monkeypatch.setattr(scrape_zillow, 'QUANDL_API_KEY', 'api_key')
+  city_codes = ['1|2|3|6', '4', '9|12', '7|15', '5|3', '8', '21|24']
+  cached_dict = {'ZILLOW/C7_ZRIFAH': {'Date': {'0': '2020'}, 'Value': {'0': 7}}}
+  results = []
+  for jobs in (1, 8):
+    scrape_cache = ScrapeCache(
+      'zillow', str(tmp_path / 'scrape_cache_{}.sqlite'.format(jobs)))
+    scrape_cache.set_many(cached_dict)
+    dataframe = scrape_zillow.add_zillow_price_codes_to_dataframe(
+      get_city_codes_dataframe(city_codes), jobs, scrape_cache)
+    zillow_cache = scrape_cache.get_all()
+    assert zillow_cache['ZILLOW/C1_ZRIFAH'] is None
+    assert zillow_cache['ZILLOW/C3_ZRIFAH'] == {
+      'dates': ['2020-12-31', '2019-12-31'],
+      'values': [0.3, 0.0]
+    }
+    # Read in the older cached form, and compacted.
+    assert zillow_cache['ZILLOW/C7_ZRIFAH'] == {
+      'dates': ['2020'],
+      'values': [7]
+    }
+    results.append(dataframe)
+  pandas.testing.assert_frame_equal(results[0], results[1])
+  assert results[1]['ZRIFAH'].to_list() == [0.3, '', 0.9, 7, 0.3, '', 2.1]
+  # Everything a second run needs is cached.
+  monkeypatch.setattr(quandl, 'get', None)
+  dataframe = scrape_zillow.add_zillow_price_codes_to_dataframe(
+    get_city_codes_dataframe(city_codes), 8, scrape_cache)
+  pandas.testing.assert_frame_equal(results[1], dataframe)
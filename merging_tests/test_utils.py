@@ -1,5 +1,11 @@
+import contextlib
+import os
+import pandas
 from merging_code.get_city_comparison import CSV_FILES_TO_MERGE
 from merging_code.merge_dataframes import get_dataframe_from_merged_table_metadata
+from merging_code import utils
+from merging_code.utils import get_cached_dataframe_from_spreadsheet
+from merging_code.utils import read_intermediate_dataframe, write_final_dataframe
 from merging_code.utils import remove_substring_from_end_of_string, get_logger
 from merging_tests.utils import get_city_state_row
 
@@ -20,3 +26,146 @@ def test_madison_row():
   madison = get_city_state_row(dataframe, 'madison', 'wisconsin')
   madison_violent_crime = round(float(madison.get('violent crime')), 2)
   assert madison_violent_crime == 365.1
+
+
+def get_typed_dataframe():
+  return pandas.DataFrame({
+    'state': ['ohio', 'utah'],
+    'city': ['akron', 'provo'],
+    'county_fips': ['01001', '49049']
+  }).set_index(['state', 'city'])
+
+
+def test_read_intermediate_dataframe(tmp_path, monkeypatch):
+  """ The typed copy keeps the dtypes that the csv loses, and goes stale when
+  the csv is written after it. """
+  logger = get_logger('test')
+  csv_filename = str(tmp_path / 'test_normalized.csv')
+  monkeypatch.setenv('INTERMEDIATE_FORMAT', 'pickle')
+  write_final_dataframe(logger, get_typed_dataframe, csv_filename)
+  assert os.path.isfile(str(tmp_path / 'test_normalized.pkl'))
+  dataframe = read_intermediate_dataframe(logger, csv_filename)
+  assert list(dataframe.columns) == ['state', 'city', 'county_fips']
+  assert list(dataframe['county_fips']) == ['01001', '49049']
+  # Turned off, or stale, the csv is read, and the fips lose their zeros.
+  monkeypatch.setenv('INTERMEDIATE_FORMAT', 'csv')
+  dataframe = read_intermediate_dataframe(logger, csv_filename)
+  assert list(dataframe['county_fips']) == [1001, 49049]
+  monkeypatch.setenv('INTERMEDIATE_FORMAT', 'pickle')
+  os.utime(csv_filename, (0, os.path.getmtime(csv_filename) + 10))
+  dataframe = read_intermediate_dataframe(logger, csv_filename)
+  assert list(dataframe['county_fips']) == [1001, 49049]
+
+
+def test_get_cached_dataframe_from_spreadsheet(tmp_path, monkeypatch):
+  """ A spreadsheet is parsed once, then again only when it changes. """
+  logger = get_logger('test')
+  csv_filename = str(tmp_path / 'test.csv')
+  cache_directory = str(tmp_path / 'cache')
+  parsed_filenames = []
+  get_dataframe = utils.get_dataframe_from_spreadsheet
+
+  def get_parsed_dataframe(logger, file_path, sheet_type, **kwargs):
+    parsed_filenames.append(file_path)
+    return get_dataframe(logger, file_path, sheet_type, **kwargs)
+
+  monkeypatch.setattr(utils, get_dataframe.__name__, get_parsed_dataframe)
+  with open(csv_filename, 'w') as file_handler:
+    file_handler.write('note\ncity,population\nakron,1\n')
+  for _ in range(2):
+    dataframe = get_cached_dataframe_from_spreadsheet(logger,
+                                                      csv_filename,
+                                                      cache_directory,
+                                                      header=1)
+    assert list(dataframe['population']) == [1]
+  assert len(parsed_filenames) == 1
+  # Other read options are another cache entry.
+  get_cached_dataframe_from_spreadsheet(logger, csv_filename, cache_directory)
+  assert len(parsed_filenames) == 2
+  with open(csv_filename, 'w') as file_handler:
+    file_handler.write('note\ncity,population\nakron,2\n')
+  dataframe = get_cached_dataframe_from_spreadsheet(logger,
+                                                    csv_filename,
+                                                    cache_directory,
+                                                    header=1)
+  assert list(dataframe['population']) == [2]
+  assert len(parsed_filenames) == 3
+  # Older versions of the spreadsheet are dropped from the cache.
+  assert len(os.listdir(cache_directory)) == 1
+
+
+def test_projection_from_header_plan(tmp_path):
+  """ The columns 'experian' drops are never parsed, from the csv or from the
+  typed copy, unless they're kept. """
+  logger = get_logger('test')
+  csv_filename = str(tmp_path / 'test_normalized.csv')
+  pandas.DataFrame({
+    'Rank': [1, 2],
+    'City': ['akron', 'provo'],
+    'Population': [190000, 115000],
+    'Vantage Score': [680, 710]
+  }).to_csv(csv_filename, index=False)
+  dataframe = utils.get_dataframe_from_spreadsheet(logger,
+                                                   csv_filename,
+                                                   data_source='experian',
+                                                   keep_columns=['Rank'])
+  assert list(dataframe.columns) == ['Rank', 'City', 'Vantage Score']
+  pandas.read_csv(csv_filename).to_pickle(str(tmp_path / 'test_normalized.pkl'))
+  dataframe = read_intermediate_dataframe(logger,
+                                          csv_filename,
+                                          data_source='experian')
+  assert list(dataframe.columns) == ['City', 'Vantage Score']
+
+
+def is_even_rank(dataframe):
+  return dataframe['Rank'] % 2 == 0
+
+
+def test_chunked_row_filter(tmp_path):
+  """ A csv read in chunks with a row filter gives the rows, and the index, of
+  the whole csv filtered. """
+  logger = get_logger('test')
+  csv_filename = str(tmp_path / 'test_source.csv')
+  pandas.DataFrame({
+    'Rank': range(25),
+    'City': ['city {}'.format(rank) for rank in range(25)],
+    'Population': range(1000, 1025)
+  }).to_csv(csv_filename, index=False)
+  whole_dataframe = pandas.read_csv(csv_filename, usecols=['Rank', 'City'])
+  dataframe = utils.get_dataframe_from_spreadsheet(logger,
+                                                   csv_filename,
+                                                   data_source='experian',
+                                                   keep_columns=['Rank'],
+                                                   row_filter=is_even_rank,
+                                                   chunk_row_count=4)
+  pandas.testing.assert_frame_equal(
+    whole_dataframe[is_even_rank(whole_dataframe)], dataframe)
+  assert list(dataframe.index[:3]) == [0, 2, 4]
+
+
+def test_chunked_row_filter_without_rows(tmp_path, monkeypatch):
+  """ A csv without rows gives the empty dataframe of its header, whether or
+  not it's read in chunks. """
+  logger = get_logger('test')
+  csv_filename = str(tmp_path / 'test_source.csv')
+  with open(csv_filename, 'w') as file_handler:
+    file_handler.write('Rank,City,Population\n')
+  whole_dataframe = pandas.read_csv(csv_filename, usecols=['Rank', 'City'])
+  dataframe = utils.get_dataframe_from_spreadsheet(logger,
+                                                   csv_filename,
+                                                   usecols=['Rank', 'City'],
+                                                   row_filter=is_even_rank)
+  pandas.testing.assert_frame_equal(whole_dataframe, dataframe)
+  read_csv = pandas.read_csv
+
+  def read_csv_without_chunks(*args, chunksize=None, **kwargs):
+    if chunksize is None:
+      return read_csv(*args, **kwargs)
+    return contextlib.nullcontext(iter([]))
+
+  monkeypatch.setattr(pandas, 'read_csv', read_csv_without_chunks)
+  dataframe = utils.get_dataframe_from_spreadsheet(logger,
+                                                   csv_filename,
+                                                   usecols=['Rank', 'City'],
+                                                   row_filter=is_even_rank)
+  pandas.testing.assert_frame_equal(whole_dataframe, dataframe)
@@ -1,3 +1,20 @@
+import time
+
+
 def get_city_state_row(dataframe, city, state):
   return dataframe.loc[(dataframe['city'] == city) &
                        (dataframe['state'] == state)]
+
+
+def get_benchmarked_results(logger, reference_function, function, dataframe):
+  """ Run both functions on a copy of `dataframe`, log how long each took, and
+  return both results. """
+  times = []
+  results = []
+  for transform in (reference_function, function):
+    start_time = time.time()
+    results.append(transform(dataframe.copy()))
+    times.append(time.time() - start_time)
+  logger.info('{}, {} rows, reference: {:.3f}s new: {:.3f}s'.format(
+    function.__name__, len(dataframe), times[0], times[1]))
+  return results